@@ -0,0 +1,56 @@
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from line_protocol import PointSchema, Row
+from rates import RateDeriver
+from settings import TriggerSettings
+
+
+def _holds(trigger: TriggerSettings, value) -> bool:
+    return ((trigger.above is not None and value > trigger.above) or
+            (trigger.below is not None and value < trigger.below))
+
+
+class AdaptiveRate:
+    """
+    Picks the interval of a monitor's next measurement from its last one. While any trigger holds in any of its
+    points (e.g. any core or any disk), the monitor runs at min_interval_s. Once none do, the interval grows by
+    decay_factor each measurement until it is back at base_interval_s.
+    """
+
+    def __init__(self, base_interval_s: float, min_interval_s: float, triggers: Sequence[TriggerSettings],
+                 decay_factor: float = 2.0):
+        if min_interval_s > base_interval_s:
+            raise ValueError(f'Adaptive min_rate of {min_interval_s}s is slower than the base rate of '
+                             f'{base_interval_s}s')
+        if decay_factor <= 1:
+            raise ValueError(f'Adaptive decay_factor must be greater than 1, got {decay_factor}')
+        self.base_interval_s = base_interval_s
+        self.min_interval_s = min_interval_s
+        self.triggers = tuple(triggers)
+        self.decay_factor = decay_factor
+        self.interval_s = base_interval_s
+        # Triggers can be on counter rates, which need the previous sample of the same series
+        self.rates = RateDeriver('alongside')
+        self._checks: Dict[PointSchema, List[Tuple[int, TriggerSettings]]] = {}
+
+    def _schema_checks(self, schema: PointSchema) -> List[Tuple[int, TriggerSettings]]:
+        checks = self._checks.get(schema)
+        if checks is None:
+            keys = schema.field_keys
+            checks = self._checks[schema] = [(keys.index(t.field), t) for t in self.triggers if t.field in keys]
+        return checks
+
+    def triggered(self, rows: Iterable[Row]) -> bool:
+        for schema, _, field_values in rows:
+            for i, trigger in self._schema_checks(schema):
+                value = field_values[i]
+                if value is not None and _holds(trigger, value):
+                    return True
+        return False
+
+    def update(self, rows: Iterable[Row], monotonic_ns: int) -> float:
+        if self.triggered(self.rates.derive(rows, monotonic_ns)):
+            self.interval_s = self.min_interval_s
+        else:
+            self.interval_s = min(self.interval_s * self.decay_factor, self.base_interval_s)
+        return self.interval_s
@@ -0,0 +1,222 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Iterable, List, Optional
+
+from spool import Spool
+
+OVERFLOW_POLICIES = ('drop-oldest', 'block')
+
+
+def backoff_delay_s(attempt: int, initial_s: float, max_s: float) -> float:
+    """
+    Exponential backoff with full jitter, so hosts that lost the same server do not all retry in lockstep
+    """
+    return random.uniform(0, min(max_s, initial_s * 2 ** min(attempt, 32)))
+
+
+@dataclass(frozen=True)
+class WriteStats:
+    points_queued: int = 0
+    points_written: int = 0
+    points_dropped: int = 0
+    points_spooled: int = 0
+    points_replayed: int = 0
+    spool_depth: int = 0
+    batches_written: int = 0
+    write_errors: int = 0
+    queue_depth: int = 0
+
+
+class BatchWriter:
+    """
+    Bounded queue drained by a background thread that hands points to `write` in batches of up to batch_size,
+    at least every flush_interval_s. When the queue is full, 'drop-oldest' discards the oldest queued points and
+    'block' makes the producer wait for the writer to catch up.
+
+    With a spool, failed batches are appended to it instead of being dropped, and later batches go straight to the
+    spool until health_check passes again, checked with exponential backoff from retry_interval_s up to
+    max_retry_interval_s. Spooled points are then replayed alongside live writes, limited to
+    replay_points_per_s so a long backlog does not starve them.
+    """
+
+    def __init__(self, write: Callable[[List[Any]], None], batch_size: int = 5000, flush_interval_s: float = 1.0,
+                 max_queue_size: int = 100000, overflow: str = 'drop-oldest', spool: Optional[Spool] = None,
+                 health_check: Optional[Callable[[], bool]] = None, retry_interval_s: float = 1,
+                 max_retry_interval_s: float = 60, replay_points_per_s: float = 5000):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}")
+        self._write = write
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.spool = spool
+        self.health_check = health_check
+        self.retry_interval_s = retry_interval_s
+        self.max_retry_interval_s = max_retry_interval_s
+        self._failed_health_checks = 0
+        self.replay_points_per_s = replay_points_per_s
+        self._degraded = False
+        self._next_health_check_s = 0.0
+        self._replay_tokens = 0.0
+        self._last_replay_s = time.monotonic()
+        self._queue: Deque[Any] = deque()
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='batch-writer', daemon=True)
+        self.points_queued = 0
+        self.points_written = 0
+        self.points_dropped = 0
+        self.points_spooled = 0
+        self.points_replayed = 0
+        self.batches_written = 0
+        self.write_errors = 0
+
+    def start(self):
+        self._thread.start()
+
+    def close(self, timeout_s: float = 10):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout_s)
+        if self._thread.is_alive():
+            logging.error(f'Timed out flushing writes, {len(self._queue)} points were not written')
+        elif self.spool is not None:
+            self.spool.close()
+
+    @property
+    def stats(self) -> WriteStats:
+        with self._cond:
+            return WriteStats(
+                points_queued=self.points_queued,
+                points_written=self.points_written,
+                points_dropped=self.points_dropped + (self.spool.points_evicted if self.spool is not None else 0),
+                points_spooled=self.points_spooled,
+                points_replayed=self.points_replayed,
+                spool_depth=self.spool.pending_points if self.spool is not None else 0,
+                batches_written=self.batches_written,
+                write_errors=self.write_errors,
+                queue_depth=len(self._queue),
+            )
+
+    def put(self, points: Iterable[Any]):
+        with self._cond:
+            for point in points:
+                if len(self._queue) >= self.max_queue_size:
+                    if self.overflow == 'drop-oldest':
+                        self._queue.popleft()
+                        self.points_dropped += 1
+                    else:
+                        self._cond.wait_for(lambda: len(self._queue) < self.max_queue_size or self._closing)
+                self._queue.append(point)
+                self.points_queued += 1
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _take_batch(self) -> List[Any]:
+        batch_len = min(len(self._queue), self.batch_size)
+        batch = [self._queue.popleft() for _ in range(batch_len)]
+        self._cond.notify_all()
+        return batch
+
+    def _wait_timeout_s(self, last_flush_s: float) -> float:
+        timeout_s = last_flush_s + self.flush_interval_s - time.monotonic()
+        if self.spool is not None and self.spool.pending_points:
+            if self._degraded:
+                timeout_s = min(timeout_s, self._next_health_check_s - time.monotonic())
+            else:
+                timeout_s = min(timeout_s, self.batch_size / self.replay_points_per_s)
+        return max(timeout_s, 0)
+
+    def _run(self):
+        last_flush_s = time.monotonic()
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._queue) >= self.batch_size or self._closing,
+                                    timeout=self._wait_timeout_s(last_flush_s))
+                if self._closing and not self._queue:
+                    return
+                if len(self._queue) >= self.batch_size or self._closing \
+                        or time.monotonic() - last_flush_s >= self.flush_interval_s:
+                    batch = self._take_batch()
+                    last_flush_s = time.monotonic()
+                else:
+                    batch = []
+            if batch:
+                self._flush(batch)
+            if self.spool is not None and not self._closing:
+                self._replay()
+
+    def _mark_degraded(self):
+        if not self._degraded:
+            self._failed_health_checks = 0
+        self._degraded = True
+        self._next_health_check_s = time.monotonic() + backoff_delay_s(
+            self._failed_health_checks, self.retry_interval_s, self.max_retry_interval_s)
+        self._failed_health_checks += 1
+
+    def _spool_or_drop(self, batch: List[Any]):
+        with self._cond:
+            if self.spool is None:
+                self.points_dropped += len(batch)
+                return
+            self.spool.append(batch)
+            self.points_spooled += len(batch)
+
+    def _flush(self, batch: List[Any]):
+        if self._degraded:
+            self._spool_or_drop(batch)
+            return
+        try:
+            self._write(batch)
+        except Exception:
+            logging.exception(f'Could not write batch of {len(batch)} points!')
+            with self._cond:
+                self.write_errors += 1
+            self._spool_or_drop(batch)
+            if self.spool is not None:
+                self._mark_degraded()
+            return
+        with self._cond:
+            self.points_written += len(batch)
+            self.batches_written += 1
+
+    def _replay(self):
+        now = time.monotonic()
+        self._replay_tokens = min(self._replay_tokens + (now - self._last_replay_s) * self.replay_points_per_s,
+                                  max(self.replay_points_per_s, self.batch_size))
+        self._last_replay_s = now
+        if not self.spool.pending_points:
+            return
+        if self._degraded:
+            if now < self._next_health_check_s:
+                return
+            if self.health_check is not None and not self.health_check():
+                self._mark_degraded()
+                return
+            self._degraded = False
+            logging.info(f'Connection restored, replaying {self.spool.pending_points} spooled points')
+
+        # Reading a segment updates the spool's point counts, which stats sums from other threads
+        with self._cond:
+            batch = self.spool.peek(min(int(self._replay_tokens), self.batch_size))
+        if not batch:
+            return
+        try:
+            self._write(batch)
+        except Exception:
+            logging.exception(f'Could not replay batch of {len(batch)} spooled points!')
+            with self._cond:
+                self.write_errors += 1
+            self._mark_degraded()
+            return
+        with self._cond:
+            self.spool.commit(len(batch))
+            self._replay_tokens -= len(batch)
+            self.points_replayed += len(batch)
+            self.batches_written += 1
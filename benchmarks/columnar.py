@@ -0,0 +1,141 @@
+import argparse
+import gc
+import time
+import tracemalloc
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy as np
+
+from benchmarks.fixtures import load_bench_settings
+from columns import Columns
+from line_protocol import LineProtocolEncoder, Row
+from results import CPU_CORE_SCHEMA, CPUTestData
+
+
+@dataclass(frozen=True)
+class LegacyCoreData:
+    """
+    How CPUTestData held each core before it held Columns
+    """
+    utilization_percent: float
+    user_percent: float
+    system_percent: float
+    iowait_percent: float
+    irq_percent: float
+    steal_percent: float
+    freq_mhz: Optional[float]
+
+
+def legacy_rows(cores: List[LegacyCoreData]) -> List[Row]:
+    return [
+        (CPU_CORE_SCHEMA, (core,), (d.utilization_percent, d.user_percent, d.system_percent, d.iowait_percent,
+                                    d.irq_percent, d.steal_percent, d.freq_mhz))
+        for core, d in enumerate(cores)
+    ]
+
+
+def build_legacy(percents: np.ndarray, freqs: List[float]) -> List[LegacyCoreData]:
+    return [
+        LegacyCoreData(utilization_percent=utilization, user_percent=user, system_percent=system,
+                       iowait_percent=iowait, irq_percent=irq, steal_percent=steal, freq_mhz=freq)
+        for (utilization, user, system, iowait, irq, steal), freq in zip(percents.tolist(), freqs)
+    ]
+
+
+def build_columnar(percents: np.ndarray, freqs: List[float], core_tags: List[Tuple[int]]) -> Columns:
+    return Columns(CPU_CORE_SCHEMA, core_tags, [*percents.T, array('d', freqs)])
+
+
+def gc_pauses(build: Callable[[], Any], serialize: Callable[[Any], Any], samples: int,
+              queued: int) -> Tuple[float, int, float, float]:
+    """
+    Returns the time per sample, and the number of collections, total and longest pause while taking them. The last
+    `queued` results are kept alive, as they would be while waiting for the main thread and the sinks.
+    """
+    queue = deque(maxlen=queued)
+    pauses = []
+    started = []
+
+    def callback(phase: str, info: dict):
+        if phase == 'start':
+            started.append(time.perf_counter())
+        else:
+            pauses.append(time.perf_counter() - started.pop())
+
+    gc.collect()
+    gc.callbacks.append(callback)
+    try:
+        start_s = time.perf_counter()
+        for _ in range(samples):
+            result = build()
+            queue.append(result)
+            serialize(result)
+        elapsed_s = time.perf_counter() - start_s
+    finally:
+        gc.callbacks.remove(callback)
+    return elapsed_s / samples, len(pauses), sum(pauses), max(pauses, default=0.0)
+
+
+def allocations(func: Callable[[], Any]) -> Tuple[int, int]:
+    """
+    Returns the blocks and bytes a sample still holds once taken, e.g. while queued for the main thread, and the
+    peak bytes allocated while taking and serializing it
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        result = func()
+        peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    held = sum(stat.count_diff for stat in after.compare_to(before, 'lineno'))
+    del result
+    return held, peak_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-core dataclasses with columnar CPU results')
+    parser.add_argument('--cores', type=int, default=256)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--queued', type=int, default=16, help='results kept alive at once')
+    args = parser.parse_args()
+
+    load_bench_settings()
+    rng = np.random.default_rng(0)
+    percents = (rng.random((args.cores, 6)) * 100).round(2)
+    freqs = [2400.0 + core for core in range(args.cores)]
+    core_tags = [(core,) for core in range(args.cores)]
+    encoder = LineProtocolEncoder()
+
+    def legacy_result():
+        return build_legacy(percents, freqs)
+
+    def columnar_result():
+        return CPUTestData(cores=build_columnar(percents, freqs, core_tags), load_avg_1m_percent=1.0,
+                           load_avg_5m_percent=1.0, load_avg_15m_percent=1.0, num_context_switches=1,
+                           num_interrupts=1, num_software_interrupts=1)
+
+    paths = {
+        'dataclasses': (legacy_result, lambda r: encoder.encode_rows(legacy_rows(r), 1)),
+        'columns': (columnar_result, lambda r: encoder.encode_rows(r.rows(), 1)),
+    }
+    print(f'{args.cores} cores, {args.samples} samples each with {args.queued} kept alive')
+    print(f'{"result":<14}{"held blocks":>13}{"peak (KiB)":>12}{"sample (us)":>13}{"collections":>13}'
+          f'{"gc total (ms)":>15}{"gc max (ms)":>13}')
+    for name, (build, serialize) in paths.items():
+        held, _ = allocations(build)
+        _, peak_bytes = allocations(lambda: serialize(build()))
+        per_sample_s, collections, total_s, max_s = gc_pauses(build, serialize, args.samples, args.queued)
+        print(f'{name:<14}{held:>13,}{peak_bytes / 1024:>12,.1f}{per_sample_s * 1e6:>13,.1f}{collections:>13,}'
+              f'{total_s * 1e3:>15,.2f}{max_s * 1e3:>13,.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import gzip
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Set
+
+
+class FakeInfluxDB:
+    """
+    Local stand-in for the InfluxDB /ping and /api/v2/write endpoints. Set `status` to make every request fail
+    with that HTTP status, and `latency_s` to delay every response. For intermittent faults, `error_rate` of the
+    writes fail with `error_status`, and `stall_rate` of them hang for `stall_s` before being answered, which a
+    client with a shorter read timeout sees as a timeout.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, keep_series: bool = False):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keeps connections alive between requests, like InfluxDB does
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status: int):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                time.sleep(fake.latency_s)
+                self._respond(fake.status or (204 if self.path.startswith('/ping') else 404))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(fake.latency_s)
+                with fake.lock:
+                    stall = fake.random.random() < fake.stall_rate
+                    error = fake.random.random() < fake.error_rate
+                if stall:
+                    time.sleep(fake.stall_s)
+                if fake.status or error:
+                    with fake.lock:
+                        fake.errors += 1
+                    self._respond(fake.status or fake.error_status)
+                    return
+                lines = gzip.decompress(body) if self.headers.get('Content-Encoding') == 'gzip' else body
+                with fake.lock:
+                    fake.requests += 1
+                    fake.bytes_received += len(body)
+                    fake.lines_received += lines.count(b'\n') + (0 if lines.endswith(b'\n') else 1)
+                    if fake.series is not None:
+                        fake.series.update(line.split(b' ', 1)[0] for line in lines.split(b'\n') if line)
+                self._respond(204)
+
+        self.status = 0
+        self.latency_s = 0.0
+        self.error_rate = 0.0
+        self.error_status = 503
+        self.stall_rate = 0.0
+        self.stall_s = 0.0
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.errors = 0
+        self.requests = 0
+        self.bytes_received = 0
+        self.lines_received = 0
+        # Measurement and tag set of every line received, if kept
+        self.series: Optional[Set[bytes]] = set() if keep_series else None
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-influxdb', daemon=True)
+
+    @property
+    def address(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'{host}:{port}'
+
+    def start(self) -> 'FakeInfluxDB':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
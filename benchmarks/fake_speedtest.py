@@ -0,0 +1,167 @@
+import argparse
+import copy
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.fixtures import BENCH_SETTINGS
+from settings import Settings
+
+CHUNK = bytes(65536)
+UPLOAD_IDLE_S = 0.05
+# What speedtest.net's configuration looks like after speedtest.Speedtest.get_config() has parsed it
+SPEEDTEST_CONFIG = {
+    'client': {'ip': '127.0.0.1', 'lat': '51.5', 'lon': '-0.12', 'isp': 'Loopback', 'country': 'GB'},
+    'ignore_servers': [],
+    'sizes': {'upload': [32768, 65536, 131072, 262144, 524288, 1048576, 7340032],
+              'download': [350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000]},
+    'counts': {'upload': 4, 'download': 4},
+    'threads': {'upload': 2, 'download': 4},
+    'length': {'upload': 10, 'download': 10},
+    'upload_max': 28,
+}
+
+
+class FakeSpeedtestServer:
+    """
+    Local stand-in for a speedtest.net server: latency.txt, the randomNxN.jpg download files and upload.php. Set
+    `latency_s` to delay every response, or `status` to fail them.
+    """
+
+    def __init__(self, name: str, host: str = '127.0.0.1', port: int = 0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, body: bytes = b'', length: int = 0, status: int = 200):
+                time.sleep(fake.latency_s)
+                self.send_response(fake.status or status)
+                self.send_header('Content-Length', str(len(body) or length))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with fake.lock:
+                    fake.requests += 1
+                if '/latency.txt' in self.path:
+                    self._respond(b'test=test')
+                    return
+                match = re.search(r'/random(\d+)x\d+\.jpg', self.path)
+                if match is None:
+                    self._respond(status=404)
+                    return
+                size = 2 * int(match.group(1)) ** 2
+                self._respond(length=size)
+                while size > 0:
+                    self.wfile.write(CHUNK[:size])
+                    size -= len(CHUNK)
+                with fake.lock:
+                    fake.bytes_sent += 2 * int(match.group(1)) ** 2
+
+            def do_POST(self):
+                # speedtest-cli sends a few bytes less than its Content-Length for some sizes, so a body that
+                # stops arriving is taken to be complete
+                self.connection.settimeout(UPLOAD_IDLE_S)
+                received, remaining = 0, int(self.headers.get('Content-Length', 0))
+                try:
+                    while remaining > 0:
+                        chunk = self.rfile.read1(min(remaining, len(CHUNK)))
+                        if not chunk:
+                            break
+                        received += len(chunk)
+                        remaining -= len(chunk)
+                except socket.timeout:
+                    self.close_connection = True
+                self.connection.settimeout(None)
+                with fake.lock:
+                    fake.requests += 1
+                    fake.bytes_received += received
+                self._respond(f'size={received}'.encode())
+
+        self.name = name
+        self.latency_s = 0.0
+        self.status = 0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name=f'fake-speedtest-{name}', daemon=True)
+
+    def entry(self, server_id: int, distance_km: float) -> dict:
+        """
+        The server as it appears in speedtest.net's server list
+        """
+        host, port = self.server.server_address[:2]
+        return {'url': f'http://{host}:{port}/speedtest/upload.php', 'lat': '51.5', 'lon': '-0.12', 'name': self.name,
+                'country': 'United Kingdom', 'cc': 'GB', 'sponsor': f'Stand-in {self.name}', 'id': str(server_id),
+                'host': f'{host}:{port}', 'd': distance_km}
+
+    def start(self) -> 'FakeSpeedtestServer':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the speedtest monitor against local stand-in servers')
+    parser.add_argument('--download-bytes', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--upload-bytes', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--threads', type=int, default=2)
+    args = parser.parse_args()
+
+    from network_monitor import NetworkSpeedMonitor, SpeedtestCache
+
+    near, far = FakeSpeedtestServer('near').start(), FakeSpeedtestServer('far').start()
+    far.latency_s = 0.02
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, 'speedtest-cache.json')
+        Settings.load_dict({
+            **BENCH_SETTINGS,
+            'network': {**BENCH_SETTINGS['network'], 'speedtest': {
+                **BENCH_SETTINGS['network']['speedtest'], 'cache_path': cache_path,
+                'download_bytes': args.download_bytes, 'upload_bytes': args.upload_bytes,
+                'download_threads': args.threads, 'upload_threads': args.threads,
+            }},
+        })
+        # speedtest.net can't be reached from here, so the configuration and server list start out cached
+        cache = SpeedtestCache(cache_path, 3600)
+        cache.put('config', copy.deepcopy(SPEEDTEST_CONFIG))
+        cache.put('servers', [near.entry(1, 1.0), far.entry(2, 2.0)])
+        cache.save()
+
+        monitor = NetworkSpeedMonitor('network-speedtest', '1h')
+        runs = [('cold', None), ('cached', None), ('degraded', lambda: setattr(near, 'latency_s', 0.05)),
+                ('reselected', None)]
+        print(f'{"run":<12}{"server":<18}{"cache":>7}{"config (ms)":>13}{"select (ms)":>13}{"download (ms)":>15}'
+              f'{"upload (ms)":>13}{"down (Mbps)":>13}{"up (Mbps)":>11}')
+        for name, before in runs:
+            if before is not None:
+                before()
+            success, r = monitor._measure()
+            if not success:
+                print(f'{name:<12}failed')
+                continue
+            print(f'{name:<12}{r.server_vendor:<18}{"hit" if r.server_cache_hit else "miss":>7}{r.config_ms:>13.1f}'
+                  f'{r.select_ms:>13.1f}{r.download_ms:>15.1f}{r.upload_ms:>13.1f}{r.download_mbps:>13.1f}'
+                  f'{r.upload_mbps:>11.1f}')
+    for server in (near, far):
+        server.stop()
+        print(f'{server.name}: {server.requests} requests, sent {server.bytes_sent} bytes, received '
+              f'{server.bytes_received} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import time
+
+from batch_writer import WriteStats
+from columns import Columns
+from instrumentation import AgentResources, Histogram, HistogramSnapshot, LATENCY_BUCKETS_MS
+from results import (CgroupStats, CPU_CORE_SCHEMA, CPUTestData, DISK_SCHEMA, DiskTestData, InternalTestData,
+                     MemoryTestData, NETWORK_IO_SCHEMA, NetworkIOData, ProcessStats, ProcessTestData,
+                     SchedulerTestData, SchedulerTickStats, SpeedTestData)
+from settings import Settings
+
+BENCH_SETTINGS = {
+    'influxdb': {'server': '127.0.0.1:8086', 'token': 'token', 'bucket': 'bucket', 'org': 'org'},
+    'network': {
+        'speedtest': {'measurement': 'net-speed', 'monitor_rate': '1h'},
+        'io': {'interfaces': ['lo', 'eth0'], 'measurement': 'net-updown', 'monitor_rate': '5s'},
+    },
+    'cpu_monitor': {'measurement': 'cpu-stats', 'monitor_rate': '5s'},
+    'memory_monitor': {'ram_measurement': 'ram-stats', 'swap_measurement': 'swap-stats', 'monitor_rate': '5s'},
+    'disk_monitor': {'directories': ['/', '/tmp'], 'measurement': 'disk-stats', 'monitor_rate': '5s'},
+    'process_monitor': {'measurement': 'process-stats', 'cgroup_measurement': 'cgroup-stats', 'monitor_rate': '10s'},
+}
+
+
+def load_bench_settings():
+    Settings.load_dict(BENCH_SETTINGS)
+
+
+def cpu_cores(cores: int = 128) -> Columns:
+    columns = Columns.allocate(CPU_CORE_SCHEMA, cores)
+    for core in range(cores):
+        columns.set(core, (core,), (core * 0.7 % 100, core * 0.5 % 100, 0.15, 0.05, 0.0, 0.0, 2400.0 + core))
+    return columns
+
+
+def cpu_result(cores: int = 128) -> CPUTestData:
+    return CPUTestData(
+        cores=cpu_cores(cores),
+        load_avg_1m_percent=12.5,
+        load_avg_5m_percent=10.25,
+        load_avg_15m_percent=8.0,
+        num_context_switches=123456789,
+        num_interrupts=98765432,
+        num_software_interrupts=1234567,
+        timestamp_ns=time.time_ns(),
+    )
+
+
+def memory_result() -> MemoryTestData:
+    return MemoryTestData(
+        ram_total_bytes=67108864000, ram_available_bytes=33554432000, ram_available_percent=50.0,
+        ram_used_bytes=30000000000, ram_free_bytes=20000000000, ram_active_bytes=15000000000,
+        ram_inactive_bytes=10000000000, ram_buffers_bytes=500000000, ram_cached_bytes=12000000000,
+        ram_shared_bytes=100000000, ram_slab_bytes=800000000, swap_total_bytes=8589934592,
+        swap_used_bytes=1000000, swap_free_bytes=8588934592, swap_used_percent=0.1, swap_in_total_bytes=4096,
+        swap_out_total_bytes=8192, timestamp_ns=time.time_ns(),
+    )
+
+
+def disk_result(disks: int = 8) -> DiskTestData:
+    columns = Columns.allocate(DISK_SCHEMA, disks)
+    for i in range(disks):
+        columns.set(i, (f'/mnt/disk{i}', f'/dev/nvme{i}n1'), (
+            1000204886016, 500000000000, 500204886016, 50.0, 1000000 + i, 2000000 + i, 50000000000, 80000000000,
+            400000, 900000, 1200000, 3000, 5000,
+        ))
+    return DiskTestData(disks=columns, timestamp_ns=time.time_ns())
+
+
+def network_result(interfaces: int = 4) -> NetworkIOData:
+    columns = Columns.allocate(NETWORK_IO_SCHEMA, interfaces)
+    for i in range(interfaces):
+        columns.set(i, (f'eth{i}',), (123456789012, 987654321098, 123456789, 987654321, 0, 0, 12, 0))
+    return NetworkIOData(interfaces=columns, timestamp_ns=time.time_ns())
+
+
+def speedtest_result() -> SpeedTestData:
+    return SpeedTestData(
+        download_mbps=512.123, upload_mbps=40.5, ping_ms=12.345, server_lat=51.5072, server_long=-0.1276,
+        server_city='London', server_country='United Kingdom', server_vendor='Example ISP', client_lat=51.5,
+        client_long=-0.12, server_cache_hit=True, config_ms=0.5, select_ms=45.2, download_ms=10012.5,
+        upload_ms=10034.1, timestamp_ns=time.time_ns(),
+    )
+
+
+def scheduler_result(monitors: int = 6) -> SchedulerTestData:
+    return SchedulerTestData(tick_stats=[
+        SchedulerTickStats(monitor=f'monitor-{i}', lateness_ms=0.25 * i, missed_deadlines=0, interval_s=1.0)
+        for i in range(monitors)
+    ], timestamp_ns=time.time_ns())
+
+
+def process_result(top_n: int = 10, cgroups: int = 20) -> ProcessTestData:
+    processes = [
+        ProcessStats(pid=1000 + i, name=f'worker-{i}', cmdline=f'/usr/bin/worker --id {i} --config /etc/worker.yaml',
+                     exe='/usr/bin/worker', cgroup=f'/system.slice/worker-{i % cgroups}.service',
+                     cpu_percent=99.5 - i, rss_bytes=(top_n - i) * 104857600, read_bytes_per_s=4096.0 * i,
+                     write_bytes_per_s=8192.0 * i)
+        for i in range(top_n)
+    ]
+    return ProcessTestData(
+        top_processes={'cpu': processes, 'rss': processes, 'io': processes[::-1]},
+        cgroup_stats=[
+            CgroupStats(cgroup=f'/system.slice/worker-{i}.service', num_processes=i + 1, cpu_percent=1.5 * i,
+                        rss_bytes=i * 52428800, read_bytes_per_s=1024.0 * i, write_bytes_per_s=2048.0 * i)
+            for i in range(cgroups)
+        ],
+        pids_total=20000, pids_scanned=20000, scan_cpu_ms=180.5, scan_truncated=False, timestamp_ns=time.time_ns(),
+    )
+
+
+def internal_result(monitors: int = 6) -> InternalTestData:
+    histograms = []
+    for i in range(monitors):
+        for stage in ('collect', 'serialize', 'lateness'):
+            h = Histogram(LATENCY_BUCKETS_MS)
+            for j in range(100):
+                h.observe(j * 0.05 * (i + 1))
+            histograms.append(HistogramSnapshot(stage=stage, monitor=f'monitor-{i}', bounds=h.bounds,
+                                                counts=tuple(h.counts), count=h.count, total=h.total, max=h.max))
+    return InternalTestData(
+        histograms=histograms,
+        resources=AgentResources(rss_bytes=67108864, cpu_percent=1.25, num_threads=8),
+        write_stats=WriteStats(points_queued=100000, points_written=99000, points_dropped=0, points_spooled=1000,
+                               points_replayed=1000, spool_depth=0, batches_written=20, write_errors=1, queue_depth=0),
+        timestamp_ns=time.time_ns(),
+    )
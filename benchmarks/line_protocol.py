@@ -0,0 +1,59 @@
+import argparse
+import time
+from typing import Callable
+
+from benchmarks.fixtures import cpu_result, disk_result, load_bench_settings, memory_result, network_result
+from line_protocol import LineProtocolEncoder, escape_key, escape_measurement, format_field
+from results import TestResult
+
+
+def naive_path(result: TestResult) -> int:
+    """
+    Formats every line from scratch, escaping each key and formatting each value, as a point object would
+    """
+    lines = []
+    for schema, tag_values, field_values in result.rows():
+        tags = b''.join(b',' + escape_key(k) + b'=' + escape_key(str(v))
+                        for k, v in sorted(zip(schema.tag_keys, tag_values)))
+        fields = b','.join(escape_key(k) + b'=' + format_field(v)
+                           for (k, _), v in zip(schema.fields, field_values) if v is not None)
+        lines.append(escape_measurement(schema.measurement) + tags + b' ' + fields + b' %d' % result.timestamp_ns)
+    return len(lines)
+
+
+def points_per_s(encode: Callable[[TestResult], int], result: TestResult, min_time_s: float) -> float:
+    points = 0
+    start_s = time.perf_counter()
+    while (elapsed_s := time.perf_counter() - start_s) < min_time_s:
+        points += encode(result)
+    return points / elapsed_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare formatting each line from scratch with the line protocol '
+                                                 'encoder')
+    parser.add_argument('--cores', type=int, default=128)
+    parser.add_argument('--min-time-s', type=float, default=1.0)
+    args = parser.parse_args()
+
+    load_bench_settings()
+    encoder = LineProtocolEncoder()
+
+    def encoder_path(result: TestResult) -> int:
+        return len(encoder.encode_rows(result.rows(), result.timestamp_ns))
+
+    results = {
+        'cpu': cpu_result(args.cores),
+        'memory': memory_result(),
+        'disk': disk_result(),
+        'network-io': network_result(),
+    }
+    print(f'{"result":<12}{"naive (points/s)":>20}{"encoder (points/s)":>22}{"speedup":>10}')
+    for name, result in results.items():
+        old = points_per_s(naive_path, result, args.min_time_s)
+        new = points_per_s(encoder_path, result, args.min_time_s)
+        print(f'{name:<12}{old:>20,.0f}{new:>22,.0f}{new / old:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import time
+from typing import Callable
+
+import psutil
+
+from benchmarks.fixtures import load_bench_settings
+from disk_monitor import DiskMonitor
+from memory_monitor import MemoryUsageMonitor
+from network_io_monitor import NetworkIOMonitor
+
+
+def ops_per_s(func: Callable, min_time_s: float) -> float:
+    ops = 0
+    start_s = time.perf_counter()
+    while (elapsed_s := time.perf_counter() - start_s) < min_time_s:
+        func()
+        ops += 1
+    return ops / elapsed_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the procfs readers with the psutil calls they replace')
+    parser.add_argument('--min-time-s', type=float, default=1.0)
+    args = parser.parse_args()
+
+    load_bench_settings()
+    memory = MemoryUsageMonitor('memory-monitor', '1s')
+    network = NetworkIOMonitor('network-io', '1s')
+    disk = DiskMonitor('disk-monitor', '1s')
+    devices = [p.device.rsplit('/', 1)[-1].encode() + b' ' for p in psutil.disk_partitions(all=False)]
+
+    def read_diskstats():
+        disk.diskstats.refresh()
+        for device in devices:
+            disk.diskstats.fields(device)
+
+    cases = {
+        'memory': (lambda: (psutil.virtual_memory(), psutil.swap_memory()), memory._measure),
+        'network-io': (lambda: psutil.net_io_counters(pernic=True), network._measure),
+        'diskstats': (lambda: psutil.disk_io_counters(perdisk=True, nowrap=True), read_diskstats),
+    }
+    print(f'{"collector":<12}{"psutil (ops/s)":>18}{"procfs (ops/s)":>18}{"speedup":>10}')
+    for name, (old, new) in cases.items():
+        old_ops = ops_per_s(old, args.min_time_s)
+        new_ops = ops_per_s(new, args.min_time_s)
+        print(f'{name:<12}{old_ops:>18,.0f}{new_ops:>18,.0f}{new_ops / old_ops:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import argparse
+import time
+from typing import Dict, Optional
+
+from line_protocol import LineProtocolEncoder
+from monitors import create_monitors
+from rates import RateDeriver
+from settings import Settings
+
+MONITORS = {
+    'cpu_monitor': {'measurement': 'cpu-stats', 'monitor_rate': '1h'},
+    'memory_monitor': {'ram_measurement': 'ram-stats', 'swap_measurement': 'swap-stats', 'monitor_rate': '1h'},
+    'disk_monitor': {'directories': ['/'], 'measurement': 'disk-stats', 'monitor_rate': '1h'},
+}
+# What a typical dashboard graphs: utilization, available memory, disk space and throughput
+DASHBOARD = {
+    'cpu-stats': {'include': ['utilization-percent', 'iowait-percent', 'context_switches']},
+    'ram-stats': {'include': ['ram_available_bytes', 'ram_available_percent']},
+    'swap-stats': {'include': []},
+    'disk-stats': {'include': ['read_bytes', 'write_bytes', 'busy_time_ms']},
+}
+PROFILES = {'all fields': None, 'dashboard': DASHBOARD}
+
+
+def run(fields: Optional[dict], samples: int) -> Dict[str, float]:
+    Settings.load_dict({'sinks': [{'type': 'file'}], **MONITORS, **({'fields': fields} if fields else {})})
+    monitors = list(create_monitors().values())
+    encoder = LineProtocolEncoder()
+    rates = RateDeriver('alongside')
+    collect_s = serialize_s = 0.0
+    points = body_bytes = 0
+    for _ in range(samples):
+        start_s = time.perf_counter()
+        results = [monitor.take_measurement()[1] for monitor in monitors]
+        collect_s += time.perf_counter() - start_s
+        start_s = time.perf_counter()
+        for result in results:
+            lines = encoder.encode_rows(rates.derive(result.rows(), result.monotonic_ns), result.timestamp_ns)
+            points += len(lines)
+            body_bytes += sum(len(line) for line in lines)
+        serialize_s += time.perf_counter() - start_s
+    return {'collect_us': collect_s / samples * 1e6, 'serialize_us': serialize_s / samples * 1e6,
+            'points': points / samples, 'bytes': body_bytes / samples}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare collecting and sending every field with a projection')
+    parser.add_argument('--samples', type=int, default=500)
+    args = parser.parse_args()
+
+    print(f'{"fields":<14}{"collect (us)":>14}{"serialize (us)":>16}{"points":>8}{"bytes":>8}')
+    for name, fields in PROFILES.items():
+        r = run(fields, args.samples)
+        print(f'{name:<14}{r["collect_us"]:>14,.1f}{r["serialize_us"]:>16,.1f}{r["points"]:>8,.1f}{r["bytes"]:>8,.0f}')
+
+
+if __name__ == '__main__':
+    main()
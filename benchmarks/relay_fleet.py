@@ -0,0 +1,93 @@
+import argparse
+import dataclasses
+import multiprocessing
+import os
+import tempfile
+import time
+
+from benchmarks.fake_influx import FakeInfluxDB
+from benchmarks.fixtures import BENCH_SETTINGS, cpu_result
+from settings import Settings
+
+TRANSPORTS = ('tcp', 'unix', 'udp')
+
+
+def agent(address: str, agent_id: int, batches: int, cores: int, retransmit_every: int):
+    from influx_db import InfluxDBConnection
+
+    Settings.load_dict({
+        **BENCH_SETTINGS,
+        'influxdb': {'spool_directory': None, 'flush_interval_ms': 100},
+        'relay': {'address': address},
+        # As if each agent ran on its own machine
+        'host': f'agent-{agent_id}',
+        # Rates would make a retransmitted line differ from the original
+        'rates': {'mode': 'off'},
+    })
+    conn = InfluxDBConnection()
+    conn.wait_for_good_connection()
+    conn.connect()
+    base = cpu_result(cores)
+    for i in range(batches):
+        result = dataclasses.replace(base, timestamp_ns=base.timestamp_ns + agent_id * batches + i)
+        conn.record_measurement(result)
+        if retransmit_every and i % retransmit_every == 0:
+            # As if the agent lost its connection after the relay read the batch, and sent it again
+            conn.relay.write(conn.encoder.encode_rows(result.rows(), result.timestamp_ns))
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run several agent processes through a relay to a fake InfluxDB')
+    parser.add_argument('--agents', type=int, default=6)
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--cores', type=int, default=16)
+    parser.add_argument('--retransmit-every', type=int, default=5)
+    args = parser.parse_args()
+
+    from influx_db import InfluxDBConnection
+    from relay import Relay
+
+    upstream = FakeInfluxDB(keep_series=True).start()
+    with tempfile.TemporaryDirectory() as directory:
+        listen = ['tcp://127.0.0.1:18094', f'unix://{os.path.join(directory, "relay.sock")}', 'udp://127.0.0.1:18094']
+        Settings.load_dict({
+            **BENCH_SETTINGS,
+            'influxdb': {**BENCH_SETTINGS['influxdb'], 'server': upstream.address, 'spool_directory': None},
+            'relay': {'listen': listen},
+        })
+        conn = InfluxDBConnection()
+        conn.connect()
+        relay = Relay(listen, conn.batch_writer.put, Settings.relay.dedup_window)
+        relay.start()
+
+        start_s = time.perf_counter()
+        agents = [
+            multiprocessing.Process(target=agent, args=(listen[i % len(listen)], i, args.batches, args.cores,
+                                                        args.retransmit_every))
+            for i in range(args.agents)
+        ]
+        for p in agents:
+            p.start()
+        for p in agents:
+            p.join()
+        # UDP datagrams may still be in the relay's socket buffer
+        time.sleep(0.2)
+        relay.close()
+        conn.close()
+        elapsed_s = time.perf_counter() - start_s
+
+    upstream.stop()
+    expected = args.agents * args.batches * (args.cores + 1)
+    print(f'{args.agents} agents sent {expected} unique lines in {elapsed_s:.2f}s')
+    print(f'Relay received {relay.lines_received} lines and dropped {relay.lines_duplicate} duplicates')
+    print(f'Upstream received {upstream.lines_received} lines ({upstream.lines_received / expected:.1%}) in '
+          f'{upstream.requests} requests, {upstream.bytes_received} bytes')
+    hosts = {tag.split(b'=', 1)[1] for series in upstream.series for tag in series.split(b',')[1:]
+             if tag.startswith(b'host=')}
+    print(f'Upstream received {len(upstream.series)} series from {len(hosts)} hosts, '
+          f'{len(upstream.series) // max(len(hosts), 1)} each')
+
+
+if __name__ == '__main__':
+    main()
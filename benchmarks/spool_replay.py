@@ -0,0 +1,65 @@
+import argparse
+import tempfile
+import time
+
+import requests
+
+from batch_writer import BatchWriter
+from benchmarks.fake_influx import FakeInfluxDB
+from spool import Spool
+
+
+def fill_spool(directory: str, num_points: int, segment_bytes: int):
+    spool = Spool(directory, segment_bytes=segment_bytes, max_bytes=1024 * 1024 * 1024)
+    now_ns = time.time_ns()
+    batch = []
+    for i in range(num_points):
+        batch.append(b'cpu-stats,core=%d utilization-percent=%d.5,freq-mhz=2400.0 %d' % (i % 64, i % 100, now_ns + i))
+        if len(batch) == 5000:
+            spool.append(batch)
+            batch = []
+    spool.append(batch)
+    spool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how fast a spool left behind by an outage is replayed')
+    parser.add_argument('--points', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--replay-points-per-s', type=float, default=1e9)
+    parser.add_argument('--segment-mb', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    server = FakeInfluxDB().start()
+    server.latency_s = args.latency_ms / 1000
+    session = requests.Session()
+
+    with tempfile.TemporaryDirectory() as directory:
+        fill_spool(directory, args.points, args.segment_mb * 1024 * 1024)
+
+        # A fresh Spool picks the segments up from disk, as it would after a restart
+        spool = Spool(directory)
+        writer = BatchWriter(
+            lambda batch: session.post(f'http://{server.address}/api/v2/write', data=b'\n'.join(batch),
+                                       params={'bucket': 'bucket', 'org': 'org', 'precision': 'ns'}).raise_for_status(),
+            batch_size=args.batch_size,
+            spool=spool,
+            health_check=lambda: requests.get(f'http://{server.address}/ping', timeout=1).status_code == 204,
+            replay_points_per_s=args.replay_points_per_s,
+        )
+        start_s = time.perf_counter()
+        writer.start()
+        while spool.pending_points:
+            time.sleep(0.01)
+        elapsed_s = time.perf_counter() - start_s
+        writer.close()
+
+    session.close()
+    server.stop()
+    print(f'Replayed {server.lines_received} points in {server.requests} requests over {elapsed_s:.3f}s '
+          f'({server.lines_received / elapsed_s:.0f} points/s)')
+
+
+if __name__ == '__main__':
+    main()
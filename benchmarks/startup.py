@@ -0,0 +1,125 @@
+import argparse
+import copy
+import json
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+
+from benchmarks.fake_speedtest import SPEEDTEST_CONFIG, FakeSpeedtestServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Every type of monitor, with the measurement its first sample shows up as
+MONITORS = {
+    'cpu': ({'measurement': 'cpu-stats'}, 'cpu-stats'),
+    'memory': ({'ram_measurement': 'ram-stats', 'swap_measurement': 'swap-stats'}, 'ram-stats'),
+    'disk': ({'directories': ['/'], 'measurement': 'disk-stats'}, 'disk-stats'),
+    'network_io': ({'interfaces': ['lo'], 'measurement': 'net-updown'}, 'net-updown'),
+    'process': ({'measurement': 'process-stats', 'cgroup_measurement': 'cgroup-stats'}, 'process-stats'),
+    'pressure': ({'measurement': 'pressure'}, 'pressure'),
+    'speedtest': ({'measurement': 'net-speed', 'download_bytes': 1000000, 'upload_bytes': 500000}, 'net-speed'),
+}
+PROFILES = {
+    'memory+disk': ['memory', 'disk'],
+    'cpu+memory': ['cpu', 'memory'],
+    'all': list(MONITORS),
+}
+
+
+def settings(monitor_types: List[str], directory: str) -> dict:
+    monitors = []
+    for monitor_type in monitor_types:
+        options, _ = MONITORS[monitor_type]
+        monitor = {'type': monitor_type, 'monitor_rate': '1h', **options}
+        if monitor_type == 'speedtest':
+            monitor['cache_path'] = os.path.join(directory, 'speedtest-cache.json')
+        monitors.append(monitor)
+    return {
+        'monitors': monitors,
+        'sinks': [{'type': 'file', 'path': '-'}],
+        'instrumentation': {'profile_signal': None},
+    }
+
+
+def rss_kib(pid: int) -> Dict[str, int]:
+    with open(f'/proc/{pid}/status') as f:
+        return {line.split(':')[0]: int(line.split()[1]) for line in f if line.startswith(('VmRSS', 'VmHWM'))}
+
+
+def start_agent(settings_path: str, expected: List[str], timeout_s: float) -> Tuple[Optional[float], Optional[float],
+                                                                                      Dict[str, int]]:
+    """
+    Returns the seconds until the agent's first sample, until every expected measurement had one, and its memory
+    """
+    start_s = time.perf_counter()
+    agent = subprocess.Popen([sys.executable, 'main.py', '--settings', settings_path], cwd=ROOT,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    first_s = all_s = None
+    missing = set(expected)
+    selector = selectors.DefaultSelector()
+    selector.register(agent.stdout, selectors.EVENT_READ)
+    pending = b''
+    try:
+        while missing and time.perf_counter() - start_s < timeout_s:
+            if not selector.select(timeout=0.1):
+                continue
+            # Read straight from the pipe, since select() can't see lines already sitting in a file object's buffer
+            chunk = os.read(agent.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            first_s = first_s or time.perf_counter() - start_s
+            *lines, pending = (pending + chunk).split(b'\n')
+            for line in lines:
+                missing.discard(line.split(b' ', 1)[0].split(b',', 1)[0].decode())
+        if not missing:
+            all_s = time.perf_counter() - start_s
+        memory = rss_kib(agent.pid)
+    finally:
+        agent.send_signal(signal.SIGINT)
+        try:
+            agent.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            agent.kill()
+    return first_s, all_s, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure time to first sample and memory of the agent')
+    parser.add_argument('--runs', type=int, default=3, help='agents started per profile, the fastest is kept')
+    parser.add_argument('--timeout-s', type=float, default=30)
+    args = parser.parse_args()
+
+    server = FakeSpeedtestServer('startup').start()
+    print(f'{"profile":<14}{"first sample (ms)":>19}{"all sampled (ms)":>18}{"RSS (MiB)":>11}{"peak RSS (MiB)":>16}')
+    try:
+        for profile, monitor_types in PROFILES.items():
+            results = []
+            for _ in range(args.runs):
+                with tempfile.TemporaryDirectory() as directory:
+                    # speedtest.net can't be relied on from here, so the speedtest runs against the stand-in
+                    with open(os.path.join(directory, 'speedtest-cache.json'), 'w') as f:
+                        now = time.time()
+                        json.dump({'config': [now, copy.deepcopy(SPEEDTEST_CONFIG)],
+                                   'servers': [now, [server.entry(1, 1.0)]]}, f)
+                    settings_path = os.path.join(directory, 'settings.yaml')
+                    with open(settings_path, 'w') as f:
+                        yaml.safe_dump(settings(monitor_types, directory), f)
+                    expected = [MONITORS[t][1] for t in monitor_types]
+                    results.append(start_agent(settings_path, expected, args.timeout_s))
+            first_s, all_s, memory = min(results, key=lambda r: r[1] or float('inf'))
+            first = f'{first_s * 1000:,.0f}' if first_s else 'none'
+            sampled = f'{all_s * 1000:,.0f}' if all_s else 'timed out'
+            print(f'{profile:<14}{first:>19}{sampled:>18}{memory["VmRSS"] / 1024:>11,.1f}'
+                  f'{memory["VmHWM"] / 1024:>16,.1f}')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import re
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from benchmarks.fake_influx import FakeInfluxDB
+from benchmarks.fixtures import (BENCH_SETTINGS, cpu_result, disk_result, internal_result, memory_result,
+                                 network_result, process_result, scheduler_result, speedtest_result)
+from settings import Settings
+
+WARMUP_ITERATIONS = 3
+# Metrics compared against a baseline, and whether a higher value is better. p99 is reported but is too sensitive
+# to scheduling noise on a shared machine to fail a run on
+METRICS = {'ops_per_s': True, 'p50_us': False, 'peak_alloc_bytes': False}
+# Allocation differences smaller than this are noise from the interpreter, not the code being measured
+MIN_ALLOC_REGRESSION_BYTES = 1024
+
+
+@dataclass
+class Benchmark:
+    name: str
+    func: Callable[[], Any]
+    # Called before the benchmark runs, e.g. to set up the fake server's faults
+    setup: Optional[Callable[[], Any]] = None
+    # Called after the timed iterations and counted in their elapsed time, e.g. to wait for queued writes
+    finish: Optional[Callable[[], Any]] = None
+    min_iterations: int = 20
+    alloc_iterations: int = 20
+
+
+def _timed_pass(bench: Benchmark, min_time_s: float) -> Tuple[List[int], int]:
+    timings = []
+    min_time_ns = int(min_time_s * 1e9)
+    start_ns = time.perf_counter_ns()
+    while len(timings) < bench.min_iterations or time.perf_counter_ns() - start_ns < min_time_ns:
+        call_ns = time.perf_counter_ns()
+        bench.func()
+        timings.append(time.perf_counter_ns() - call_ns)
+    if bench.finish is not None:
+        bench.finish()
+    elapsed_ns = time.perf_counter_ns() - start_ns
+    timings.sort()
+    return timings, elapsed_ns
+
+
+def run_benchmark(bench: Benchmark, min_time_s: float, repeat: int) -> Dict[str, float]:
+    if bench.setup is not None:
+        bench.setup()
+    for _ in range(WARMUP_ITERATIONS):
+        bench.func()
+    if bench.finish is not None:
+        bench.finish()
+
+    # The fastest of a few timed passes is the least disturbed by whatever else the machine was doing
+    timings, elapsed_ns = None, 0
+    for _ in range(repeat):
+        pass_timings, pass_elapsed_ns = _timed_pass(bench, min_time_s)
+        if timings is None or len(pass_timings) / pass_elapsed_ns > len(timings) / elapsed_ns:
+            timings, elapsed_ns = pass_timings, pass_elapsed_ns
+
+    # Allocations are traced in a separate pass since tracing slows every allocation down
+    gc.collect()
+    tracemalloc.start()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    peak_bytes = 0
+    for _ in range(bench.alloc_iterations):
+        current_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        bench.func()
+        peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1] - current_bytes)
+    if bench.finish is not None:
+        bench.finish()
+    retained_bytes = (tracemalloc.get_traced_memory()[0] - start_bytes) / bench.alloc_iterations
+    tracemalloc.stop()
+
+    return {
+        'iterations': len(timings),
+        'ops_per_s': round(len(timings) / (elapsed_ns / 1e9), 1),
+        'p50_us': round(timings[len(timings) // 2] / 1000, 2),
+        'p99_us': round(timings[min(int(len(timings) * 0.99), len(timings) - 1)] / 1000, 2),
+        'peak_alloc_bytes': peak_bytes,
+        'retained_bytes_per_op': round(retained_bytes, 1),
+    }
+
+
+def collector_benchmarks() -> List[Benchmark]:
+    from cpu_monitor import CPUMonitor
+    from disk_monitor import DiskMonitor
+    from memory_monitor import MemoryUsageMonitor
+    from network_io_monitor import NetworkIOMonitor
+    from process_monitor import ProcessMonitor
+
+    return [
+        Benchmark('measure.cpu', CPUMonitor('cpu-stat', '1s')._measure),
+        Benchmark('measure.memory', MemoryUsageMonitor('memory-monitor', '1s')._measure),
+        Benchmark('measure.disk', DiskMonitor('disk-monitor', '1s')._measure),
+        Benchmark('measure.network-io', NetworkIOMonitor('network-io', '1s')._measure),
+        Benchmark('measure.process', ProcessMonitor('process-monitor', '1s')._measure, alloc_iterations=5),
+    ]
+
+
+def serialization_benchmarks() -> List[Benchmark]:
+    from line_protocol import LineProtocolEncoder
+
+    encoder = LineProtocolEncoder()
+    results = {
+        'cpu': cpu_result(),
+        'memory': memory_result(),
+        'disk': disk_result(),
+        'network-io': network_result(),
+        'speedtest': speedtest_result(),
+        'scheduler': scheduler_result(),
+        'process': process_result(),
+        'internal': internal_result(),
+    }
+    benchmarks = []
+    for name, result in results.items():
+        benchmarks.append(Benchmark(
+            f'serialize.{name}',
+            lambda r=result: encoder.encode_rows(r.rows(), r.timestamp_ns),
+        ))
+    return benchmarks
+
+
+def write_benchmarks(server: FakeInfluxDB, client_timeout_ms: int) -> Tuple[List[Benchmark], Any]:
+    from influx_db import InfluxDBConnection
+
+    conn = InfluxDBConnection()
+    conn.connect()
+    batch = [
+        line
+        for result in (cpu_result(), memory_result(), disk_result(), network_result())
+        for line in conn.encoder.encode_rows(result.rows(), result.timestamp_ns)
+    ]
+
+    def write():
+        try:
+            conn._write(batch)
+        except Exception:
+            # Failed writes are part of what is being measured, e.g. how long a timeout holds up the writer
+            pass
+
+    def faults(latency_s: float = 0.0, error_rate: float = 0.0, stall_rate: float = 0.0):
+        def setup():
+            server.latency_s = latency_s
+            server.error_rate = error_rate
+            server.stall_rate = stall_rate
+            server.stall_s = client_timeout_ms / 1000 * 2
+        return setup
+
+    pipeline_result = cpu_result()
+
+    def drain():
+        while True:
+            stats = conn.batch_writer.stats
+            if stats.points_queued == stats.points_written + stats.points_dropped:
+                return
+            time.sleep(0.001)
+
+    return [
+        Benchmark('write.ok', write, setup=faults()),
+        Benchmark('write.latency-20ms', write, setup=faults(latency_s=0.02), alloc_iterations=5),
+        Benchmark('write.errors-20pct', write, setup=faults(error_rate=0.2), alloc_iterations=5),
+        Benchmark('write.timeouts-10pct', write, setup=faults(stall_rate=0.1), alloc_iterations=5),
+        Benchmark('write.pipeline', lambda: conn.record_measurement(pipeline_result, 'cpu-stat'),
+                  setup=faults(), finish=drain),
+    ], conn
+
+
+def compare(baseline: Dict[str, Dict[str, float]], current: Dict[str, Dict[str, float]],
+            threshold: float) -> List[str]:
+    regressions = []
+    for name, result in current.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if metric not in base or not base[metric]:
+                continue
+            change = (result[metric] - base[metric]) / base[metric]
+            if metric == 'peak_alloc_bytes' and result[metric] - base[metric] < MIN_ALLOC_REGRESSION_BYTES:
+                continue
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(f'{name} {metric} went from {base[metric]:,} to {result[metric]:,} '
+                                   f'({change:+.0%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the collectors, serialization and the write path')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name matches this regex')
+    parser.add_argument('--min-time-s', type=float, default=0.5, help='minimum time of each timed pass')
+    parser.add_argument('--repeat', type=int, default=3, help='timed passes per benchmark, the fastest is kept')
+    parser.add_argument('--client-timeout-ms', type=int, default=250)
+    parser.add_argument('--save', help='write the results to this JSON file, to use as a baseline')
+    parser.add_argument('--compare', help='fail if a result regressed past --threshold of this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed regression, as a fraction')
+    args = parser.parse_args()
+
+    server = FakeInfluxDB().start()
+    Settings.load_dict({
+        **BENCH_SETTINGS,
+        # A short read timeout so stalled writes fail instead of hanging
+        'influxdb': {**BENCH_SETTINGS['influxdb'], 'server': server.address, 'spool_directory': None,
+                     'read_timeout_s': args.client_timeout_ms / 1000},
+    })
+    benchmarks = collector_benchmarks() + serialization_benchmarks()
+    writes, conn = write_benchmarks(server, args.client_timeout_ms)
+    benchmarks += writes
+
+    results = {}
+    print(f'{"benchmark":<26}{"ops/s":>14}{"p50 (us)":>12}{"p99 (us)":>12}{"peak alloc (B)":>16}{"retained (B)":>14}')
+    for bench in benchmarks:
+        if not re.search(args.filter, bench.name):
+            continue
+        r = results[bench.name] = run_benchmark(bench, args.min_time_s, args.repeat)
+        print(f'{bench.name:<26}{r["ops_per_s"]:>14,.1f}{r["p50_us"]:>12,.2f}{r["p99_us"]:>12,.2f}'
+              f'{r["peak_alloc_bytes"]:>16,}{r["retained_bytes_per_op"]:>14,.1f}')
+    conn.batch_writer.close()
+    server.stop()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'results': results,
+            }, f, indent=2)
+        print(f'Saved results to {args.save}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline['results'], results, args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions past {args.threshold:.0%} of {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import hashlib
+import logging
+import math
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Set, Tuple
+
+from line_protocol import PointSchema, Row
+
+ON_EXCEEDED = ('warn', 'reject')
+# 4096 one byte registers, for a standard error of about 1.6%
+SKETCH_PRECISION = 12
+
+
+class SeriesSketch:
+    """
+    HyperLogLog estimate of how many distinct series have been added, in the same 2^precision bytes however many
+    there are
+    """
+
+    def __init__(self, precision: int = SKETCH_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, key: bytes):
+        h = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+        index = h >> (64 - self.precision)
+        rank = 64 - self.precision - (h & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate while most registers are still empty
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+
+@dataclass(frozen=True)
+class CardinalityStats:
+    series: int
+    series_estimate: int
+    tags_demoted: int
+    points_rejected: int
+
+
+class _Plan:
+    __slots__ = ('schema', 'measurement', 'kept', 'demoted', 'watched')
+
+    def __init__(self, schema: PointSchema, demoted: Dict[str, type]):
+        self.kept = [i for i, key in enumerate(schema.tag_keys) if key not in demoted]
+        self.demoted = [(i, demoted[key]) for i, key in enumerate(schema.tag_keys) if key in demoted]
+        self.schema = schema if not self.demoted else PointSchema(
+            schema._measurement,
+            [schema.tag_keys[i] for i in self.kept],
+            schema.fields + tuple((schema.tag_keys[i], t) for i, t in self.demoted),
+            schema.counters,
+        )
+        self.measurement = schema.measurement
+        # Tags whose distinct values are still being counted
+        self.watched = list(self.kept)
+
+
+def _demoted_value(value, t: type):
+    if value is None or value == '':
+        return None
+    try:
+        return t(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CardinalityGuard:
+    """
+    Keeps the number of series an agent writes in check. Tags a schema declares as high cardinality, tags listed in
+    `demote` and tags that have taken more than max_tag_values distinct values are written as fields instead, so they
+    no longer create series. The distinct series written are counted with a HyperLogLog sketch. Past series_budget a
+    warning is logged, or with on_exceeded set to reject, points of series that weren't written before are dropped.
+    """
+
+    def __init__(self, series_budget: int, on_exceeded: str, max_tag_values: int, demote: Dict[str, List[str]]):
+        if on_exceeded not in ON_EXCEEDED:
+            raise ValueError(f'Unknown cardinality on_exceeded {on_exceeded}, expected one of {ON_EXCEEDED}')
+        self.series_budget = series_budget
+        self.reject = on_exceeded == 'reject'
+        self.max_tag_values = max_tag_values
+        self.demote = demote
+        self._plans: Dict[PointSchema, _Plan] = {}
+        self._auto_demoted: Dict[PointSchema, Set[str]] = {}
+        self._tag_values: Dict[Tuple[PointSchema, int], Set] = {}
+        # Series written so far, never more than series_budget of them
+        self._admitted: Set[Tuple[PointSchema, Tuple]] = set()
+        self.sketch = SeriesSketch()
+        self.exceeded = False
+        self.points_rejected = 0
+
+    @property
+    def stats(self) -> CardinalityStats:
+        return CardinalityStats(
+            series=len(self._admitted),
+            series_estimate=self.sketch.estimate(),
+            tags_demoted=sum(len(plan.demoted) for plan in self._plans.values()),
+            points_rejected=self.points_rejected,
+        )
+
+    def _plan(self, schema: PointSchema) -> _Plan:
+        plan = self._plans.get(schema)
+        if plan is None:
+            demoted = {key: str for key in self.demote.get(schema.measurement, ())}
+            demoted.update((key, str) for key in self._auto_demoted.get(schema, ()))
+            demoted.update(schema.high_cardinality_tags)
+            plan = self._plans[schema] = _Plan(schema, demoted)
+        return plan
+
+    def _count_tag_values(self, schema: PointSchema, plan: _Plan, tag_values: Tuple) -> _Plan:
+        for i in plan.watched:
+            values = self._tag_values.get((schema, i))
+            if values is None:
+                values = self._tag_values[(schema, i)] = set()
+            values.add(tag_values[i])
+            if len(values) > self.max_tag_values:
+                key = schema.tag_keys[i]
+                logging.warning(f'Tag {key} of {plan.measurement} has taken more than {self.max_tag_values} values, '
+                                f'writing it as a field from now on')
+                self._auto_demoted.setdefault(schema, set()).add(key)
+                del self._tag_values[(schema, i)]
+                del self._plans[schema]
+                new_plan = self._plan(schema)
+                new_plan.watched = [j for j in plan.watched if j != i and j in new_plan.kept]
+                return new_plan
+        return plan
+
+    def _admit(self, plan: _Plan, tag_values: Tuple) -> bool:
+        series = (plan.schema, tag_values)
+        if series in self._admitted:
+            return True
+        self.sketch.add(repr((plan.measurement, plan.schema.tag_keys, tag_values)).encode())
+        if len(self._admitted) < self.series_budget:
+            self._admitted.add(series)
+            return True
+        if not self.exceeded:
+            self.exceeded = True
+            logging.warning(f'Over the budget of {self.series_budget} series with new series of {plan.measurement}, '
+                            f'{"dropping their points" if self.reject else "writing them anyway"}. Demote its '
+                            f'unbounded tags to fields in the cardinality settings, or raise series_budget')
+        if self.reject:
+            self.points_rejected += 1
+            return False
+        return True
+
+    def guard(self, rows: Iterable[Row]) -> List[Row]:
+        guarded = []
+        for schema, tag_values, field_values in rows:
+            plan = self._plan(schema)
+            if plan.watched and self.max_tag_values:
+                plan = self._count_tag_values(schema, plan, tag_values)
+            if plan.demoted:
+                field_values = field_values + tuple(_demoted_value(tag_values[i], t) for i, t in plan.demoted)
+                tag_values = tuple(tag_values[i] for i in plan.kept)
+            if self._admit(plan, tag_values):
+                guarded.append((plan.schema, tag_values, field_values))
+        return guarded
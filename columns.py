@@ -0,0 +1,59 @@
+from array import array
+from itertools import repeat
+from typing import List, Sequence, Tuple
+
+from line_protocol import PointSchema, Row
+from projection import Projections
+
+TYPECODES = {int: 'q', float: 'd'}
+
+
+class Columns:
+    """
+    Struct of arrays holding the points of one schema, e.g. one per core: the tag values of each point, and one
+    array.array (or NumPy array, or list for other types) per field indexed the same way. Collectors fill the
+    columns in place instead of building an object per core, device or interface, and rows() walks them with zip so
+    no Python code runs per point. Only the fields selected by the schema's projection are allocated and sent.
+    """
+    __slots__ = ('schema', 'tags', 'columns')
+
+    def __init__(self, schema: PointSchema, tags: List[Tuple], columns: List[Sequence]):
+        if len(columns) != len(schema.fields):
+            raise ValueError(f'{schema.measurement} has {len(schema.fields)} fields, got {len(columns)} columns')
+        self.schema = schema
+        self.tags = tags
+        self.columns = columns
+
+    @classmethod
+    def allocate(cls, schema: PointSchema, size: int) -> 'Columns':
+        selected = Projections.plan(schema).selected
+        # Fields that aren't selected are left None, since they are not collected
+        columns = [array(TYPECODES[t], bytes(8 * size)) if t in TYPECODES and key in selected else [None] * size
+                   for key, t in schema.fields]
+        return cls(schema, [()] * size, columns)
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def set(self, i: int, tag_values: Tuple, field_values: Sequence):
+        self.tags[i] = tag_values
+        for column, value in zip(self.columns, field_values):
+            column[i] = value
+
+    def truncate(self, size: int):
+        """
+        Drops the points from size on, e.g. for devices that turned out to be missing
+        """
+        del self.tags[size:]
+        for column in self.columns:
+            del column[size:]
+
+    def column(self, key: str) -> Sequence:
+        return self.columns[self.schema.field_keys.index(key)]
+
+    def rows(self) -> List[Row]:
+        plan = Projections.plan(self.schema)
+        columns = self.columns if plan.indices is None else [self.columns[i] for i in plan.indices]
+        # tolist() turns array and NumPy values into Python ints and floats in one go, as the encoder expects
+        columns = [column.tolist() if hasattr(column, 'tolist') else column for column in columns]
+        return list(zip(repeat(plan.schema), self.tags, zip(*columns)))
@@ -1,35 +1,105 @@
 import logging
-from typing import Optional, Tuple
+import os
+from array import array
+from typing import List, Optional, Tuple
 
+import numpy as np
 import psutil
 
-from influx_db import CPUCoreData, CPUTestData, TestResult
+from columns import Columns
 from monitored_stat import MonitoredStat
+from procfs import ProcFile
+from projection import Projections
+from results import CPU_CORE_SCHEMA, CPU_SCHEMA, CPUTestData, TestResult
+
+# Columns of the per-core lines in /proc/stat. Guest time is already counted in user time
+USER, NICE, SYSTEM, IDLE, IOWAIT, IRQ, SOFTIRQ, STEAL = range(8)
+
+
+def read_proc_stat(proc_stat: ProcFile) -> Tuple[np.ndarray, int, int, int]:
+    """
+    Returns the per-core jiffies as a (cores, columns) array, along with the context switch, interrupt and soft
+    interrupt counters
+    """
+    proc_stat.refresh()
+    lines = proc_stat.contents().split(b'\n')
+    num_cores = 0
+    while lines[num_cores + 1].startswith(b'cpu'):
+        num_cores += 1
+    core_fields = b' '.join(lines[1:num_cores + 1]).split()
+    jiffies = np.array(core_fields, dtype=np.bytes_).reshape(num_cores, -1)[:, 1:STEAL + 2].astype(np.int64)
+
+    ctx_switches = interrupts = soft_interrupts = 0
+    for line in lines[num_cores + 1:]:
+        if line.startswith(b'ctxt '):
+            ctx_switches = int(line[5:])
+        elif line.startswith(b'intr '):
+            interrupts = int(line[5:line.index(b' ', 5)])
+        elif line.startswith(b'softirq '):
+            soft_interrupts = int(line[8:line.index(b' ', 8)])
+    return jiffies, ctx_switches, interrupts, soft_interrupts
 
 
 class CPUMonitor(MonitoredStat):
+    schemas = (CPU_CORE_SCHEMA, CPU_SCHEMA)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Frequencies take a sysfs read per core, so they are only read when selected
+        self.reads_freq = Projections.plan(CPU_CORE_SCHEMA).wants('freq-mhz')
+        self.reads_load_avg = Projections.plan(CPU_SCHEMA).wants('load_avg_1m_percent', 'load_avg_5m_percent',
+                                                                 'load_avg_15m_percent')
+        self.proc_stat = ProcFile('/proc/stat')
+        # Utilization is computed from the jiffies elapsed since the previous sample, so prime it here
+        self.prev_jiffies, _, _, _ = read_proc_stat(self.proc_stat)
+        # Shared by every result, since the tags of a core never change
+        self.core_tags: List[Tuple[int]] = []
+
+    def _utilization_percents(self, jiffies: np.ndarray) -> np.ndarray:
+        """
+        Returns a (cores, 6) array of total, user, system, iowait, irq and steal utilization since the previous sample
+        """
+        if jiffies.shape != self.prev_jiffies.shape:
+            logging.warning(f'Number of CPU cores changed from {len(self.prev_jiffies)} to {len(jiffies)}')
+            self.prev_jiffies = np.zeros_like(jiffies)
+        delta = np.clip(jiffies - self.prev_jiffies, 0, None)
+        self.prev_jiffies = jiffies
+
+        total = delta.sum(axis=1)
+        busy = total - delta[:, IDLE] - delta[:, IOWAIT]
+        breakdown = np.stack([
+            busy,
+            delta[:, USER] + delta[:, NICE],
+            delta[:, SYSTEM],
+            delta[:, IOWAIT],
+            delta[:, IRQ] + delta[:, SOFTIRQ],
+            delta[:, STEAL],
+        ], axis=1)
+        return breakdown * (100.0 / np.maximum(total, 1))[:, None]
+
     def _measure(self) -> Tuple[bool, Optional[TestResult]]:
-        load_avg_1m_percent, load_avg_5m_percent, load_avg_15m_percent = [x / psutil.cpu_count() * 100 for x in
-                                                                          psutil.getloadavg()]
-        freq_mhzs = [current for current, _, _ in psutil.cpu_freq(True)]
-        utilization_percents = psutil.cpu_percent(0.5, True)
-        stats = psutil.cpu_stats()
-        core_data = []
-        for utilization_percent, freq_mhz in zip(utilization_percents, freq_mhzs):
-            core_data.append(
-                CPUCoreData(
-                    utilization_percent=utilization_percent,
-                    freq_mhz=freq_mhz
-                )
-            )
+        load_avg_1m_percent = load_avg_5m_percent = load_avg_15m_percent = None
+        if self.reads_load_avg:
+            num_cpus = os.cpu_count()
+            load_avg_1m_percent, load_avg_5m_percent, load_avg_15m_percent = [x / num_cpus * 100 for x in
+                                                                              os.getloadavg()]
+        jiffies, ctx_switches, interrupts, soft_interrupts = read_proc_stat(self.proc_stat)
+        percents = self._utilization_percents(jiffies).round(2)
+        num_cores = len(percents)
+        if len(self.core_tags) != num_cores:
+            self.core_tags = [(core,) for core in range(num_cores)]
+        freqs = psutil.cpu_freq(True) if self.reads_freq else []
+        freq_mhzs = array('d', [current for current, _, _ in freqs]) if len(freqs) == num_cores else [None] * num_cores
+        # The utilization columns are rows of the transposed array, the order of CPU_CORE_SCHEMA's fields
+        cores = Columns(CPU_CORE_SCHEMA, self.core_tags, [*percents.T, freq_mhzs])
         test_data = CPUTestData(
-            cpu_core_data=core_data,
+            cores=cores,
             load_avg_1m_percent=load_avg_1m_percent,
             load_avg_5m_percent=load_avg_5m_percent,
             load_avg_15m_percent=load_avg_15m_percent,
-            num_interrupts=stats.interrupts,
-            num_context_switches=stats.ctx_switches,
-            num_software_interrupts=stats.soft_interrupts,
+            num_interrupts=interrupts,
+            num_context_switches=ctx_switches,
+            num_software_interrupts=soft_interrupts,
         )
         logging.debug(test_data)
         return True, test_data
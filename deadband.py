@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from line_protocol import PointSchema, Row, format_field
+
+# Rough size of the measurement, tag set and timestamp of a line that is not sent at all
+LINE_OVERHEAD_BYTES = 40
+
+
+class Deadband(NamedTuple):
+    absolute: float = 0.0
+    percent: float = 0.0
+
+
+@dataclass(frozen=True)
+class DeadbandStats:
+    fields_sent: int
+    fields_suppressed: int
+    points_suppressed: int
+    bytes_saved: int
+
+
+class _SeriesState:
+    __slots__ = ('last_sent', 'intervals_since_heartbeat')
+
+    def __init__(self, num_fields: int):
+        self.last_sent: List = [None] * num_fields
+        self.intervals_since_heartbeat = 0
+
+
+class DeadbandFilter:
+    """
+    Drops fields whose value is unchanged since it was last sent, or within that field's absolute or percent
+    deadband of it, by replacing them with None. Every heartbeat_intervals points of a series, all of its fields are
+    sent regardless so dashboards always have a recent value.
+    """
+
+    def __init__(self, heartbeat_intervals: int, deadbands: Dict[str, Dict[str, Deadband]]):
+        self.heartbeat_intervals = heartbeat_intervals
+        self.deadbands = deadbands
+        self._schemas: Dict[PointSchema, Tuple[Deadband, ...]] = {}
+        self._series: Dict[Tuple[PointSchema, Tuple], _SeriesState] = {}
+        self.fields_sent = 0
+        self.fields_suppressed = 0
+        self.points_suppressed = 0
+        self.bytes_saved = 0
+
+    @property
+    def stats(self) -> DeadbandStats:
+        return DeadbandStats(
+            fields_sent=self.fields_sent,
+            fields_suppressed=self.fields_suppressed,
+            points_suppressed=self.points_suppressed,
+            bytes_saved=self.bytes_saved,
+        )
+
+    def _field_deadbands(self, schema: PointSchema) -> Tuple[Deadband, ...]:
+        field_deadbands = self._schemas.get(schema)
+        if field_deadbands is None:
+            configured = self.deadbands.get(schema.measurement, {})
+            field_deadbands = self._schemas[schema] = tuple(configured.get(key, Deadband()) for key in schema.field_keys)
+        return field_deadbands
+
+    @staticmethod
+    def _changed(deadband: Deadband, last, value) -> bool:
+        if last is None or isinstance(value, (str, bool)):
+            return value != last
+        delta = abs(value - last)
+        if delta <= deadband.absolute:
+            return False
+        return not (deadband.percent and last and delta / abs(last) * 100 <= deadband.percent)
+
+    def filter(self, rows: Iterable[Row]) -> List[Row]:
+        filtered = []
+        for schema, tag_values, field_values in rows:
+            state = self._series.get((schema, tag_values))
+            if state is None:
+                state = self._series[(schema, tag_values)] = _SeriesState(len(field_values))
+            heartbeat = state.intervals_since_heartbeat == 0
+            state.intervals_since_heartbeat = (state.intervals_since_heartbeat + 1) % self.heartbeat_intervals
+
+            sent = list(field_values)
+            suppressed = 0
+            for i, (deadband, value) in enumerate(zip(self._field_deadbands(schema), field_values)):
+                if value is None:
+                    continue
+                if heartbeat or self._changed(deadband, state.last_sent[i], value):
+                    state.last_sent[i] = value
+                    self.fields_sent += 1
+                else:
+                    sent[i] = None
+                    suppressed += 1
+                    self.bytes_saved += len(schema.fields[i][0]) + len(format_field(value)) + 2
+
+            self.fields_suppressed += suppressed
+            if suppressed and all(v is None for v in sent):
+                self.points_suppressed += 1
+                self.bytes_saved += LINE_OVERHEAD_BYTES
+                continue
+            filtered.append((schema, tag_values, tuple(sent)))
+        return filtered
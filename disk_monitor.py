@@ -1,56 +1,69 @@
 import logging
-from os.path import basename, dirname, exists, ismount
+import os
 from typing import Optional, Tuple
 
 import psutil
 
-from influx_db import DiskIOStats, DiskTestData, TestResult
+from columns import Columns
 from monitored_stat import MonitoredStat
+from mount_index import MountIndex
+from procfs import ProcFile
+from projection import Projections
+from results import DISK_SCHEMA, DiskTestData, TestResult
 from settings import Settings
 
-
-def get_mount_point_from_directory(d: str):
-    mount_point = d
-    while not ismount(mount_point):
-        mount_point = dirname(mount_point)
-    return mount_point
+SECTOR_SIZE = 512
+SPACE_FIELDS = ('total_bytes', 'used_bytes', 'free_bytes', 'percent_used')
 
 
 class DiskMonitor(MonitoredStat):
+    schemas = (DISK_SCHEMA,)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.diskstats = ProcFile('/proc/diskstats')
+        self.mounts = MountIndex(Settings.disk_monitor.directories)
+        # A statvfs per directory for the space fields, and /proc/diskstats for the rest
+        projection = Projections.plan(DISK_SCHEMA)
+        self.reads_usage = projection.wants(*SPACE_FIELDS)
+        self.reads_diskstats = projection.wants(*(key for key in DISK_SCHEMA.field_keys if key not in SPACE_FIELDS))
+
     def _measure(self) -> Tuple[bool, Optional[TestResult]]:
-        disk_stats = []
-        parts = psutil.disk_partitions(all=False)
-        disk_io = psutil.disk_io_counters(perdisk=True, nowrap=True)
-        for d in Settings.disk_monitor.directories:
-            if not exists(d):
+        if self.reads_diskstats:
+            self.diskstats.refresh()
+        mounts = self.mounts.lookup()
+        disks = Columns.allocate(DISK_SCHEMA, len(mounts))
+        num_disks = 0
+        for d, mount in list(mounts.items()):
+            if not self.reads_usage and not os.path.exists(d):
+                # Otherwise the stats of its old device would be reported under it
                 logging.warning(f'Could not find directory {d}. SKIPPING')
+                self.mounts.forget(d)
                 continue
-            mount_point = get_mount_point_from_directory(d)
-            for device in parts:
-                if device.mountpoint == mount_point:
-                    disk_util = disk_io[basename(device.device)]
+            io = (None,) * 9
+            if self.reads_diskstats:
+                disk_util = self.diskstats.fields(mount.kernel_name.encode() + b' ')
+                if disk_util is None:
+                    logging.warning(f'Could not find {mount.kernel_name} ({mount.device}) in /proc/diskstats. '
+                                    f'SKIPPING')
+                    continue
+                reads, reads_merged, read_sectors, read_time, writes, writes_merged, write_sectors, write_time, \
+                    _, busy_time = map(int, disk_util[:10])
+                io = (reads, writes, read_sectors * SECTOR_SIZE, write_sectors * SECTOR_SIZE, read_time, write_time,
+                      busy_time, reads_merged, writes_merged)
+            space = (None,) * 4
+            if self.reads_usage:
+                try:
                     disk_usage = psutil.disk_usage(d)
-                    disk_stats.append(
-                        DiskIOStats(
-                            device=device.device,
-                            directory=d,
-                            total_bytes=disk_usage.total,
-                            used_bytes=disk_usage.used,
-                            free_bytes=disk_usage.free,
-                            percent_used=disk_usage.percent,
-                            read_count=disk_util.read_count,
-                            write_count=disk_util.write_count,
-                            read_bytes=disk_util.read_bytes,
-                            write_bytes=disk_util.write_bytes,
-                            read_time_ms=disk_util.read_time,
-                            write_time_ms=disk_util.write_time,
-                            busy_time_ms=disk_util.busy_time,
-                            read_merged_count=disk_util.read_merged_count,
-                            write_merged_count=disk_util.write_merged_count,
-                        )
-                    )
-                    break
+                except OSError as e:
+                    logging.warning(f'Could not read disk usage of {d}: {e}. SKIPPING')
+                    self.mounts.forget(d)
+                    continue
+                space = (disk_usage.total, disk_usage.used, disk_usage.free, disk_usage.percent)
+            disks.set(num_disks, (d, mount.device), space + io)
+            num_disks += 1
+        disks.truncate(num_disks)
         result = DiskTestData(
-            disk_stats=disk_stats,
+            disks=disks,
         )
         return True, result
@@ -0,0 +1,104 @@
+import logging
+import math
+import queue
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from instrumentation import Instruments
+from monitored_stat import MonitoredStat
+from results import TestResult
+
+
+# Compared by identity, since runs of the same monitor can have equal fields
+@dataclass(eq=False)
+class MeasurementRun:
+    monitor: MonitoredStat
+    started_s: float
+    deadline_s: float
+    success: bool = False
+    result: Optional[TestResult] = None
+    timed_out: bool = False
+
+
+class MeasurementExecutor:
+    """
+    Runs each measurement on its own daemon thread so a slow or hung collector cannot hold up the others.
+    Runs that outlive their monitor's timeout are abandoned and reported as failures; the thread is left to
+    finish (or hang) in the background, but still counts against the monitor's overlapping run cap.
+    """
+
+    def __init__(self):
+        self._completed: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._running: Dict[str, int] = defaultdict(int)
+        self._pending: List[MeasurementRun] = []
+
+    def running(self, monitor: MonitoredStat) -> int:
+        with self._lock:
+            return self._running[monitor.name]
+
+    def submit(self, monitor: MonitoredStat) -> bool:
+        with self._lock:
+            if self._running[monitor.name] >= monitor.max_overlapping_runs:
+                return False
+            self._running[monitor.name] += 1
+        now = time.monotonic()
+        run = MeasurementRun(monitor=monitor, started_s=now, deadline_s=now + monitor.timeout_s)
+        self._pending.append(run)
+        threading.Thread(target=self._run, args=(run,), name=f'{monitor.name}-measurement', daemon=True).start()
+        return True
+
+    def _run(self, run: MeasurementRun):
+        try:
+            with Instruments.profiled():
+                success, result = run.monitor.take_measurement()
+        except Exception:
+            logging.exception(f'Unhandled error while taking {run.monitor.name} measurement')
+            success, result = False, None
+        finally:
+            with self._lock:
+                self._running[run.monitor.name] -= 1
+        run.success, run.result = success, result
+        self._completed.put(run)
+
+    def report(self, monitor: MonitoredStat, result: TestResult):
+        """
+        Hands wait() a result taken outside of the executor, e.g. by a monitor woken up by the kernel
+        """
+        now = time.monotonic()
+        self._completed.put(MeasurementRun(monitor=monitor, started_s=now, deadline_s=now, success=True,
+                                           result=result))
+
+    def _next_deadline_s(self) -> float:
+        return min((run.deadline_s for run in self._pending), default=math.inf)
+
+    def wait(self, timeout_s: float) -> List[MeasurementRun]:
+        """
+        Blocks for up to timeout_s until at least one run finishes or times out, and returns every run that has.
+        """
+        finished = []
+        block_s = max(min(timeout_s, self._next_deadline_s() - time.monotonic()), 0)
+        try:
+            finished.append(self._completed.get(timeout=block_s))
+            while True:
+                finished.append(self._completed.get_nowait())
+        except queue.Empty:
+            pass
+
+        # Runs that finish after being abandoned were already reported as timed out
+        finished = [run for run in finished if not run.timed_out]
+        for run in finished:
+            # Reported runs were never pending
+            if run in self._pending:
+                self._pending.remove(run)
+
+        now = time.monotonic()
+        for run in [run for run in self._pending if run.deadline_s <= now]:
+            self._pending.remove(run)
+            run.timed_out = True
+            run.success, run.result = False, None
+            finished.append(run)
+        return finished
@@ -0,0 +1,234 @@
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+from line_protocol import PointSchema
+from sinks import Sink
+
+if TYPE_CHECKING:
+    from results import TestResult
+
+MAGIC = b'SYSRING1'
+# magic, header size, record size, capacity, records written
+HEADER = struct.Struct('<8sIIQQ')
+WRITTEN_OFFSET = 24
+HEADER_BYTES = 4096
+# Tag values are stored inline, truncated to this many bytes, so every record has the same width
+TAG_BYTES = 24
+# Stands in for a missing int field, NaN does for float fields
+MISSING_INT = -(1 << 63)
+MAX_CACHED_TAG_SETS = 10000
+RING_SUFFIX = '.ring'
+
+
+def _layout(schema: PointSchema) -> dict:
+    return {
+        'measurement': schema.measurement,
+        'tags': list(schema.tag_keys),
+        # Ints are kept exact so counters don't lose precision, everything else numeric is a double
+        'fields': [[key, 'q' if t is int else 'd'] for key, t in schema.fields if t in (int, float, bool)],
+        'counters': [c[0] for c in schema.counters],
+    }
+
+
+def _record_struct(layout: dict) -> struct.Struct:
+    return struct.Struct('<q' + f'{TAG_BYTES}s' * len(layout['tags']) + ''.join(f for _, f in layout['fields']))
+
+
+class HistoryRing:
+    """
+    Fixed size, memory-mapped ring of the most recent points of one schema. Each record is the timestamp, the tag
+    values and the numeric fields packed at a fixed width, so appending is one struct.pack_into into the map and
+    the file never grows. Once full, the oldest record is overwritten. The kernel writes the pages back, so the
+    history survives the agent being killed, though not necessarily the machine losing power.
+    """
+
+    def __init__(self, path: str, schema: PointSchema, max_bytes: int):
+        self.path = path
+        self.layout = _layout(schema)
+        self.record = _record_struct(self.layout)
+        self.field_indices = [i for i, (_, t) in enumerate(schema.fields) if t in (int, float, bool)]
+        self.int_fields = {i for i, (_, t) in enumerate(schema.fields) if t is int}
+        self.capacity = max(1, (max_bytes - HEADER_BYTES) // self.record.size)
+        self.tag_sets: Dict[Tuple, List[bytes]] = {}
+
+        layout_json = json.dumps(self.layout).encode()
+        if 4 + len(layout_json) > HEADER_BYTES - HEADER.size:
+            raise ValueError(f'{schema.measurement} has too many fields to keep history of')
+        size = HEADER_BYTES + self.capacity * self.record.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.pread(fd, HEADER_BYTES, 0)
+            self.written = self._resume(existing, layout_json) if os.fstat(fd).st_size == size else None
+            if self.written is None:
+                if existing:
+                    logging.info(f'{path} was written with a different layout or size, starting a new history')
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                header = HEADER.pack(MAGIC, HEADER_BYTES, self.record.size, self.capacity, 0)
+                os.pwrite(fd, header + struct.pack('<I', len(layout_json)) + layout_json, 0)
+                self.written = 0
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _resume(self, header: bytes, layout_json: bytes) -> Optional[int]:
+        if len(header) < HEADER.size + 4:
+            return None
+        magic, header_bytes, record_size, capacity, written = HEADER.unpack_from(header)
+        (layout_size,) = struct.unpack_from('<I', header, HEADER.size)
+        stored_layout = header[HEADER.size + 4:HEADER.size + 4 + layout_size]
+        if (magic, header_bytes, record_size, capacity, stored_layout) != \
+                (MAGIC, HEADER_BYTES, self.record.size, self.capacity, layout_json):
+            return None
+        return written
+
+    def _tag_set(self, tag_values: Tuple) -> List[bytes]:
+        tag_set = self.tag_sets.get(tag_values)
+        if tag_set is None:
+            if len(self.tag_sets) >= MAX_CACHED_TAG_SETS:
+                self.tag_sets.clear()
+            tag_set = self.tag_sets[tag_values] = [
+                ('' if v is None else str(v)).encode()[:TAG_BYTES] for v in tag_values
+            ]
+        return tag_set
+
+    def append(self, timestamp_ns: int, tag_values: Tuple, field_values: Tuple):
+        fields = []
+        for i in self.field_indices:
+            value = field_values[i]
+            if value is None:
+                value = MISSING_INT if i in self.int_fields else math.nan
+            fields.append(value)
+        offset = HEADER_BYTES + (self.written % self.capacity) * self.record.size
+        self.record.pack_into(self.map, offset, timestamp_ns, *self._tag_set(tag_values), *fields)
+        # Only counted once the record is complete, so readers never take a half written one as the newest
+        self.written += 1
+        struct.pack_into('<Q', self.map, WRITTEN_OFFSET, self.written)
+
+    def close(self):
+        self.map.close()
+
+
+class HistorySink(Sink):
+    """
+    Keeps the recent points of every schema in a HistoryRing, so what the agent measured can be looked at with
+    `python main.py history` even while InfluxDB can't be reached
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rings: Dict[PointSchema, HistoryRing] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _ring(self, schema: PointSchema) -> HistoryRing:
+        ring = self.rings.get(schema)
+        if ring is None:
+            layout_json = json.dumps(_layout(schema)).encode()
+            name = f'{re.sub(r"[^a-zA-Z0-9_.-]", "_", schema.measurement)}-{zlib.crc32(layout_json):08x}'
+            ring = self.rings[schema] = HistoryRing(os.path.join(self.directory, name + RING_SUFFIX), schema,
+                                                   self.max_bytes)
+        return ring
+
+    def record_measurement(self, data: 'TestResult', monitor: str = ''):
+        timestamp_ns = data.timestamp_ns or time.time_ns()
+        for schema, tag_values, field_values in data.rows():
+            self._ring(schema).append(timestamp_ns, tag_values, field_values)
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+
+
+def read_ring(path: str, since_ns: int = 0) -> Tuple[dict, List[Tuple]]:
+    """
+    Returns the layout of a ring file and its records newer than since_ns, oldest first. Records are unpacked
+    straight out of the map without copying the file.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        magic, header_bytes, record_size, capacity, written = HEADER.unpack_from(m)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a history ring')
+        (layout_size,) = struct.unpack_from('<I', m, HEADER.size)
+        layout = json.loads(bytes(m[HEADER.size + 4:HEADER.size + 4 + layout_size]))
+        record = _record_struct(layout)
+        view = memoryview(m)
+        try:
+            records = view[header_bytes:header_bytes + capacity * record_size]
+            if written <= capacity:
+                chunks = [records[:written * record_size]]
+            else:
+                # The oldest slot is skipped since the agent may be overwriting it right now
+                start = (written % capacity + 1) * record_size
+                chunks = [records[start:], records[:start - record_size]]
+            rows = [r for chunk in chunks for r in record.iter_unpack(chunk) if r[0] >= since_ns]
+            for chunk in chunks:
+                chunk.release()
+            records.release()
+        finally:
+            view.release()
+    return layout, rows
+
+
+def _field_value(value) -> Optional[float]:
+    if value == MISSING_INT or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value
+
+
+def summarize(layout: dict, rows: List[Tuple]) -> Iterator[Tuple[str, str, int, Optional[float], Optional[float],
+                                                                   Optional[float]]]:
+    """
+    Yields (series, field, samples, mean, max, per-second rate) for every field of every series. The rate is only
+    given for counters, and skips over resets.
+    """
+    num_tags = len(layout['tags'])
+    counters = set(layout['counters'])
+    series: Dict[Tuple, List[Tuple]] = {}
+    for row in rows:
+        series.setdefault(row[1:1 + num_tags], []).append(row)
+    for tag_values, series_rows in series.items():
+        name = ','.join(f'{key}={value.rstrip(bytes(1)).decode(errors="replace")}'
+                        for key, value in zip(layout['tags'], tag_values) if value.rstrip(bytes(1)))
+        for i, (field, _) in enumerate(layout['fields'], start=1 + num_tags):
+            points = [(row[0], _field_value(row[i])) for row in series_rows]
+            points = [(ts, v) for ts, v in points if v is not None]
+            if not points:
+                continue
+            values = [v for _, v in points]
+            rate = None
+            if field in counters and len(points) > 1:
+                increase = sum(cur - prev for (_, prev), (_, cur) in zip(points, points[1:]) if cur >= prev)
+                rate = increase / ((points[-1][0] - points[0][0]) / 1e9) if points[-1][0] > points[0][0] else None
+            yield name, field, len(values), sum(values) / len(values), max(values), rate
+
+
+def print_history(directory: str, minutes: float, measurement: Optional[str] = None, raw: bool = False):
+    since_ns = time.time_ns() - int(minutes * 60e9)
+    paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(RING_SUFFIX))
+    for path in paths:
+        layout, rows = read_ring(path, since_ns)
+        if measurement is not None and layout['measurement'] != measurement:
+            continue
+        tags = ','.join(layout['tags'])
+        print(f'{layout["measurement"]}{f" ({tags})" if tags else ""}: {len(rows)} samples in the last {minutes:g}m')
+        if raw:
+            keys = ['time'] + layout['tags'] + [key for key, _ in layout['fields']]
+            print('  ' + ' '.join(keys))
+            for row in rows:
+                values = [time.strftime('%H:%M:%S', time.localtime(row[0] / 1e9))]
+                values += [v.rstrip(bytes(1)).decode(errors='replace') if isinstance(v, bytes) else
+                           str(_field_value(v)) for v in row[1:]]
+                print('  ' + ' '.join(values))
+            continue
+        for series, field, samples, mean, maximum, rate in summarize(layout, rows):
+            rate_text = f'  rate={rate:.6g}/s' if rate is not None else ''
+            print(f'  {series + " " if series else ""}{field}: mean={mean:.6g} max={maximum:.6g}{rate_text}')
@@ -1,236 +1,112 @@
+import gzip
 import logging
 import time
-from dataclasses import dataclass
-from typing import Iterable, Optional
+from typing import TYPE_CHECKING, List, Optional
 
 import requests
-from influxdb_client import InfluxDBClient, WriteApi
-from influxdb_client.client.write_api import Point, SYNCHRONOUS
-
+from requests.adapters import HTTPAdapter
+
+from batch_writer import BatchWriter, backoff_delay_s
+from cardinality import CardinalityGuard
+from deadband import Deadband, DeadbandFilter
+from instrumentation import Instruments, SIZE_BUCKETS_BYTES
+from line_protocol import LineProtocolEncoder
+from rates import RateDeriver
+from results import TestResult
 from settings import Settings
+from sinks import Sink
+from spool import Spool
 
-
-@dataclass(frozen=True)
-class TestResult:
-    def to_points(self) -> Iterable[Point]:
-        raise NotImplementedError("All test data must implement to_point()")
-
-
-@dataclass(frozen=True)
-class MemoryTestData(TestResult):
-    ram_total_bytes: int
-    ram_available_bytes: int
-    ram_available_percent: float
-    ram_used_bytes: int
-    ram_free_bytes: int
-    ram_active_bytes: int
-    ram_inactive_bytes: int
-    ram_buffers_bytes: int
-    ram_cached_bytes: int
-    ram_shared_bytes: int
-    ram_slab_bytes: int
-    swap_total_bytes: int
-    swap_used_bytes: int
-    swap_free_bytes: int
-    swap_used_percent: float
-    swap_in_total_bytes: int
-    swap_out_total_bytes: int
-
-    def to_points(self) -> Iterable[Point]:
-        # TODO: don't send alllll of these to db. Choose better. Config?
-        p = []
-        memp = Point(Settings.memory_monitor.ram_measurement)
-        memp.field('ram_total_bytes', self.ram_total_bytes)
-        memp.field('ram_available_bytes', self.ram_available_bytes)
-        memp.field('ram_available_percent', self.ram_available_percent)
-        memp.field('ram_used_bytes', self.ram_used_bytes)
-        memp.field('ram_free_bytes', self.ram_free_bytes)
-        memp.field('ram_active_bytes', self.ram_active_bytes)
-        memp.field('ram_inactive_bytes', self.ram_inactive_bytes)
-        memp.field('ram_buffers_bytes', self.ram_buffers_bytes)
-        memp.field('ram_cached_bytes', self.ram_cached_bytes)
-        memp.field('ram_shared_bytes', self.ram_shared_bytes)
-        memp.field('ram_slab_bytes', self.ram_slab_bytes)
-        p.append(memp)
-        if self.swap_total_bytes != 0:
-            swapp = Point(Settings.memory_monitor.swap_measurement)
-            swapp.field('swap_total_bytes', self.swap_total_bytes)
-            swapp.field('swap_used_bytes', self.swap_used_bytes)
-            swapp.field('swap_free_bytes', self.swap_free_bytes)
-            swapp.field('swap_used_percent', self.swap_used_percent)
-            swapp.field('swap_in_total_bytes', self.swap_in_total_bytes)
-            swapp.field('swap_out_total_bytes', self.swap_out_total_bytes)
-            p.append(swapp)
-        return p
-
-
-@dataclass(frozen=True)
-class CPUCoreData:
-    utilization_percent: float
-    freq_mhz: float
-
-
-@dataclass(frozen=True)
-class CPUTestData(TestResult):
-    cpu_core_data: Iterable[CPUCoreData]
-    load_avg_1m_percent: float
-    load_avg_5m_percent: float
-    load_avg_15m_percent: float
-    num_context_switches: int
-    num_interrupts: int
-    num_software_interrupts: int
-
-    def to_points(self) -> Iterable[Point]:
-        points = []
-        for core, core_data in enumerate(self.cpu_core_data):
-            p = Point(Settings.cpu_monitor.measurement)
-            p.tag('core', int(core))
-            p.field('utilization-percent', core_data.utilization_percent)
-            p.field('freq-mhz', core_data.freq_mhz)
-            points.append(p)
-        p = Point(Settings.cpu_monitor.measurement)
-        p.field('context_switches', self.num_context_switches)
-        p.field('interrupts', self.num_interrupts)
-        p.field('software_interrupts', self.num_software_interrupts)
-        p.field('load_avg_1m_percent', self.load_avg_1m_percent)
-        p.field('load_avg_5m_percent', self.load_avg_5m_percent)
-        p.field('load_avg_15m_percent', self.load_avg_15m_percent)
-        points.append(p)
-        return points
-
-
-@dataclass(frozen=True)
-class SpeedTestData(TestResult):
-    download_mbps: float
-    upload_mbps: float
-    ping_ms: float
-    server_lat: float
-    server_long: float
-    server_city: str
-    server_country: str
-    server_vendor: str
-    client_lat: float
-    client_long: float
-
-    def to_points(self) -> Iterable[Point]:
-        p = Point(Settings.network_speed_test.measurement)
-        p.tag("server_city", self.server_city)
-        p.tag("server_country", self.server_country)
-        p.tag("server_vendor", self.server_vendor)
-        p.tag("server_lat", self.server_lat)
-        p.tag("server_long", self.server_long)
-        p.tag("client_lat", self.client_lat)
-        p.tag("client_long", self.client_long)
-        p.field("download-mbps", self.download_mbps)
-        p.field('upload-mbps', self.upload_mbps)
-        p.field('ping-ms', self.ping_ms)
-        return [p]
+if TYPE_CHECKING:
+    from relay import RelayClient
 
 
-@dataclass(frozen=True)
-class NetworkIOInterfaceStats:
-    interface: str
-    bytes_sent: int
-    bytes_recv: int
-    packets_sent: int
-    packets_recv: int
-    errin: int
-    errout: int
-    dropin: int
-    dropout: int
+class InfluxDBConnection(Sink):
+    """
+    Writes line protocol to InfluxDB's /api/v2/write endpoint. Every request, health checks included, goes through one
+    keep-alive session with connect and read timeouts, and write bodies of at least gzip_min_bytes are gzipped.
+    """
 
-
-@dataclass(frozen=True)
-class NetworkIOData(TestResult):
-    interface_data: Iterable[NetworkIOInterfaceStats]
-
-    def to_points(self) -> Iterable[Point]:
-        points = []
-        for d in self.interface_data:
-            p = Point(Settings.network_io_monitor.measurement)
-            p.tag('interface', d.interface)
-            p.field('bytes_sent', d.bytes_sent)
-            p.field('bytes_recv', d.bytes_recv)
-            p.field('packets_sent', d.packets_sent)
-            p.field('packets_recv', d.packets_recv)
-            p.field('errors_incoming', d.errin)
-            p.field('errors_outgoing', d.errout)
-            p.field('packets_dropped_incoming', d.dropin)
-            p.field('packets_dropped_outgoing', d.dropout)
-            points.append(p)
-        return points
-
-
-@dataclass(frozen=True)
-class DiskIOStats:
-    device: str
-    directory: str
-    total_bytes: int
-    used_bytes: int
-    free_bytes: int
-    percent_used: float
-    read_count: int
-    write_count: int
-    read_bytes: int
-    write_bytes: int
-    read_time_ms: int
-    write_time_ms: int
-    busy_time_ms: int
-    read_merged_count: int
-    write_merged_count: int
-
-
-@dataclass(frozen=True)
-class DiskTestData(TestResult):
-    disk_stats: Iterable[DiskIOStats]
-
-    def to_points(self) -> Iterable[Point]:
-        points = []
-        for disk in self.disk_stats:
-            p = Point(Settings.disk_monitor.measurement)
-            p.tag('directory', disk.directory)
-            p.tag('device', disk.device)
-            p.field('total_bytes', disk.total_bytes)
-            p.field('used_bytes', disk.used_bytes)
-            p.field('free_bytes', disk.free_bytes)
-            p.field('percent_used', disk.percent_used)
-            p.field('read_count', disk.read_count)
-            p.field('write_count', disk.write_count)
-            p.field('read_bytes', disk.read_bytes)
-            p.field('write_bytes', disk.write_bytes)
-            p.field('read_time_ms', disk.read_time_ms)
-            p.field('write_time_ms', disk.write_time_ms)
-            p.field('busy_time_ms', disk.busy_time_ms)
-            p.field('read_merged_count', disk.read_merged_count)
-            p.field('write_merged_count', disk.write_merged_count)
-            points.append(p)
-        return points
-
-
-class InfluxDBConnection:
     def __init__(self):
         self.url: Settings.influxdb.server = Settings.influxdb.server
         self.token: Settings.influxdb.token = Settings.influxdb.token
         self.org: Settings.influxdb.org = Settings.influxdb.org
         self.bucket: Settings.influxdb.bucket = Settings.influxdb.bucket
-        self.conn: Optional[InfluxDBClient] = None
-        self.writer: Optional[WriteApi] = None
+        self.base_url = self.url if '://' in self.url else f'http://{self.url}'
+        self.timeout = (Settings.influxdb.connect_timeout_s, Settings.influxdb.read_timeout_s)
+        self.session = requests.Session()
+        # The batch writer's writes and replays, and health checks from the main thread
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.headers['Authorization'] = f'Token {self.token}'
+        self.write_params = {'org': self.org, 'bucket': self.bucket, 'precision': 'ns'}
+        # Agents pointed at a relay send it their lines instead, and leave the token and batching to it
+        self.relay: Optional['RelayClient'] = None
+        if Settings.relay.address:
+            from relay import RelayClient
+            self.relay = RelayClient(Settings.relay.address, Settings.influxdb.read_timeout_s,
+                                     Settings.relay.max_datagram_bytes)
+        self.encoder = LineProtocolEncoder(Settings.host)
+        self.rate_deriver = RateDeriver(Settings.rates.mode)
+        self.cardinality: Optional[CardinalityGuard] = None
+        if Settings.cardinality.enabled:
+            self.cardinality = CardinalityGuard(Settings.cardinality.series_budget, Settings.cardinality.on_exceeded,
+                                                Settings.cardinality.max_tag_values, Settings.cardinality.demote)
+        self.deadband: Optional[DeadbandFilter] = None
+        if Settings.deadband.enabled:
+            self.deadband = DeadbandFilter(Settings.deadband.heartbeat_intervals, {
+                measurement: {key: Deadband(**deadband) for key, deadband in fields.items()}
+                for measurement, fields in Settings.deadband.measurements.items()
+            })
+        self.batch_writer = BatchWriter(
+            self._write,
+            batch_size=Settings.influxdb.batch_size,
+            flush_interval_s=Settings.influxdb.flush_interval_ms / 1000,
+            max_queue_size=Settings.influxdb.max_queue_size,
+            overflow=Settings.influxdb.overflow,
+            spool=self._open_spool(),
+            health_check=self.has_good_connection,
+            retry_interval_s=Settings.influxdb.retry_initial_s,
+            max_retry_interval_s=Settings.influxdb.retry_max_s,
+            replay_points_per_s=Settings.influxdb.replay_points_per_s,
+        )
+
+    @staticmethod
+    def _open_spool() -> Optional[Spool]:
+        if not Settings.influxdb.spool_directory:
+            return None
+        try:
+            return Spool(
+                Settings.influxdb.spool_directory,
+                segment_bytes=Settings.influxdb.spool_segment_mb * 1024 * 1024,
+                max_bytes=Settings.influxdb.spool_max_mb * 1024 * 1024,
+            )
+        except OSError as e:
+            logging.error(f'Could not open spool in {Settings.influxdb.spool_directory}, points that fail to write '
+                          f'will be dropped: {e}')
+            return None
 
     def connect(self):
-        self.conn = InfluxDBClient(url=self.url, token=self.token, org=self.org)
-        self.writer = self.conn.write_api(write_options=SYNCHRONOUS)
+        self.batch_writer.start()
 
     def close(self):
-        self.writer.close()
-        self.conn.close()
+        self.batch_writer.close()
+        logging.info(f'Write stats: {self.batch_writer.stats}')
+        if self.deadband is not None:
+            logging.info(f'Deadband stats: {self.deadband.stats}')
+        if self.cardinality is not None:
+            logging.info(f'Cardinality stats: {self.cardinality.stats}')
+        self.session.close()
+        if self.relay is not None:
+            self.relay.close()
 
     def has_good_connection(self) -> bool:
+        if self.relay is not None:
+            return self.relay.has_good_connection()
         try:
-            result = requests.get(f'http://{self.url}/ping')
-        except requests.exceptions.ConnectionError as e:
-            reason = ''.join(e.args[0].reason.args[-1].split(':')[1:]).strip()
+            result = self.session.get(f'{self.base_url}/ping', timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
             logging.debug(f'Could not establish a connection to InfluxDB at {self.url}', exc_info=True)
-            logging.error(f'Failed to connect to InfluxDB at {self.url}: {reason}')
+            logging.error(f'Failed to connect to InfluxDB at {self.url}: {type(e).__name__}')
             return False
         if result.status_code != 204:
             logging.error(f"Unexpected response from InfluxDB ping - Got response {result.status_code}, expected 204")
@@ -238,11 +114,39 @@ class InfluxDBConnection:
         return True
 
     def wait_for_good_connection(self):
+        attempt = 0
         while not self.has_good_connection():
-            time.sleep(3)
-
-    def _write(self, record: Iterable[Point]):
-        self.writer.write(bucket=self.bucket, org=self.org, record=record)
-
-    def record_measurement(self, data: TestResult):
-        self._write(record=data.to_points())
+            delay_s = backoff_delay_s(attempt, Settings.influxdb.retry_initial_s, Settings.influxdb.retry_max_s)
+            logging.info(f'Retrying connection to InfluxDB in {delay_s:.1f}s')
+            time.sleep(delay_s)
+            attempt += 1
+
+    def _write(self, record: List[bytes]):
+        if self.relay is not None:
+            with Instruments.timed('write'):
+                self.relay.write(record)
+            return
+        body = b'\n'.join(record)
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if Settings.influxdb.gzip_level and len(body) >= Settings.influxdb.gzip_min_bytes:
+            with Instruments.timed('compress'):
+                body = gzip.compress(body, compresslevel=Settings.influxdb.gzip_level, mtime=0)
+            headers['Content-Encoding'] = 'gzip'
+        Instruments.observe('payload', '', len(body), SIZE_BUCKETS_BYTES)
+        with Instruments.timed('write'):
+            response = self.session.post(f'{self.base_url}/api/v2/write', params=self.write_params, data=body,
+                                         headers=headers, timeout=self.timeout)
+        if response.status_code != 204:
+            raise requests.exceptions.HTTPError(
+                f'InfluxDB write failed with {response.status_code}: {response.text[:200]}', response=response)
+
+    def record_measurement(self, data: TestResult, monitor: str = ''):
+        with Instruments.timed('serialize', monitor):
+            rows = self.rate_deriver.derive(data.rows(), data.monotonic_ns or time.monotonic_ns())
+            # Before the deadband, so a demoted tag is compared like any other field
+            if self.cardinality is not None:
+                rows = self.cardinality.guard(rows)
+            if self.deadband is not None:
+                rows = self.deadband.filter(rows)
+            lines = self.encoder.encode_rows(rows, data.timestamp_ns or time.time_ns())
+        self.batch_writer.put(lines)
@@ -0,0 +1,190 @@
+import bisect
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from procfs import ProcFile
+
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SIZE_BUCKETS_BYTES = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+TRACEMALLOC_TOP_N = 50
+
+
+@dataclass(frozen=True)
+class HistogramSnapshot:
+    stage: str
+    monitor: str
+    bounds: Tuple[float, ...]
+    # Number of observations in each bucket, with one more bucket for values above the last bound
+    counts: Tuple[int, ...]
+    count: int
+    total: float
+    max: float
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Upper bound of the bucket the q-th percentile falls in, or the largest observation if it is past the last one
+        """
+        if not self.count:
+            return None
+        rank = self.count * q / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return round(float(min(bound, self.max)), 3)
+        return round(float(self.max), 3)
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, so recording one is a bisect and an increment however many there are
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+@dataclass(frozen=True)
+class AgentResources:
+    rss_bytes: int
+    cpu_percent: Optional[float]
+    num_threads: int
+
+
+class Instrumentation:
+    """
+    Histograms of how long each stage of getting a measurement to InfluxDB takes, keyed by stage and monitor.
+    Stages record into them from whichever thread they run on, and snapshot() hands them over once per interval
+    and starts new ones.
+
+    Profiling is toggled by a signal: the first starts cProfile and tracemalloc, the second writes their results to
+    profile_directory. Measurements run on their own threads, so each one taken while profiling gets its own
+    profiler and they are merged when dumped. Python 3.12 and later allow only one active profiler, so there only the
+    main thread is profiled.
+    """
+
+    def __init__(self):
+        # Reentrant since the profiling signal handler can run while the main thread is recording an observation
+        self._lock = threading.RLock()
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._profiles: List[cProfile.Profile] = []
+        self._main_profile: Optional[cProfile.Profile] = None
+        # Cleared the first time a measurement's profiler can't be enabled next to the main one
+        self._profile_measurements = True
+        self.profile_directory = '.'
+        self._self_stat: Optional[ProcFile] = None
+        self._prev_cpu: Optional[Tuple[int, int]] = None
+
+    def observe(self, stage: str, monitor: str, value: float, bounds: Sequence[float] = LATENCY_BUCKETS_MS):
+        with self._lock:
+            histogram = self._histograms.get((stage, monitor))
+            if histogram is None:
+                histogram = self._histograms[(stage, monitor)] = Histogram(bounds)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timed(self, stage: str, monitor: str = ''):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, monitor, (time.perf_counter() - start) * 1000)
+
+    def snapshot(self) -> List[HistogramSnapshot]:
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        return [
+            HistogramSnapshot(stage=stage, monitor=monitor, bounds=h.bounds, counts=tuple(h.counts), count=h.count,
+                              total=h.total, max=h.max)
+            for (stage, monitor), h in histograms.items()
+        ]
+
+    def resources(self) -> AgentResources:
+        if self._self_stat is None:
+            self._self_stat = ProcFile('/proc/self/stat', 1024)
+        self._self_stat.refresh()
+        stat = self._self_stat.contents()
+        # Columns after the command name, see proc(5)
+        fields = stat[stat.rindex(b')') + 2:].split()
+        cpu_ticks = int(fields[11]) + int(fields[12])
+        now_ns = time.monotonic_ns()
+        cpu_percent = None
+        if self._prev_cpu is not None and now_ns > self._prev_cpu[0]:
+            elapsed_s = (now_ns - self._prev_cpu[0]) / 1e9
+            cpu_percent = round((cpu_ticks - self._prev_cpu[1]) / os.sysconf('SC_CLK_TCK') / elapsed_s * 100, 2)
+        self._prev_cpu = (now_ns, cpu_ticks)
+        return AgentResources(
+            rss_bytes=int(fields[21]) * os.sysconf('SC_PAGE_SIZE'),
+            cpu_percent=cpu_percent,
+            num_threads=int(fields[17]),
+        )
+
+    @property
+    def profiling(self) -> bool:
+        return self._main_profile is not None
+
+    @contextlib.contextmanager
+    def profiled(self):
+        if not self.profiling or not self._profile_measurements:
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiling tool is already active
+            logging.warning(f'Measurements will not be profiled: {e}')
+            self._profile_measurements = False
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+
+    def toggle_profiling(self, *_):
+        if not self.profiling:
+            logging.warning(f'Profiling started, signal again to write results to {self.profile_directory}')
+            tracemalloc.start()
+            self._main_profile = cProfile.Profile()
+            self._main_profile.enable()
+            return
+        self._main_profile.disable()
+        with self._lock:
+            profiles, self._profiles = [self._main_profile, *self._profiles], []
+        self._main_profile = None
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        prefix = os.path.join(self.profile_directory, f'sysmon-{time.strftime("%Y%m%d-%H%M%S")}')
+        os.makedirs(self.profile_directory, exist_ok=True)
+        pstats.Stats(*profiles).dump_stats(f'{prefix}.prof')
+        with open(f'{prefix}-tracemalloc.txt', 'w') as f:
+            for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP_N]:
+                f.write(f'{stat}\n')
+        logging.warning(f'Profiling stopped, wrote {prefix}.prof and {prefix}-tracemalloc.txt')
+
+
+Instruments = Instrumentation()
@@ -0,0 +1,30 @@
+from typing import Callable, Optional, Tuple
+
+from batch_writer import WriteStats
+from deadband import DeadbandStats
+from instrumentation import Instruments
+from monitored_stat import MonitoredStat
+from results import INTERNAL_AGENT_SCHEMA, INTERNAL_HISTOGRAM_SCHEMAS, InternalTestData, TestResult
+
+
+class InternalMonitor(MonitoredStat):
+    """
+    Reports the agent's own latency histograms, resource usage, write queue and what the deadband saved
+    """
+    schemas = (*INTERNAL_HISTOGRAM_SCHEMAS.values(), INTERNAL_AGENT_SCHEMA)
+
+    def __init__(self, *args, write_stats: Callable[[], WriteStats],
+                 deadband_stats: Callable[[], Optional[DeadbandStats]] = lambda: None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_stats = write_stats
+        self.deadband_stats = deadband_stats
+        # Prime the CPU counter so the first report has a utilization
+        Instruments.resources()
+
+    def _measure(self) -> Tuple[bool, Optional[TestResult]]:
+        return True, InternalTestData(
+            histograms=Instruments.snapshot(),
+            resources=Instruments.resources(),
+            write_stats=self.write_stats(),
+            deadband_stats=self.deadband_stats(),
+        )
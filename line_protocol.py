@@ -0,0 +1,127 @@
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+FIELD_FORMATS = {int: b'%di', float: b'%r'}
+MAX_CACHED_TAG_SETS = 10000
+
+
+class PointSchema:
+    """
+    Declares the tag and field keys of one kind of point, which of its fields are cumulative counters (see
+    rates.Counter), and which of its tags have unbounded values and are better written as fields of the given type
+    (see cardinality.CardinalityGuard). The measurement name is looked up lazily since it comes from settings, which
+    are loaded after the schemas are declared.
+    """
+    __slots__ = ('_measurement', 'tag_keys', 'fields', 'counters', 'high_cardinality_tags')
+
+    def __init__(self, measurement: Callable[[], str], tag_keys: Sequence[str], fields: Sequence[Tuple[str, type]],
+                 counters: Sequence[Tuple] = (), high_cardinality_tags: Sequence[Tuple[str, type]] = ()):
+        self._measurement = measurement
+        self.tag_keys: Tuple[str, ...] = tuple(tag_keys)
+        self.fields: Tuple[Tuple[str, type], ...] = tuple(fields)
+        self.counters: Tuple[Tuple, ...] = tuple(counters)
+        self.high_cardinality_tags: Tuple[Tuple[str, type], ...] = tuple(high_cardinality_tags)
+
+    @property
+    def measurement(self) -> str:
+        return self._measurement()
+
+    @property
+    def field_keys(self) -> Tuple[str, ...]:
+        return tuple(key for key, _ in self.fields)
+
+
+# A row is one point: its schema, tag values and field values, in schema order. A field value of None is omitted.
+Row = Tuple[PointSchema, Tuple, Tuple]
+
+
+def escape_measurement(s: str) -> bytes:
+    return s.replace(',', r'\,').replace(' ', r'\ ').encode()
+
+
+def escape_key(s: str) -> bytes:
+    return s.replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ').encode()
+
+
+def escape_string_field(s: str) -> bytes:
+    return b'"' + s.replace('\\', '\\\\').replace('"', '\\"').encode() + b'"'
+
+
+def format_field(value) -> bytes:
+    if isinstance(value, bool):
+        return b'true' if value else b'false'
+    if isinstance(value, int):
+        return b'%di' % value
+    if isinstance(value, float):
+        return b'%r' % value
+    return escape_string_field(str(value))
+
+
+class _Template:
+    __slots__ = ('measurement', 'tag_keys', 'tag_order', 'extra_tag_values', 'field_keys', 'fields_format',
+                 'preformatted_fields', 'tag_sets')
+
+    def __init__(self, schema: PointSchema, extra_tags: Tuple[Tuple[str, str], ...] = ()):
+        self.measurement = escape_measurement(schema.measurement)
+        tag_keys = schema.tag_keys + tuple(key for key, _ in extra_tags)
+        self.tag_keys = [b',' + escape_key(k) + b'=' for k in tag_keys]
+        # InfluxDB recommends sorting tags by key
+        self.tag_order = sorted(range(len(tag_keys)), key=lambda i: tag_keys[i])
+        self.extra_tag_values = tuple(value for _, value in extra_tags)
+        self.field_keys = [escape_key(k) + b'=' for k, _ in schema.fields]
+        self.fields_format = b' ' + b','.join(
+            k + FIELD_FORMATS.get(t, b'%s') for k, (_, t) in zip(self.field_keys, schema.fields)
+        ) + b' %d'
+        self.preformatted_fields = [i for i, (_, t) in enumerate(schema.fields) if t not in FIELD_FORMATS]
+        self.tag_sets: Dict[Tuple, bytes] = {}
+
+    def tag_set(self, tag_values: Tuple) -> bytes:
+        tag_set = self.tag_sets.get(tag_values)
+        if tag_set is None:
+            if len(self.tag_sets) >= MAX_CACHED_TAG_SETS:
+                self.tag_sets.clear()
+            values = tag_values + self.extra_tag_values
+            tag_set = self.measurement + b''.join(
+                self.tag_keys[i] + escape_key(str(values[i])) for i in self.tag_order
+                if values[i] is not None and values[i] != ''
+            )
+            self.tag_sets[tag_values] = tag_set
+        return tag_set
+
+    def encode(self, tag_values: Tuple, field_values: Tuple, timestamp_ns: int) -> Optional[bytes]:
+        if None in field_values:
+            fields = b','.join(k + format_field(v) for k, v in zip(self.field_keys, field_values) if v is not None)
+            if not fields:
+                return None
+            return self.tag_set(tag_values) + b' ' + fields + b' %d' % timestamp_ns
+        if self.preformatted_fields:
+            field_values = list(field_values)
+            for i in self.preformatted_fields:
+                field_values[i] = format_field(field_values[i])
+            field_values = tuple(field_values)
+        return self.tag_set(tag_values) + self.fields_format % (*field_values, timestamp_ns)
+
+
+class LineProtocolEncoder:
+    """
+    Serializes rows straight to line protocol bytes, with one precompiled template per schema and the escaped tag
+    set of each series cached after its first point. With a host, every line is also tagged with it, so the series of
+    agents writing to the same bucket stay apart.
+    """
+
+    def __init__(self, host: Optional[str] = None):
+        self._templates: Dict[PointSchema, _Template] = {}
+        self.extra_tags: Tuple[Tuple[str, str], ...] = (('host', host),) if host else ()
+
+    def template(self, schema: PointSchema) -> _Template:
+        template = self._templates.get(schema)
+        if template is None:
+            template = self._templates[schema] = _Template(schema, self.extra_tags)
+        return template
+
+    def encode_rows(self, rows: Iterable[Row], timestamp_ns: int) -> List[bytes]:
+        lines = []
+        for schema, tag_values, field_values in rows:
+            line = self.template(schema).encode(tag_values, field_values, timestamp_ns)
+            if line is not None:
+                lines.append(line)
+        return lines
@@ -1,62 +1,174 @@
+import argparse
 import logging
-import time
-from typing import Iterable
+import signal
+from typing import Dict, List, Optional
 
-import urllib3.exceptions
-
-from cpu_monitor import CPUMonitor
-from disk_monitor import DiskMonitor
-from influx_db import InfluxDBConnection
-from memory_monitor import MemoryUsageMonitor
-from monitored_stat import MonitoredStat
-from network_monitor import NetworkIOMonitor, NetworkSpeedMonitor
+from batch_writer import WriteStats
+from executor import MeasurementExecutor
+from history import HistorySink, print_history
+from instrumentation import Instruments
+from internal_monitor import InternalMonitor
+from monitors import create_monitors
+from projection import Projections
+from results import SCHEDULER_SCHEMA, SchedulerTestData, SchedulerTickStats
+from scheduler import Scheduler
 from settings import Settings
+from sinks import SINK_TYPES, LineProtocolFileSink, PrometheusSink, Sink
+
+
+def create_sinks() -> List[Sink]:
+    sinks = []
+    for sink in Settings.sinks:
+        if sink.type == 'influxdb':
+            # Imported here since requests takes a while to import, and agents with other sinks don't need it
+            from influx_db import InfluxDBConnection
+            conn = InfluxDBConnection()
+            conn.wait_for_good_connection()
+            sinks.append(conn)
+        elif sink.type == 'prometheus':
+            sinks.append(PrometheusSink(sink.listen))
+        elif sink.type == 'file':
+            sinks.append(LineProtocolFileSink(sink.path))
+        elif sink.type == 'history':
+            sinks.append(HistorySink(sink.directory, int(sink.max_mb * 1024 * 1024)))
+        else:
+            raise ValueError(f"Unknown sink type {sink.type}, expected one of {', '.join(SINK_TYPES)}")
+    return sinks
+
 
+def record_measurement(sinks: List[Sink], data, monitor: str):
+    for sink in sinks:
+        try:
+            sink.record_measurement(data, monitor)
+        except Exception:
+            # One sink failing shouldn't stop the others from getting the measurement
+            logging.exception(f'{type(sink).__name__} failed to record {monitor} measurement')
 
-def start_monitoring(influx_conn: InfluxDBConnection, monitors: Iterable[MonitoredStat]):
+
+def held_tick_stats(held: Optional[SchedulerTickStats], tick: SchedulerTickStats) -> SchedulerTickStats:
+    """
+    Folds a tick into the stats held since a monitor's last rollup: the worst lateness and every missed deadline
+    """
+    if held is None:
+        return tick
+    return SchedulerTickStats(monitor=tick.monitor, lateness_ms=max(held.lateness_ms, tick.lateness_ms),
+                              missed_deadlines=held.missed_deadlines + tick.missed_deadlines,
+                              interval_s=tick.interval_s)
+
+
+def start_monitoring(sinks: List[Sink], scheduler: Scheduler, executor: MeasurementExecutor):
+    # Monitors with a sample_rate only send a point per rollup, so their scheduler stats are held until one is sent
+    held_ticks: Dict[str, SchedulerTickStats] = {}
     while True:
-        time_to_next_measurement_s = []
-        for monitor in monitors:
-            if monitor.is_ready_for_measurement():
-                logging.info(f'Taking {monitor.name} measurement')
-                success, m = monitor.take_measurement()
-                if not success:
-                    logging.critical(f"{monitor.name} measurement failed!")
-                else:
-                    try:
-                        influx_conn.record_measurement(m)
-                    except urllib3.exceptions.ReadTimeoutError:
-                        logging.critical(f'Connection timed out! Could not write data for {monitor.name} measurement!')
-            time_to_next_measurement_s.append(monitor.get_time_to_next_measurement_s())
-        sleep_time = max(min(time_to_next_measurement_s), 0)
-        logging.debug(f"Sleeping for {sleep_time} seconds")
-        time.sleep(sleep_time)
+        ticks = scheduler.pop_due()
+        tick_stats = []
+        for tick in ticks:
+            monitor = tick.monitor
+            Instruments.observe('lateness', monitor.name, tick.lateness_s * 1000)
+            if tick.missed:
+                logging.warning(f'{monitor.name} fired {tick.lateness_s:.3f}s late, coalescing {tick.missed} missed '
+                                f'measurement(s)')
+            logging.log(logging.INFO if monitor.rollup is None else logging.DEBUG,
+                        f'Taking {monitor.name} measurement')
+            if not executor.submit(monitor):
+                logging.error(f'{monitor.name} already has {executor.running(monitor)} measurement(s) running. '
+                              f'SKIPPING')
+            stats = SchedulerTickStats(monitor=monitor.name, lateness_ms=tick.lateness_s * 1000,
+                                       missed_deadlines=tick.missed, interval_s=monitor.refresh_rate_s)
+            if monitor.rollup is None:
+                tick_stats.append(stats)
+            else:
+                held_ticks[monitor.name] = held_tick_stats(held_ticks.get(monitor.name), stats)
+        if tick_stats:
+            record_measurement(sinks, SchedulerTestData(tick_stats=tick_stats), 'scheduler')
 
+        sleep_time = scheduler.time_to_next_tick_s()
+        logging.debug(f"Waiting up to {sleep_time} seconds for measurements")
+        for run in executor.wait(sleep_time):
+            if run.monitor.adaptive is not None:
+                scheduler.reschedule(run.monitor)
+            if run.timed_out:
+                logging.critical(f"{run.monitor.name} measurement timed out after {run.monitor.timeout_s}s!")
+            elif not run.success:
+                logging.critical(f"{run.monitor.name} measurement failed!")
+            elif run.result is not None:
+                record_measurement(sinks, run.result, run.monitor.name)
+                held = held_ticks.pop(run.monitor.name, None)
+                if held is not None:
+                    record_measurement(sinks, SchedulerTestData(tick_stats=[held]), 'scheduler')
 
-def main():
+
+def history(args: argparse.Namespace):
+    directory = args.directory
+    if directory is None:
+        Settings.load_settings(args.settings)
+        directory = next((sink.directory for sink in Settings.sinks if sink.type == 'history'), None)
+        if directory is None:
+            raise SystemExit(f'No history sink in {args.settings}, pass --directory')
+    print_history(directory, args.minutes, args.measurement, args.raw)
+
+
+def run(args: argparse.Namespace):
     logging.getLogger().setLevel(logging.INFO)
-    Settings.load_settings()
+    Settings.load_settings(args.settings)
+    enabled = create_monitors()
+    # The scheduler's and the agent's own points aren't an enabled monitor's, so their fields settings are checked here
+    Projections.check([SCHEDULER_SCHEMA, *(InternalMonitor.schemas if Settings.instrumentation.enabled else ())])
+    Projections.check_measurements()
+    if not enabled and not Settings.instrumentation.enabled:
+        raise SystemExit(f'No monitors are enabled in {args.settings}')
+
+    sinks = create_sinks()
+    for sink in sinks:
+        sink.connect()
+    # Sinks are created in the order they are configured
+    conn = next((sink for sink, settings in zip(sinks, Settings.sinks) if settings.type == 'influxdb'), None)
 
-    conn = InfluxDBConnection()
-    conn.wait_for_good_connection()
-    conn.connect()
+    monitors = list(enabled.values())
+    if Settings.instrumentation.enabled:
+        monitors.append(InternalMonitor(
+            'sysmon-internal', Settings.instrumentation.monitor_rate,
+            write_stats=lambda: conn.batch_writer.stats if conn else WriteStats(),
+            deadband_stats=lambda: conn.deadband.stats if conn and conn.deadband else None,
+        ))
+    if Settings.instrumentation.profile_signal:
+        Instruments.profile_directory = Settings.instrumentation.profile_directory
+        signal.signal(getattr(signal, Settings.instrumentation.profile_signal), Instruments.toggle_profiling)
 
-    monitors = [
-        DiskMonitor('disk-monitor', Settings.disk_monitor.monitor_rate),
-        NetworkIOMonitor('network-io', Settings.network_io_monitor.monitor_rate),
-        NetworkSpeedMonitor('network-speedtest', Settings.network_speed_test.monitor_rate),
-        CPUMonitor('cpu-stat', Settings.cpu_monitor.monitor_rate),
-        MemoryUsageMonitor('memory-monitor', Settings.memory_monitor.monitor_rate),
-    ]
+    scheduler = Scheduler(
+        monitors,
+        align_to_wall_clock=Settings.scheduler.align_to_wall_clock,
+        catch_up=Settings.scheduler.catch_up,
+    )
+
+    executor = MeasurementExecutor()
+    if 'pressure' in enabled:
+        enabled['pressure'].start_triggers(Settings.pressure_monitor.triggers, executor.report)
 
     try:
-        start_monitoring(conn, monitors)
+        start_monitoring(sinks, scheduler, executor)
     except Exception:
         logging.exception('Critical error - shutting down')
     except KeyboardInterrupt:
         logging.info('Caught KeyboardInterrupt. Exiting')
     finally:
-        conn.close()
+        for sink in sinks:
+            sink.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send system measurements to InfluxDB and other sinks')
+    parser.add_argument('--settings', default='settings.yaml')
+    parser.set_defaults(command=run)
+    subcommands = parser.add_subparsers()
+    history_parser = subcommands.add_parser('history', help='show recent measurements kept by the history sink')
+    history_parser.add_argument('--minutes', type=float, default=10)
+    history_parser.add_argument('--measurement', help='only show this measurement')
+    history_parser.add_argument('--directory', help="the history sink's directory, instead of reading settings")
+    history_parser.add_argument('--raw', action='store_true', help='print every sample instead of aggregates')
+    history_parser.set_defaults(command=history)
+    args = parser.parse_args()
+    args.command(args)
 
 
 if __name__ == '__main__':
@@ -1,32 +1,66 @@
 from typing import Optional, Tuple
 
-import psutil
-
-from influx_db import MemoryTestData, TestResult
 from monitored_stat import MonitoredStat
+from procfs import ProcFile
+from projection import Projections
+from results import RAM_SCHEMA, SWAP_SCHEMA, MemoryTestData, TestResult
+
+KB = 1024
+SWAP_PAGE_BYTES = 4 * KB
+
+
+def usage_percent(used: int, total: int) -> float:
+    return round(used / total * 100, 1) if total else 0.0
 
 
 class MemoryUsageMonitor(MonitoredStat):
+    schemas = (RAM_SCHEMA, SWAP_SCHEMA)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.meminfo = ProcFile('/proc/meminfo')
+        self.vmstat = ProcFile('/proc/vmstat')
+        swap = Projections.plan(SWAP_SCHEMA)
+        self.reads_swap = bool(swap.selected)
+        self.reads_vmstat = swap.wants('swap_in_total_bytes', 'swap_out_total_bytes')
+
     def _measure(self) -> Tuple[bool, Optional[TestResult]]:
-        vmem = psutil.virtual_memory()
-        swap = psutil.swap_memory()
+        # Matches the arithmetic psutil.virtual_memory and psutil.swap_memory do on the same files
+        meminfo = self.meminfo
+        meminfo.refresh()
+        ram_total = meminfo.int_field(b'MemTotal:') * KB
+        ram_free = meminfo.int_field(b'MemFree:') * KB
+        ram_available = meminfo.int_field(b'MemAvailable:') * KB
+        if not 0 < ram_available <= ram_total:
+            ram_available = ram_free
+        swap_total = swap_used = swap_free = swap_used_percent = swap_in = swap_out = None
+        if self.reads_swap:
+            swap_total = meminfo.int_field(b'SwapTotal:') * KB
+            swap_free = meminfo.int_field(b'SwapFree:') * KB
+            swap_used = swap_total - swap_free
+            swap_used_percent = usage_percent(swap_used, swap_total)
+        if self.reads_vmstat:
+            self.vmstat.refresh()
+            swap_in = self.vmstat.int_field(b'pswpin ') * SWAP_PAGE_BYTES
+            swap_out = self.vmstat.int_field(b'pswpout ') * SWAP_PAGE_BYTES
+
         d = MemoryTestData(
-            ram_total_bytes=vmem.total,
-            ram_available_bytes=vmem.available,
-            ram_available_percent=vmem.percent,
-            ram_used_bytes=vmem.used,
-            ram_free_bytes=vmem.free,
-            ram_active_bytes=vmem.active,
-            ram_inactive_bytes=vmem.inactive,
-            ram_buffers_bytes=vmem.buffers,
-            ram_cached_bytes=vmem.cached,
-            ram_shared_bytes=vmem.shared,
-            ram_slab_bytes=vmem.slab,
-            swap_total_bytes=swap.total,
-            swap_used_bytes=swap.used,
-            swap_free_bytes=swap.free,
-            swap_used_percent=swap.percent,
-            swap_in_total_bytes=swap.sin,
-            swap_out_total_bytes=swap.sout,
+            ram_total_bytes=ram_total,
+            ram_available_bytes=ram_available,
+            ram_available_percent=usage_percent(ram_total - ram_available, ram_total),
+            ram_used_bytes=ram_total - ram_available,
+            ram_free_bytes=ram_free,
+            ram_active_bytes=meminfo.int_field(b'Active:') * KB,
+            ram_inactive_bytes=meminfo.int_field(b'Inactive:') * KB,
+            ram_buffers_bytes=meminfo.int_field(b'Buffers:') * KB,
+            ram_cached_bytes=(meminfo.int_field(b'Cached:') + meminfo.int_field(b'SReclaimable:')) * KB,
+            ram_shared_bytes=meminfo.int_field(b'Shmem:') * KB,
+            ram_slab_bytes=meminfo.int_field(b'Slab:') * KB,
+            swap_total_bytes=swap_total,
+            swap_used_bytes=swap_used,
+            swap_free_bytes=swap_free,
+            swap_used_percent=swap_used_percent,
+            swap_in_total_bytes=swap_in,
+            swap_out_total_bytes=swap_out,
         )
         return True, d
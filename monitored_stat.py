@@ -1,36 +1,84 @@
-from datetime import datetime, timedelta
-from typing import Optional, Tuple
+import dataclasses
+import threading
+import time
+from typing import TYPE_CHECKING, Optional, Sequence, Tuple
 
-from influx_db import TestResult
+from adaptive import AdaptiveRate
+from instrumentation import Instruments
+from line_protocol import PointSchema
+from projection import Projections
+from rates import RateDeriver
+from results import RollupTestData, TestResult
+from settings import AdaptiveSettings, Settings, parse_refresh_rate
 
-UNIT_TO_S = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+if TYPE_CHECKING:
+    from rollup import RollupBuffer
 
 
-def parse_refresh_rate(rate: str) -> float:
-    rate = rate.lower().strip()
-    unit = rate[-1]
-    if unit not in UNIT_TO_S.keys():
-        raise KeyError(f"Invalid refresh rate unit on stat. Found {unit}, expected one of {UNIT_TO_S.keys()}")
-    refresh_rate = float(rate[:-1]) * UNIT_TO_S[unit]
-    return refresh_rate
+class MonitoredStat:
+    """
+    With a sample_rate, the stat is measured at that faster rate and each sample is kept in a rollup buffer. A
+    RollupTestData with the min, max, mean, ... of every field is then returned once per refresh_rate, and
+    take_measurement returns no result for the samples in between.
 
+    With adaptive settings, refresh_rate_s is changed after each measurement by an AdaptiveRate, and the scheduler
+    picks the new rate up when the measurement completes.
 
-class MonitoredStat:
-    def __init__(self, name: str, refresh_rate: str):
+    A stat can be measured from several threads at once, e.g. overlapping runs or a pressure trigger firing while the
+    executor runs it, so the rollup and adaptive state is only updated under state_lock.
+    """
+    # Schemas of the rows the results have, whose field projections are compiled (and checked) when it is created
+    schemas: Tuple[PointSchema, ...] = ()
+
+    def __init__(self, name: str, refresh_rate: str, timeout: Optional[str] = None, max_overlapping_runs: int = 1,
+                 sample_rate: Optional[str] = None, rollup_stats: Optional[Sequence[str]] = None,
+                 adaptive: Optional[AdaptiveSettings] = None):
         self.name = name
+        self.state_lock = threading.Lock()
+        Projections.check(self.schemas)
         self.refresh_rate_s = parse_refresh_rate(refresh_rate)
-        self.last_measurement_timestamp = datetime.fromtimestamp(0)
+        self.rollup: Optional['RollupBuffer'] = None
+        if sample_rate:
+            # Only imported when needed, since it brings in NumPy
+            from rollup import ROLLUP_STATS, RollupBuffer
+
+            self.rollup_interval_ns = int(self.refresh_rate_s * 1e9)
+            self.refresh_rate_s = parse_refresh_rate(sample_rate)
+            self.rollup = RollupBuffer.for_rates(self.rollup_interval_ns / 1e9, self.refresh_rate_s,
+                                                 rollup_stats or ROLLUP_STATS)
+            # Counters are turned into rates per sample, so bursts between two rollups show up in the rate's max
+            self.rollup_rates = RateDeriver(Settings.rates.mode)
+            self.last_rollup_ns = time.monotonic_ns()
+        self.adaptive: Optional[AdaptiveRate] = None
+        if adaptive:
+            if sample_rate:
+                raise ValueError(f'{name} can either have a sample_rate or adaptive rates, not both')
+            self.adaptive = AdaptiveRate(self.refresh_rate_s, parse_refresh_rate(adaptive.min_rate), adaptive.triggers,
+                                         adaptive.decay_factor)
+        self.timeout_s = parse_refresh_rate(timeout) if timeout else self.refresh_rate_s
+        self.max_overlapping_runs = max_overlapping_runs
 
     def take_measurement(self) -> Tuple[bool, Optional[TestResult]]:
-        self.last_measurement_timestamp = datetime.now()
-        return self._measure()
+        timestamp_ns = time.time_ns()
+        monotonic_ns = time.monotonic_ns()
+        # Not under state_lock, so a hung measurement doesn't hold up the runs overlapping it
+        with Instruments.timed('collect', self.name):
+            success, result = self._measure()
+        if result is None:
+            return success, result
+        result = dataclasses.replace(result, timestamp_ns=timestamp_ns, monotonic_ns=monotonic_ns)
+        with self.state_lock:
+            if self.adaptive is not None:
+                self.refresh_rate_s = self.adaptive.update(result.rows(), monotonic_ns)
+            if self.rollup is None:
+                return success, result
+
+            self.rollup.add(self.rollup_rates.derive(result.rows(), monotonic_ns))
+            if monotonic_ns - self.last_rollup_ns < self.rollup_interval_ns:
+                return True, None
+            self.last_rollup_ns = monotonic_ns
+            return True, RollupTestData(rollup_rows=self.rollup.flush(), timestamp_ns=timestamp_ns,
+                                        monotonic_ns=monotonic_ns)
 
     def _measure(self) -> Tuple[bool, Optional[TestResult]]:
         raise NotImplementedError("All stats must implement _measure()")
-
-    def is_ready_for_measurement(self) -> bool:
-        now = datetime.now()
-        return (now - self.last_measurement_timestamp).total_seconds() > self.refresh_rate_s
-
-    def get_time_to_next_measurement_s(self) -> float:
-        return (self.last_measurement_timestamp + timedelta(0, self.refresh_rate_s) - datetime.now()).total_seconds()
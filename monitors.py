@@ -0,0 +1,51 @@
+import importlib
+import logging
+from typing import Dict, NamedTuple
+
+from monitored_stat import MonitoredStat
+from settings import MONITOR_SECTIONS, Settings
+
+
+class MonitorType(NamedTuple):
+    # Name the monitor is logged and instrumented as
+    name: str
+    # Only imported once a monitor of this type is enabled, so disabled ones cost no import time or memory
+    module: str
+    cls: str
+
+
+MONITOR_TYPES = {
+    'disk': MonitorType('disk-monitor', 'disk_monitor', 'DiskMonitor'),
+    'network_io': MonitorType('network-io', 'network_io_monitor', 'NetworkIOMonitor'),
+    'speedtest': MonitorType('network-speedtest', 'network_monitor', 'NetworkSpeedMonitor'),
+    'cpu': MonitorType('cpu-stat', 'cpu_monitor', 'CPUMonitor'),
+    'memory': MonitorType('memory-monitor', 'memory_monitor', 'MemoryUsageMonitor'),
+    'process': MonitorType('process-monitor', 'process_monitor', 'ProcessMonitor'),
+    'pressure': MonitorType('pressure-monitor', 'pressure_monitor', 'PressureMonitor'),
+}
+
+
+def monitor_options(monitor_settings) -> dict:
+    return dict(
+        timeout=monitor_settings.timeout,
+        max_overlapping_runs=monitor_settings.max_overlapping_runs,
+        sample_rate=monitor_settings.sample_rate,
+        rollup_stats=monitor_settings.rollup_stats,
+        adaptive=monitor_settings.adaptive,
+    )
+
+
+def create_monitors() -> Dict[str, MonitoredStat]:
+    """
+    Returns the enabled monitors by type, importing only their modules
+    """
+    monitors = {}
+    for monitor_type, section in MONITOR_SECTIONS.items():
+        monitor_settings = getattr(Settings, section.attribute)
+        if monitor_settings is None:
+            continue
+        registered = MONITOR_TYPES[monitor_type]
+        cls = getattr(importlib.import_module(registered.module), registered.cls)
+        monitors[monitor_type] = cls(registered.name, monitor_settings.monitor_rate, **monitor_options(monitor_settings))
+    logging.info(f'Enabled monitors: {", ".join(monitors) or "none"}')
+    return monitors
@@ -0,0 +1,128 @@
+import logging
+import os
+import re
+import select
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+MOUNTINFO = '/proc/self/mountinfo'
+OCTAL_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+
+class Mount(NamedTuple):
+    mount_point: str
+    source: str
+    fstype: str
+    major: int
+    minor: int
+
+
+class DiskMount(NamedTuple):
+    mount_point: str
+    # The mount source as shown by `mount`, e.g. /dev/mapper/vg-root
+    device: str
+    # The name of the block device in /proc/diskstats, e.g. dm-0 or sda1
+    kernel_name: str
+
+
+def _unescape(s: str) -> str:
+    return OCTAL_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), s)
+
+
+def parse_mountinfo(contents: str) -> List[Mount]:
+    mounts = []
+    for line in contents.splitlines():
+        fields = line.split()
+        # Optional fields run until the '-' separator, followed by fstype and source
+        separator = fields.index('-', 6)
+        major, minor = fields[2].split(':')
+        mounts.append(Mount(
+            mount_point=_unescape(fields[4]),
+            source=_unescape(fields[separator + 2]),
+            fstype=fields[separator + 1],
+            major=int(major),
+            minor=int(minor),
+        ))
+    return mounts
+
+
+def block_device_name(major: int, minor: int) -> Optional[str]:
+    try:
+        return os.path.basename(os.readlink(f'/sys/dev/block/{major}:{minor}'))
+    except OSError:
+        return None
+
+
+def resolve_block_device(mount: Mount) -> Optional[str]:
+    """
+    Returns the kernel name of the block device backing a mount. Device-mapper and partitions resolve to their own
+    entry (dm-0, sda1) through the device number. Filesystems like btrfs report an anonymous device number, so fall
+    back to the device number of the source device node.
+    """
+    name = block_device_name(mount.major, mount.minor) if mount.major else None
+    if name is None and mount.source.startswith('/dev/'):
+        try:
+            rdev = os.stat(mount.source).st_rdev
+        except OSError:
+            return None
+        name = block_device_name(os.major(rdev), os.minor(rdev))
+    return name
+
+
+def find_mount(path: str, mounts: Dict[str, Mount]) -> Optional[Mount]:
+    while True:
+        mount = mounts.get(path)
+        if mount is not None or path == '/':
+            return mount
+        path = os.path.dirname(path)
+
+
+class MountIndex:
+    """
+    Maps directories to the mount and block device they live on. The index is built once and only rebuilt when the
+    kernel flags a change to the mount table, which it does by raising POLLPRI on an open mountinfo file.
+    """
+
+    def __init__(self, directories: Iterable[str], mountinfo_path: str = MOUNTINFO):
+        self.directories = list(directories)
+        self.mountinfo = open(mountinfo_path, 'r')
+        self.poller = select.poll()
+        self.poller.register(self.mountinfo, select.POLLPRI | select.POLLERR)
+        self.index: Dict[str, DiskMount] = {}
+        self.missing: List[str] = []
+        self.rebuild()
+
+    def close(self):
+        self.mountinfo.close()
+
+    def rebuild(self):
+        self.mountinfo.seek(0)
+        # Later mounts on the same mount point hide earlier ones
+        mounts = {mount.mount_point: mount for mount in parse_mountinfo(self.mountinfo.read())}
+        self.index = {}
+        self.missing = []
+        for d in self.directories:
+            if not os.path.exists(d):
+                self.missing.append(d)
+                continue
+            mount = find_mount(os.path.realpath(d), mounts)
+            kernel_name = resolve_block_device(mount) if mount is not None else None
+            if kernel_name is None:
+                logging.warning(f'{d} is not on a block device, its disk stats will not be collected')
+                continue
+            self.index[d] = DiskMount(mount_point=mount.mount_point, device=mount.source, kernel_name=kernel_name)
+        logging.debug(f'Indexed mounts for {self.directories}: {self.index}')
+
+    def lookup(self) -> Dict[str, DiskMount]:
+        if self.poller.poll(0) or any(os.path.exists(d) for d in self.missing):
+            logging.info('Mount table changed, rebuilding mount index')
+            self.rebuild()
+        for d in self.missing:
+            logging.warning(f'Could not find directory {d}. SKIPPING')
+        return self.index
+
+    def forget(self, d: str):
+        """
+        Moves a directory that was deleted after it was indexed to the missing ones, until it appears again
+        """
+        if self.index.pop(d, None) is not None:
+            self.missing.append(d)
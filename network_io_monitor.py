@@ -0,0 +1,34 @@
+import logging
+from typing import Optional, Tuple
+
+from columns import Columns
+from monitored_stat import MonitoredStat
+from procfs import ProcFile
+from results import NETWORK_IO_SCHEMA, NetworkIOData, TestResult
+from settings import Settings
+
+
+class NetworkIOMonitor(MonitoredStat):
+    schemas = (NETWORK_IO_SCHEMA,)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.net_dev = ProcFile('/proc/net/dev')
+
+    def _measure(self) -> Tuple[bool, Optional[TestResult]]:
+        self.net_dev.refresh()
+        interfaces = Columns.allocate(NETWORK_IO_SCHEMA, len(Settings.network_io_monitor.interfaces))
+        num_interfaces = 0
+        for iface in Settings.network_io_monitor.interfaces:
+            stats = self.net_dev.fields(iface.encode() + b':')
+            if stats is not None:
+                # bytes, packets, errors and drops sent, then received, in NETWORK_IO_SCHEMA's order
+                interfaces.set(num_interfaces, (iface,), [int(stats[i]) for i in (8, 0, 9, 1, 2, 10, 3, 11)])
+                num_interfaces += 1
+            else:
+                logging.warning(f"Could not find interface {iface}")
+        interfaces.truncate(num_interfaces)
+        results = NetworkIOData(
+            interfaces=interfaces
+        )
+        return True, results
@@ -1,41 +1,181 @@
+import copy
+import json
 import logging
-from typing import Dict, List, Optional, Tuple
+import os
+import time
+from typing import Dict, Optional, Tuple
 
-import psutil
 import speedtest
 
-from influx_db import NetworkIOData, NetworkIOInterfaceStats, SpeedTestData, TestResult
-from monitored_stat import MonitoredStat
+from monitored_stat import MonitoredStat, parse_refresh_rate
+from results import SPEEDTEST_SCHEMA, SpeedTestData, TestResult
 from settings import Settings
 
 BITS_PER_S_TO_M_BITS_PER_S = 1024 * 1024
+# Latency changes smaller than this are noise, however large they are relative to a very close server's latency
+MIN_LATENCY_INCREASE_MS = 5
+# speedtest.net's randomNxN.jpg download files are about this many bytes per pixel
+DOWNLOAD_BYTES_PER_PIXEL = 2
+
+
+def limit_transfer(config: dict, download_bytes: Optional[int], upload_bytes: Optional[int]):
+    """
+    Trims the files of a speedtest.net configuration so each test transfers at most about the given bytes, while
+    always keeping at least one file
+    """
+    if download_bytes is not None:
+        sizes, total = [], 0
+        for size in config['sizes']['download']:
+            total += DOWNLOAD_BYTES_PER_PIXEL * size * size * config['counts']['download']
+            if sizes and total > download_bytes:
+                break
+            sizes.append(size)
+        config['sizes']['download'] = sizes
+    if upload_bytes is not None:
+        # Uploads send the first upload_max of each size repeated counts times, smallest first
+        chunks = [size for size in config['sizes']['upload'] for _ in range(config['counts']['upload'])]
+        count, total = 0, 0
+        for size in chunks[:config['upload_max']]:
+            total += size
+            if count and total > upload_bytes:
+                break
+            count += 1
+        config['upload_max'] = count
+
+
+class SpeedtestCache:
+    """
+    speedtest.net's configuration, the closest servers and the server selected from them, saved to a JSON file so
+    they are reused across runs and restarts. Entries older than ttl_s are treated as missing.
+    """
+
+    def __init__(self, path: Optional[str], ttl_s: float):
+        self.path = path
+        self.ttl_s = ttl_s
+        # key -> (wall clock time it was saved at, value)
+        self.entries: Dict[str, Tuple[float, object]] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = {key: tuple(entry) for key, entry in json.load(f).items()}
+            except (OSError, ValueError) as e:
+                logging.warning(f'Ignoring unreadable speedtest cache {path}: {e}')
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl_s:
+            return None
+        return copy.deepcopy(entry[1])
+
+    def put(self, key: str, value):
+        self.entries[key] = (time.time(), copy.deepcopy(value))
+
+    def invalidate(self, key: str):
+        self.entries.pop(key, None)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+
+class _CachedConfigSpeedtest(speedtest.Speedtest):
+    """
+    Starts from a cached speedtest.net configuration, when there is one, instead of downloading it
+    """
+
+    def __init__(self, config: Optional[dict]):
+        self.cached_config = config
+        super().__init__()
+
+    def get_config(self):
+        if self.cached_config is None:
+            return super().get_config()
+        self.config.update(self.cached_config)
+        self.lat_lon = (float(self.config['client']['lat']), float(self.config['client']['lon']))
+        return self.config
 
 
 class NetworkSpeedMonitor(MonitoredStat):
+    """
+    Runs a speedtest.net test. Finding the best server means fetching the full server list and pinging the closest
+    ones, so the configuration, closest servers and selected server are cached for cache_ttl. A cached server is
+    only pinged to check it is still there, and is selected again if it fails or its latency has gone up by more
+    than max_latency_increase times.
+    """
+    schemas = (SPEEDTEST_SCHEMA,)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = SpeedtestCache(Settings.network_speed_test.cache_path,
+                                    parse_refresh_rate(Settings.network_speed_test.cache_ttl))
+
     def _measure(self) -> Tuple[bool, Optional[TestResult]]:
         try:
-            speed_test_results = self._speed_test_data_from_dict(self._run_speed_test())
+            speed_test_results = self._speed_test_data_from_dict(*self._run_speed_test())
         except speedtest.SpeedtestBestServerFailure:
             logging.critical("Failed to fetch the best speedtest server! Check your internet connection")
             return False, None
+        if not speed_test_results.download_mbps or not speed_test_results.upload_mbps:
+            logging.critical(f"Speedtest against {speed_test_results.server_vendor} transferred nothing, selecting "
+                             f"a new server next time")
+            self.cache.invalidate('best')
+            self.cache.save()
+            return False, None
         logging.info(f"Download: {speed_test_results.download_mbps} Mbps,")
         logging.info(f"Upload: {speed_test_results.upload_mbps} Mbps,")
         logging.info(f"Ping: {speed_test_results.ping_ms} ms")
         logging.debug(speed_test_results)
         return True, speed_test_results
 
-    def _run_speed_test(self) -> Dict:
-        test = speedtest.Speedtest()
-        test.get_servers()
-        logging.info("Finding the best server... ")
-        test.get_best_server()
-        logging.info("Downloading...")
-        test.download()
-        logging.info("Uploading... ")
-        test.upload()
-        return test.results.dict()
-
-    def _speed_test_data_from_dict(self, results: Dict) -> SpeedTestData:
+    def _select_server(self, test: speedtest.Speedtest) -> Tuple[Dict, bool]:
+        settings = Settings.network_speed_test
+        cached = self.cache.get('best')
+        if cached is not None:
+            server = test.get_best_server([cached])
+            increase_ms = server['latency'] - cached['selected_latency']
+            if increase_ms < MIN_LATENCY_INCREASE_MS or \
+                    server['latency'] <= cached['selected_latency'] * settings.max_latency_increase:
+                return server, True
+            logging.info(f"{cached['sponsor']} latency went from {cached['selected_latency']}ms to "
+                         f"{server['latency']}ms, selecting a server again")
+        servers = self.cache.get('servers')
+        if servers is None:
+            test.get_servers()
+            servers = test.get_closest_servers(settings.closest_servers)
+            self.cache.put('servers', servers)
+        server = test.get_best_server(servers)
+        self.cache.put('best', {**server, 'selected_latency': server['latency']})
+        return server, False
+
+    def _run_speed_test(self) -> Tuple[Dict, bool, Dict[str, float]]:
+        settings = Settings.network_speed_test
+        phases_ms = {}
+        start = time.perf_counter()
+        try:
+            config = self.cache.get('config')
+            test = _CachedConfigSpeedtest(config)
+            if config is None:
+                self.cache.put('config', test.config)
+            limit_transfer(test.config, settings.download_bytes, settings.upload_bytes)
+            phases_ms['config'], start = (time.perf_counter() - start) * 1000, time.perf_counter()
+            logging.info("Finding the best server... ")
+            _, cache_hit = self._select_server(test)
+            phases_ms['select'], start = (time.perf_counter() - start) * 1000, time.perf_counter()
+            logging.info("Downloading...")
+            test.download(threads=settings.download_threads)
+            phases_ms['download'], start = (time.perf_counter() - start) * 1000, time.perf_counter()
+            logging.info("Uploading... ")
+            test.upload(threads=settings.upload_threads)
+            phases_ms['upload'] = (time.perf_counter() - start) * 1000
+        finally:
+            self.cache.save()
+        return test.results.dict(), cache_hit, phases_ms
+
+    def _speed_test_data_from_dict(self, results: Dict, cache_hit: bool, phases_ms: Dict[str, float]) -> SpeedTestData:
         return SpeedTestData(
             download_mbps=round(results['download'] / BITS_PER_S_TO_M_BITS_PER_S, 3),
             upload_mbps=round(results['upload'] / BITS_PER_S_TO_M_BITS_PER_S, 3),
@@ -47,31 +187,10 @@ class NetworkSpeedMonitor(MonitoredStat):
             server_vendor=results['server']['sponsor'],
             client_lat=results['client']['lat'],
             client_long=results['client']['lon'],
+            server_cache_hit=cache_hit,
+            config_ms=round(phases_ms['config'], 3),
+            select_ms=round(phases_ms['select'], 3),
+            download_ms=round(phases_ms['download'], 3),
+            upload_ms=round(phases_ms['upload'], 3),
         )
 
-
-class NetworkIOMonitor(MonitoredStat):
-    def _measure(self) -> Tuple[bool, Optional[TestResult]]:
-        netstats = psutil.net_io_counters(pernic=True)
-        interface_data: List[NetworkIOInterfaceStats] = []
-        for iface in Settings.network_io_monitor.interfaces:
-            if iface in netstats.keys():
-                interface_data.append(
-                    NetworkIOInterfaceStats(
-                        interface=iface,
-                        bytes_sent=netstats[iface].bytes_sent,
-                        bytes_recv=netstats[iface].bytes_recv,
-                        packets_sent=netstats[iface].packets_sent,
-                        packets_recv=netstats[iface].packets_recv,
-                        errin=netstats[iface].errin,
-                        errout=netstats[iface].errout,
-                        dropin=netstats[iface].dropin,
-                        dropout=netstats[iface].dropout,
-                    )
-                )
-            else:
-                logging.warning(f"Could not find interface {iface}")
-        results = NetworkIOData(
-            interface_data=interface_data
-        )
-        return True, results
@@ -0,0 +1,124 @@
+import logging
+import os
+import select
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from monitored_stat import MonitoredStat
+from procfs import ProcFile
+from results import PRESSURE_SCHEMA, PressureStats, PressureTestData, TestResult
+from settings import PressureTriggerSettings, Settings
+
+RESOURCES = ('cpu', 'memory', 'io')
+PRESSURE_TYPES = ('some', 'full')
+
+
+def pressure_path(resource: str, cgroup: Optional[str]) -> str:
+    return os.path.join(cgroup, f'{resource}.pressure') if cgroup else f'/proc/pressure/{resource}'
+
+
+def parse_pressure(fields: Optional[List[bytearray]]) -> Tuple[Optional[float], Optional[float], Optional[float],
+                                                               Optional[int]]:
+    """
+    Parses the avg10=0.00 avg60=0.00 avg300=0.00 total=0 after the some or full of a pressure file
+    """
+    if not fields:
+        return None, None, None, None
+    values = dict(bytes(field).split(b'=', 1) for field in fields)
+    return float(values[b'avg10']), float(values[b'avg60']), float(values[b'avg300']), int(values[b'total'])
+
+
+class PressureMonitor(MonitoredStat):
+    """
+    Reports pressure stall information (PSI) of the cpu, memory and io of the whole system and of the configured
+    cgroups. Between the periodic samples, kernel PSI triggers are watched by a thread blocked in poll(), which
+    takes a sample as soon as one fires and hands it to the executor, so short stalls are caught within
+    milliseconds without polling the files any faster.
+    """
+    schemas = (PRESSURE_SCHEMA,)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.files: Dict[Tuple[str, str], ProcFile] = {}
+        for cgroup in ['', *Settings.pressure_monitor.cgroups]:
+            for resource in RESOURCES:
+                path = pressure_path(resource, cgroup)
+                try:
+                    self.files[(resource, cgroup)] = ProcFile(path, 256)
+                except FileNotFoundError:
+                    logging.warning(f'{path} does not exist, the kernel may not have PSI enabled')
+        # Resources whose trigger fired since the last sample
+        self.fired: Set[Tuple[str, str]] = set()
+        self.poller = select.poll()
+        self.trigger_fds: Dict[int, Tuple[str, str]] = {}
+
+    def start_triggers(self, triggers: List[PressureTriggerSettings],
+                       report: Callable[[MonitoredStat, TestResult], None]):
+        for trigger in triggers:
+            path = pressure_path(trigger.resource, trigger.cgroup)
+            if trigger.resource not in RESOURCES or trigger.type not in PRESSURE_TYPES:
+                raise ValueError(f'Invalid pressure trigger {trigger}, expected a resource in {RESOURCES} and a type '
+                                 f'in {PRESSURE_TYPES}')
+            fd = None
+            try:
+                # The trigger lives as long as the file is open, see Documentation/accounting/psi.rst
+                fd = os.open(path, os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+                os.write(fd, f'{trigger.type} {trigger.stall_ms * 1000} {trigger.window_ms * 1000}\0'.encode())
+            except OSError as e:
+                # Without CAP_SYS_RESOURCE windows have to be a multiple of 2s, and system wide triggers may be refused
+                logging.error(f'Failed to register {trigger} on {path}: {e}')
+                if fd is not None:
+                    os.close(fd)
+                continue
+            self.trigger_fds[fd] = (trigger.resource, trigger.cgroup or '')
+            self.poller.register(fd, select.POLLPRI)
+        if self.trigger_fds:
+            threading.Thread(target=self._watch, args=(report,), name=f'{self.name}-triggers', daemon=True).start()
+
+    def _watch(self, report: Callable[[MonitoredStat, TestResult], None]):
+        while self.trigger_fds:
+            fired = set()
+            for fd, event in self.poller.poll():
+                if event & select.POLLERR:
+                    # The cgroup was removed
+                    logging.warning(f'Pressure trigger on {self.trigger_fds[fd]} stopped working, removing it')
+                    self.poller.unregister(fd)
+                    os.close(fd)
+                    del self.trigger_fds[fd]
+                elif event & select.POLLPRI:
+                    fired.add(self.trigger_fds[fd])
+            if not fired:
+                continue
+            with self.lock:
+                self.fired |= fired
+            try:
+                success, result = self.take_measurement()
+            except Exception:
+                logging.exception(f'Unhandled error while taking triggered {self.name} measurement')
+                continue
+            if success and result is not None:
+                report(self, result)
+
+    def _measure(self) -> Tuple[bool, Optional[TestResult]]:
+        stats = []
+        with self.lock:
+            fired, self.fired = self.fired, set()
+            for (resource, cgroup), f in self.files.items():
+                f.refresh()
+                some = parse_pressure(f.fields(b'some'))
+                full = parse_pressure(f.fields(b'full'))
+                stats.append(PressureStats(
+                    resource=resource,
+                    cgroup=cgroup,
+                    some_avg10=some[0],
+                    some_avg60=some[1],
+                    some_avg300=some[2],
+                    some_total_us=some[3],
+                    full_avg10=full[0],
+                    full_avg60=full[1],
+                    full_avg300=full[2],
+                    full_total_us=full[3],
+                    triggered=(resource, cgroup) in fired,
+                ))
+        return True, PressureTestData(pressure=stats)
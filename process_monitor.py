@@ -0,0 +1,267 @@
+import bisect
+import heapq
+import logging
+import os
+import resource
+import time
+from typing import Dict, List, Optional, Tuple
+
+from monitored_stat import MonitoredStat
+from procfs import ProcFile, read_file
+from results import CGROUP_SCHEMA, PROCESS_SCAN_SCHEMA, PROCESS_SCHEMA, CgroupStats, ProcessStats, ProcessTestData, \
+    TestResult
+from settings import Settings
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+MAX_CMDLINE_LENGTH = 256
+# File descriptors left for everything else in the agent when caching /proc/<pid> handles
+FD_HEADROOM = 256
+# How many processes are sampled between checks of the scan's CPU time
+BUDGET_CHECK_INTERVAL = 64
+# Columns of /proc/<pid>/stat after the command name, which starts at column 3
+UTIME, STIME, STARTTIME, RSS = 11, 12, 19, 21
+
+RANKINGS = {
+    'cpu': lambda p: p.cpu_percent or 0.0,
+    'rss': lambda p: p.rss_bytes,
+    'io': lambda p: (p.read_bytes_per_s or 0.0) + (p.write_bytes_per_s or 0.0),
+}
+
+
+def parse_cgroup(contents: bytes) -> str:
+    """
+    Returns the unified (v2) cgroup of a process, or its cpu controller cgroup on a v1 only host
+    """
+    fallback = ''
+    for line in contents.decode(errors='replace').splitlines():
+        hierarchy, controllers, path = line.split(':', 2)
+        if hierarchy == '0' and not controllers:
+            return path
+        if 'cpu' in controllers.split(','):
+            fallback = path
+    return fallback
+
+
+def parse_io(contents: bytes) -> Tuple[int, int]:
+    read_bytes = write_bytes = 0
+    for line in contents.split(b'\n'):
+        if line.startswith(b'read_bytes: '):
+            read_bytes = int(line[12:])
+        elif line.startswith(b'write_bytes: '):
+            write_bytes = int(line[13:])
+    return read_bytes, write_bytes
+
+
+class _Process:
+    __slots__ = ('pid', 'stat', 'io', 'has_io', 'start_time', 'name', 'cmdline', 'exe', 'cgroup', 'sampled_ns',
+                 'cpu_ticks', 'io_bytes', 'cpu_percent', 'rss_bytes', 'read_bytes_per_s', 'write_bytes_per_s')
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.stat: Optional[ProcFile] = None
+        self.io: Optional[ProcFile] = None
+        self.has_io = True
+        self.start_time: Optional[int] = None
+        self.name = ''
+        self.cmdline = ''
+        self.exe = ''
+        self.cgroup = ''
+        self.sampled_ns = 0
+        self.cpu_ticks = 0
+        self.io_bytes: Tuple[int, int] = (0, 0)
+        self.cpu_percent: Optional[float] = None
+        self.rss_bytes = 0
+        self.read_bytes_per_s: Optional[float] = None
+        self.write_bytes_per_s: Optional[float] = None
+
+    def to_stats(self) -> ProcessStats:
+        return ProcessStats(
+            pid=self.pid,
+            name=self.name,
+            cmdline=self.cmdline,
+            exe=self.exe,
+            cgroup=self.cgroup,
+            cpu_percent=self.cpu_percent,
+            rss_bytes=self.rss_bytes,
+            read_bytes_per_s=self.read_bytes_per_s,
+            write_bytes_per_s=self.write_bytes_per_s,
+        )
+
+
+class ProcessMonitor(MonitoredStat):
+    """
+    Reports the top processes by CPU, RSS and IO, and totals per cgroup. Processes are tracked across scans, so the
+    command line, executable and cgroup of a process are only read once, and its stat and io files stay open (up to
+    max_open_files) and are re-read with pread. A scan stops sampling once it has used scan_budget_ms of CPU time and
+    the next scan carries on from where it stopped, with the remaining processes keeping their previous values.
+    """
+    schemas = (PROCESS_SCHEMA, CGROUP_SCHEMA, PROCESS_SCAN_SCHEMA)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.top_n = Settings.process_monitor.top_n
+        self.scan_budget_s = Settings.process_monitor.scan_budget_ms / 1000
+        self.max_open_files = self._reserve_open_files(Settings.process_monitor.max_open_files)
+        self.open_files = 0
+        self.processes: Dict[int, _Process] = {}
+        # The pid a truncated scan stopped at
+        self.resume_pid = 0
+
+    @staticmethod
+    def _reserve_open_files(wanted: int) -> int:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < wanted + FD_HEADROOM:
+            soft = wanted + FD_HEADROOM if hard == resource.RLIM_INFINITY else min(wanted + FD_HEADROOM, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        if soft == resource.RLIM_INFINITY:
+            return wanted
+        return max(min(wanted, soft - FD_HEADROOM), 0)
+
+    def _open(self, path: str, buffer_size: int) -> Optional[ProcFile]:
+        if self.open_files >= self.max_open_files:
+            return None
+        f = ProcFile(path, buffer_size)
+        self.open_files += 1
+        return f
+
+    def _track(self, pid: int) -> _Process:
+        # Tracked before anything is opened so _forget closes whatever was if the process exits part way through
+        proc = self.processes[pid] = _Process(pid)
+        proc.stat = self._open(f'/proc/{pid}/stat', 512)
+        try:
+            proc.io = self._open(f'/proc/{pid}/io', 256)
+        except PermissionError:
+            proc.has_io = False
+        try:
+            proc.cmdline = read_file(f'/proc/{pid}/cmdline').replace(b'\0', b' ').strip()[:MAX_CMDLINE_LENGTH] \
+                .decode(errors='replace')
+            proc.exe = os.readlink(f'/proc/{pid}/exe')
+        except OSError:
+            # Kernel threads have no command line or executable, and other users' executables are not readable
+            pass
+        proc.cgroup = parse_cgroup(read_file(f'/proc/{pid}/cgroup'))
+        return proc
+
+    def _forget(self, pid: int):
+        proc = self.processes.pop(pid, None)
+        if proc is None:
+            return
+        for f in (proc.stat, proc.io):
+            if f is not None:
+                f.close()
+                self.open_files -= 1
+
+    @staticmethod
+    def _read(f: Optional[ProcFile], path: str) -> bytes:
+        if f is None:
+            return read_file(path)
+        f.refresh()
+        return f.contents()
+
+    def _sample(self, proc: _Process, now_ns: int) -> bool:
+        """
+        Updates a process from its stat and io files. Returns False if its pid now belongs to a different process
+        """
+        stat = self._read(proc.stat, f'/proc/{proc.pid}/stat')
+        name_end = stat.rindex(b')')
+        fields = stat[name_end + 2:].split()
+        start_time = int(fields[STARTTIME])
+        if proc.start_time is None:
+            proc.start_time = start_time
+            proc.name = stat[stat.index(b'(') + 1:name_end].decode(errors='replace')
+        elif start_time != proc.start_time:
+            return False
+
+        cpu_ticks = int(fields[UTIME]) + int(fields[STIME])
+        io_bytes = proc.io_bytes
+        if proc.has_io:
+            try:
+                io_bytes = parse_io(self._read(proc.io, f'/proc/{proc.pid}/io'))
+            except PermissionError:
+                proc.has_io = False
+
+        if proc.sampled_ns:
+            elapsed_s = (now_ns - proc.sampled_ns) / 1e9
+            proc.cpu_percent = round((cpu_ticks - proc.cpu_ticks) / CLOCK_TICKS / elapsed_s * 100, 2)
+            if proc.has_io:
+                proc.read_bytes_per_s = round((io_bytes[0] - proc.io_bytes[0]) / elapsed_s, 3)
+                proc.write_bytes_per_s = round((io_bytes[1] - proc.io_bytes[1]) / elapsed_s, 3)
+        proc.sampled_ns = now_ns
+        proc.cpu_ticks = cpu_ticks
+        proc.io_bytes = io_bytes
+        proc.rss_bytes = int(fields[RSS]) * PAGE_SIZE
+        return True
+
+    def _scan(self, started_s: float) -> Tuple[int, int, bool]:
+        pids = sorted(int(name) for name in os.listdir('/proc') if name.isdigit())
+        for pid in self.processes.keys() - set(pids):
+            self._forget(pid)
+
+        # Carry on from where a truncated scan stopped so every process is eventually sampled
+        start = bisect.bisect_left(pids, self.resume_pid)
+        order = pids[start:] + pids[:start]
+        self.resume_pid = 0
+        scanned = 0
+        for pid in order:
+            if scanned % BUDGET_CHECK_INTERVAL == 0 and scanned and \
+                    time.thread_time() - started_s > self.scan_budget_s:
+                self.resume_pid = pid
+                return len(pids), scanned, True
+            scanned += 1
+            now_ns = time.monotonic_ns()
+            try:
+                proc = self.processes.get(pid)
+                if proc is None:
+                    proc = self._track(pid)
+                if not self._sample(proc, now_ns):
+                    self._forget(pid)
+                    proc = self._track(pid)
+                    self._sample(proc, now_ns)
+            except (OSError, ValueError, IndexError):
+                # The process exited while it was being read
+                self._forget(pid)
+        return len(pids), scanned, False
+
+    def _cgroup_stats(self) -> List[CgroupStats]:
+        totals: Dict[str, List] = {}
+        for proc in self.processes.values():
+            total = totals.get(proc.cgroup)
+            if total is None:
+                total = totals[proc.cgroup] = [0, 0.0, 0, 0.0, 0.0]
+            total[0] += 1
+            total[1] += proc.cpu_percent or 0.0
+            total[2] += proc.rss_bytes
+            total[3] += proc.read_bytes_per_s or 0.0
+            total[4] += proc.write_bytes_per_s or 0.0
+        return [
+            CgroupStats(
+                cgroup=cgroup or '/',
+                num_processes=num_processes,
+                cpu_percent=round(cpu_percent, 2),
+                rss_bytes=rss_bytes,
+                read_bytes_per_s=round(read_bytes_per_s, 3),
+                write_bytes_per_s=round(write_bytes_per_s, 3),
+            )
+            for cgroup, (num_processes, cpu_percent, rss_bytes, read_bytes_per_s, write_bytes_per_s) in totals.items()
+        ]
+
+    def _measure(self) -> Tuple[bool, Optional[TestResult]]:
+        started_s = time.thread_time()
+        pids_total, pids_scanned, truncated = self._scan(started_s)
+        if truncated:
+            logging.warning(f'{self.name} used its {self.scan_budget_s * 1000:.0f}ms CPU budget after sampling '
+                            f'{pids_scanned} of {pids_total} processes')
+        top_processes = {
+            ranking: [p.to_stats() for p in heapq.nlargest(self.top_n, self.processes.values(), key=key)]
+            for ranking, key in RANKINGS.items()
+        }
+        cgroup_stats = self._cgroup_stats()
+        return True, ProcessTestData(
+            top_processes=top_processes,
+            cgroup_stats=cgroup_stats,
+            pids_total=pids_total,
+            pids_scanned=pids_scanned,
+            scan_cpu_ms=round((time.thread_time() - started_s) * 1000, 3),
+            scan_truncated=truncated,
+        )
@@ -0,0 +1,82 @@
+import os
+from typing import Dict, List, Optional
+
+INITIAL_BUFFER_SIZE = 16 * 1024
+
+
+def read_file(path: str) -> bytes:
+    """
+    Reads a procfs file without keeping it open, for files read too rarely or too many to be worth a ProcFile
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, INITIAL_BUFFER_SIZE)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+
+
+class ProcFile:
+    """
+    Keeps a procfs file open and re-reads it with pread into a reusable buffer. Lines are looked up by a needle,
+    e.g. b'MemTotal:' or b'sda ', that must start the line or follow whitespace. The offset each needle was found
+    at is remembered and checked first on the next read, so a line is only searched for again when the lines before
+    it changed length.
+    """
+
+    def __init__(self, path: str, buffer_size: int = INITIAL_BUFFER_SIZE):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self.buffer = bytearray(buffer_size)
+        self.size = 0
+        self.offsets: Dict[bytes, int] = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def refresh(self):
+        size = 0
+        while True:
+            if size == len(self.buffer):
+                self.buffer.extend(bytes(len(self.buffer)))
+            n = os.preadv(self.fd, [memoryview(self.buffer)[size:]], size)
+            if n == 0:
+                break
+            size += n
+        self.size = size
+
+    def contents(self) -> bytes:
+        return bytes(memoryview(self.buffer)[:self.size])
+
+    def _matches(self, needle: bytes, offset: int) -> bool:
+        return self.buffer.startswith(needle, offset, self.size) and \
+            (offset == 0 or self.buffer[offset - 1] in b' \n')
+
+    def _find(self, needle: bytes) -> Optional[int]:
+        offset = self.buffer.find(needle, 0, self.size)
+        while offset != -1 and not self._matches(needle, offset):
+            offset = self.buffer.find(needle, offset + 1, self.size)
+        return offset if offset != -1 else None
+
+    def fields(self, needle: bytes) -> Optional[List[bytearray]]:
+        """
+        Returns the whitespace separated fields following the needle on its line, or None if it is not in the file
+        """
+        offset = self.offsets.get(needle)
+        if offset is None or not self._matches(needle, offset):
+            offset = self._find(needle)
+            if offset is None:
+                self.offsets.pop(needle, None)
+                return None
+            self.offsets[needle] = offset
+        start = offset + len(needle)
+        end = self.buffer.find(b'\n', start, self.size)
+        return self.buffer[start:end if end != -1 else self.size].split()
+
+    def int_field(self, needle: bytes, default: int = 0) -> int:
+        fields = self.fields(needle)
+        return int(fields[0]) if fields else default
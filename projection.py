@@ -0,0 +1,121 @@
+from typing import Dict, Iterable, List, Optional, Set
+
+from line_protocol import PointSchema, Row
+from settings import Settings
+
+
+class Projection:
+    """
+    The fields of one schema that are collected and sent, from its measurement's include or exclude list in the
+    fields settings. Collectors check wants() before reading a source that only some fields come from, and rows are
+    narrowed to a schema of just the selected fields, so the others are neither serialized nor stored. Rates are only
+    derived from selected counters.
+    """
+    __slots__ = ('schema', 'indices', 'selected')
+
+    def __init__(self, schema: PointSchema, selected: Iterable[str]):
+        self.selected = frozenset(selected)
+        # None when every field is selected, and rows are passed through as they are
+        self.indices: Optional[List[int]] = None
+        self.schema = schema
+        if len(self.selected) < len(schema.fields):
+            self.indices = [i for i, (key, _) in enumerate(schema.fields) if key in self.selected]
+            self.schema = PointSchema(
+                schema._measurement,
+                schema.tag_keys,
+                [schema.fields[i] for i in self.indices],
+                [c for c in schema.counters if c.field in self.selected],
+                schema.high_cardinality_tags,
+            )
+
+    @classmethod
+    def compile(cls, schema: PointSchema, selection: Optional[dict]) -> 'Projection':
+        # Names of fields of other schemas with the same measurement are left for those schemas
+        if not selection:
+            return cls(schema, schema.field_keys)
+        if 'include' in selection:
+            return cls(schema, [key for key in schema.field_keys if key in selection['include']])
+        return cls(schema, [key for key in schema.field_keys if key not in selection['exclude']])
+
+    def wants(self, *keys: str) -> bool:
+        """
+        Returns whether any of the fields is selected
+        """
+        return not self.selected.isdisjoint(keys)
+
+
+class FieldProjections:
+    """
+    The projection of every schema rows are built with, compiled from the settings the first time each schema is
+    seen: when a monitor declaring it is created (see check()), or otherwise when its first rows are projected
+    """
+
+    def __init__(self):
+        self._settings = None
+        self._plans: Dict[PointSchema, Projection] = {}
+        # Measurements of the schemas passed to check()
+        self._checked: Set[str] = set()
+
+    def _reset_if_reloaded(self):
+        if Settings.fields is not self._settings:
+            # Settings were (re)loaded since the plans were compiled
+            self._settings = Settings.fields
+            self._plans = {}
+            self._checked = set()
+
+    def plan(self, schema: PointSchema) -> Projection:
+        self._reset_if_reloaded()
+        plan = self._plans.get(schema)
+        if plan is None:
+            selection = Settings.fields.measurements.get(schema.measurement)
+            plan = self._plans[schema] = Projection.compile(schema, selection)
+        return plan
+
+    def check(self, schemas: Iterable[PointSchema]):
+        """
+        Compiles the projections of a monitor's schemas, and raises a ValueError if the fields settings of their
+        measurements name fields none of them have
+        """
+        self._reset_if_reloaded()
+        keys: Dict[str, List[str]] = {}
+        for schema in schemas:
+            self.plan(schema)
+            keys.setdefault(schema.measurement, []).extend(schema.field_keys)
+        self._checked.update(keys)
+        for measurement, measurement_keys in keys.items():
+            selection = Settings.fields.measurements.get(measurement)
+            if not selection:
+                continue
+            unknown = [key for key in selection.get('include', selection.get('exclude')) if key not in measurement_keys]
+            if unknown:
+                raise ValueError(f'fields.{measurement}: unknown field {", ".join(unknown)}, expected one of '
+                                 f'{", ".join(measurement_keys)}')
+
+    def check_measurements(self):
+        """
+        Raises a ValueError if the fields settings name measurements that none of the checked schemas have, e.g.
+        misspelled or of a disabled monitor. Called once every monitor has been created.
+        """
+        self._reset_if_reloaded()
+        unknown = [measurement for measurement in Settings.fields.measurements if measurement not in self._checked]
+        if unknown:
+            raise ValueError(f'fields: no enabled monitor sends {", ".join(unknown)}, expected one of '
+                             f'{", ".join(sorted(self._checked))}')
+
+    def project(self, rows: Iterable[Row]) -> List[Row]:
+        """
+        Narrows each row to its schema's selected fields, dropping rows with none
+        """
+        projected = []
+        for row in rows:
+            plan = self.plan(row[0])
+            indices = plan.indices
+            if indices is None:
+                projected.append(row)
+            elif indices:
+                field_values = row[2]
+                projected.append((plan.schema, row[1], tuple([field_values[i] for i in indices])))
+        return projected
+
+
+Projections = FieldProjections()
@@ -0,0 +1,96 @@
+import logging
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from line_protocol import PointSchema, Row
+
+RATE_MODES = ('alongside', 'instead', 'off')
+
+
+class Counter(NamedTuple):
+    field: str
+    rate_field: str
+    # Multiplier applied to the per-second rate, e.g. 0.1 turns busy milliseconds per second into a percentage
+    scale: float = 1.0
+    # Width of the counter in the kernel, used to tell a wrap from a reset
+    bits: int = 64
+
+
+def _wrapped_delta(prev: int, cur: int, bits: int) -> Optional[int]:
+    """
+    Returns the increase of a counter that went backwards if it looks like it wrapped, or None if it was reset
+    """
+    limit = 1 << bits
+    if prev >= limit * 3 // 4 and cur < limit // 4:
+        return cur + limit - prev
+    return None
+
+
+class _DerivedSchema:
+    __slots__ = ('schema', 'kept_fields', 'counter_fields', 'counters')
+
+    def __init__(self, base: PointSchema, counters: Tuple[Counter, ...], mode: str):
+        counter_keys = {c.field for c in counters}
+        base_keys = base.field_keys
+        self.kept_fields = [i for i, key in enumerate(base_keys) if mode == 'alongside' or key not in counter_keys]
+        self.counter_fields = [base_keys.index(c.field) for c in counters]
+        self.counters = counters
+        self.schema = PointSchema(
+            base._measurement,
+            base.tag_keys,
+            [base.fields[i] for i in self.kept_fields] + [(c.rate_field, float) for c in counters],
+            counters=counters if mode == 'alongside' else (),
+            high_cardinality_tags=base.high_cardinality_tags,
+        )
+
+
+class RateDeriver:
+    """
+    Turns cumulative counters into per-second rates using the previous sample of the same series and the monotonic
+    time both were taken at. The first sample of a series and a sample after a counter reset have no rate.
+    """
+
+    def __init__(self, mode: str = 'alongside'):
+        if mode not in RATE_MODES:
+            raise ValueError(f"Invalid rate mode {mode}, expected one of {RATE_MODES}")
+        self.mode = mode
+        self._derived: Dict[PointSchema, _DerivedSchema] = {}
+        self._prev: Dict[Tuple[PointSchema, Tuple], Tuple[int, List[int]]] = {}
+
+    def _derived_schema(self, schema: PointSchema) -> _DerivedSchema:
+        derived = self._derived.get(schema)
+        if derived is None:
+            derived = self._derived[schema] = _DerivedSchema(schema, schema.counters, self.mode)
+        return derived
+
+    def _rate(self, counter: Counter, prev: Optional[int], cur: Optional[int], elapsed_s: float) -> Optional[float]:
+        if prev is None or cur is None:
+            return None
+        delta = cur - prev
+        if delta < 0:
+            delta = _wrapped_delta(prev, cur, counter.bits)
+            if delta is None:
+                logging.info(f'{counter.field} went from {prev} to {cur}, assuming the counter was reset')
+                return None
+        return round(delta / elapsed_s * counter.scale, 3)
+
+    def derive(self, rows: Iterable[Row], monotonic_ns: int) -> List[Row]:
+        if self.mode == 'off':
+            return list(rows)
+        derived_rows = []
+        for schema, tag_values, field_values in rows:
+            if not schema.counters:
+                derived_rows.append((schema, tag_values, field_values))
+                continue
+            derived = self._derived_schema(schema)
+            counter_values = [field_values[i] for i in derived.counter_fields]
+            series = (schema, tag_values)
+            prev = self._prev.get(series)
+            self._prev[series] = (monotonic_ns, counter_values)
+
+            if prev is None or monotonic_ns <= prev[0]:
+                rates = [None] * len(derived.counters)
+            else:
+                elapsed_s = (monotonic_ns - prev[0]) / 1e9
+                rates = [self._rate(c, p, v, elapsed_s) for c, p, v in zip(derived.counters, prev[1], counter_values)]
+            derived_rows.append((derived.schema, tag_values, (*[field_values[i] for i in derived.kept_fields], *rates)))
+        return derived_rows
@@ -0,0 +1,252 @@
+import logging
+import os
+import select
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from typing import Deque, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+from settings import Settings
+
+RECV_BYTES = 65536
+UDP_RECV_BUFFER_BYTES = 8 * 1024 * 1024
+STATS_INTERVAL_S = 60
+
+
+def parse_address(address: str) -> Tuple[str, object]:
+    """
+    Splits tcp://host:port, udp://host:port or unix:///path into the scheme and a socket address
+    """
+    url = urlparse(address)
+    if url.scheme == 'unix':
+        return url.scheme, url.path
+    if url.scheme not in ('tcp', 'udp') or url.port is None:
+        raise ValueError(f"Invalid relay address {address}, expected tcp://host:port, udp://host:port or unix:///path")
+    return url.scheme, (url.hostname, url.port)
+
+
+class RelayClient:
+    """
+    Sends line protocol to a relay instead of InfluxDB. Over TCP and Unix sockets a batch that fails part way through
+    is sent again in full on a new connection, and the relay drops the lines it already had. A connection the relay
+    has closed, e.g. when it restarted, still accepts sends, so it is checked before each batch and replaced. Over UDP
+    batches are split into datagrams of at most max_datagram_bytes and not retried.
+    """
+
+    def __init__(self, address: str, timeout_s: float, max_datagram_bytes: int = 8192):
+        self.address = address
+        self.scheme, self.sockaddr = parse_address(address)
+        self.timeout_s = timeout_s
+        self.max_datagram_bytes = max_datagram_bytes
+        self.sock: Optional[socket.socket] = None
+        self.lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        if self.sock is None:
+            if self.scheme == 'unix':
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout_s)
+                self.sock.connect(self.sockaddr)
+            elif self.scheme == 'tcp':
+                self.sock = socket.create_connection(self.sockaddr, timeout=self.timeout_s)
+            else:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        return self.sock
+
+    def _peer_closed(self) -> bool:
+        # The relay never sends anything, so a readable socket has reached EOF or failed
+        if self.sock is None or self.scheme == 'udp' or not select.select([self.sock], [], [], 0)[0]:
+            return False
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def _reconnect_if_closed(self) -> socket.socket:
+        if self._peer_closed():
+            logging.info(f'Relay at {self.address} closed the connection, reconnecting')
+            self._disconnect()
+        return self._connect()
+
+    def _disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def close(self):
+        with self.lock:
+            self._disconnect()
+
+    def has_good_connection(self) -> bool:
+        with self.lock:
+            try:
+                self._reconnect_if_closed()
+            except OSError as e:
+                logging.error(f'Failed to connect to relay at {self.address}: {e}')
+                self._disconnect()
+                return False
+        return True
+
+    def _send_datagrams(self, lines: List[bytes]):
+        sock = self._connect()
+        datagram = bytearray()
+        for line in lines:
+            if datagram and len(datagram) + len(line) + 1 > self.max_datagram_bytes:
+                sock.sendto(datagram, self.sockaddr)
+                datagram = bytearray()
+            datagram += line + b'\n'
+        if datagram:
+            sock.sendto(datagram, self.sockaddr)
+
+    def write(self, lines: List[bytes]):
+        with self.lock:
+            if self.scheme == 'udp':
+                self._send_datagrams(lines)
+                return
+            body = b'\n'.join(lines) + b'\n'
+            try:
+                self._reconnect_if_closed().sendall(body)
+            except OSError:
+                logging.warning(f'Lost connection to relay at {self.address}, resending {len(lines)} lines')
+                self._disconnect()
+                try:
+                    self._connect().sendall(body)
+                except OSError:
+                    self._disconnect()
+                    raise
+
+
+class Deduplicator:
+    """
+    Remembers the last `window` lines seen, by hash, and filters out repeats of them
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self.seen: Set[int] = set()
+        self.order: Deque[int] = deque()
+
+    def filter(self, lines: List[bytes]) -> List[bytes]:
+        new = []
+        for line in lines:
+            key = hash(line)
+            if key in self.seen:
+                continue
+            self.seen.add(key)
+            self.order.append(key)
+            if len(self.order) > self.window:
+                self.seen.discard(self.order.popleft())
+            new.append(line)
+        return new
+
+
+class Relay:
+    """
+    Accepts line protocol from agents over TCP, UDP and Unix sockets, drops lines that were already received, and
+    queues the rest on `put`, e.g. an InfluxDBConnection's batch writer, which merges them into large batches.
+    """
+
+    def __init__(self, listen: List[str], put, dedup_window: int):
+        self.put = put
+        self.dedup = Deduplicator(dedup_window)
+        self.lock = threading.Lock()
+        self.lines_received = 0
+        self.lines_duplicate = 0
+        self.servers: List[socketserver.BaseServer] = []
+        for address in listen:
+            self.servers.append(self._server(address))
+
+    def receive(self, lines: List[bytes]):
+        lines = [line for line in lines if line]
+        with self.lock:
+            new = self.dedup.filter(lines)
+            self.lines_received += len(lines)
+            self.lines_duplicate += len(lines) - len(new)
+        if new:
+            self.put(new)
+
+    def _server(self, address: str) -> socketserver.BaseServer:
+        relay = self
+
+        class StreamHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                pending = b''
+                while True:
+                    data = self.request.recv(RECV_BYTES)
+                    if not data:
+                        # A partial last line is the start of a batch the agent will send again in full
+                        return
+                    lines = (pending + data).split(b'\n')
+                    pending = lines.pop()
+                    relay.receive(lines)
+
+        class DatagramHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                relay.receive(self.request[0].split(b'\n'))
+
+        scheme, sockaddr = parse_address(address)
+        if scheme == 'tcp':
+            server = socketserver.ThreadingTCPServer(sockaddr, StreamHandler, bind_and_activate=False)
+            server.allow_reuse_address = True
+            server.server_bind()
+            server.server_activate()
+        elif scheme == 'unix':
+            if os.path.exists(sockaddr):
+                os.unlink(sockaddr)
+            server = socketserver.ThreadingUnixStreamServer(sockaddr, StreamHandler)
+        else:
+            server = socketserver.UDPServer(sockaddr, DatagramHandler)
+            server.max_packet_size = RECV_BYTES
+            # Agents flush in bursts, and datagrams that don't fit in the buffer are lost
+            server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECV_BUFFER_BYTES)
+        server.daemon_threads = True
+        return server
+
+    def start(self):
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, name='relay-listener', daemon=True).start()
+
+    def close(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+            if isinstance(server, socketserver.UnixStreamServer):
+                os.unlink(server.server_address)
+
+
+def main():
+    from influx_db import InfluxDBConnection
+
+    logging.getLogger().setLevel(logging.INFO)
+    Settings.load_settings(sys.argv[1] if len(sys.argv) > 1 else 'settings.yaml')
+    if Settings.relay.address:
+        raise ValueError('relay.address sends to another relay, remove it to run this host as a relay')
+    if not Settings.relay.listen:
+        raise ValueError('relay.listen must list at least one address to accept agents on')
+
+    conn = InfluxDBConnection()
+    conn.wait_for_good_connection()
+    conn.connect()
+    relay = Relay(Settings.relay.listen, conn.batch_writer.put, Settings.relay.dedup_window)
+    relay.start()
+    logging.info(f'Relaying {", ".join(Settings.relay.listen)} to {conn.url}')
+    try:
+        while True:
+            time.sleep(STATS_INTERVAL_S)
+            logging.info(f'Relay received {relay.lines_received} lines, {relay.lines_duplicate} duplicates. '
+                         f'Write stats: {conn.batch_writer.stats}')
+    except KeyboardInterrupt:
+        logging.info('Caught KeyboardInterrupt. Exiting')
+    finally:
+        relay.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
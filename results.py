@@ -0,0 +1,489 @@
+import itertools
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from batch_writer import WriteStats
+from columns import Columns
+from deadband import DeadbandStats
+from instrumentation import AgentResources, HistogramSnapshot, LATENCY_BUCKETS_MS, SIZE_BUCKETS_BYTES
+from line_protocol import PointSchema, Row
+from projection import Projections
+from rates import Counter
+from settings import Settings
+
+
+@dataclass(frozen=True)
+class TestResult:
+    timestamp_ns: int = field(default=0, kw_only=True)
+    monotonic_ns: int = field(default=0, kw_only=True)
+
+    def rows(self) -> Iterable[Row]:
+        raise NotImplementedError("All test data must implement rows()")
+
+
+RAM_SCHEMA = PointSchema(lambda: Settings.memory_monitor.ram_measurement, (), (
+    ('ram_total_bytes', int),
+    ('ram_available_bytes', int),
+    ('ram_available_percent', float),
+    ('ram_used_bytes', int),
+    ('ram_free_bytes', int),
+    ('ram_active_bytes', int),
+    ('ram_inactive_bytes', int),
+    ('ram_buffers_bytes', int),
+    ('ram_cached_bytes', int),
+    ('ram_shared_bytes', int),
+    ('ram_slab_bytes', int),
+))
+SWAP_SCHEMA = PointSchema(lambda: Settings.memory_monitor.swap_measurement, (), (
+    ('swap_total_bytes', int),
+    ('swap_used_bytes', int),
+    ('swap_free_bytes', int),
+    ('swap_used_percent', float),
+    ('swap_in_total_bytes', int),
+    ('swap_out_total_bytes', int),
+), counters=(
+    Counter('swap_in_total_bytes', 'swap_in_bytes_per_s'),
+    Counter('swap_out_total_bytes', 'swap_out_bytes_per_s'),
+))
+
+
+@dataclass(frozen=True)
+class MemoryTestData(TestResult):
+    ram_total_bytes: int
+    ram_available_bytes: int
+    ram_available_percent: float
+    ram_used_bytes: int
+    ram_free_bytes: int
+    ram_active_bytes: int
+    ram_inactive_bytes: int
+    ram_buffers_bytes: int
+    ram_cached_bytes: int
+    ram_shared_bytes: int
+    ram_slab_bytes: int
+    swap_total_bytes: Optional[int]
+    swap_used_bytes: Optional[int]
+    swap_free_bytes: Optional[int]
+    swap_used_percent: Optional[float]
+    swap_in_total_bytes: Optional[int]
+    swap_out_total_bytes: Optional[int]
+
+    def rows(self) -> Iterable[Row]:
+        rows = [(RAM_SCHEMA, (), (
+            self.ram_total_bytes,
+            self.ram_available_bytes,
+            self.ram_available_percent,
+            self.ram_used_bytes,
+            self.ram_free_bytes,
+            self.ram_active_bytes,
+            self.ram_inactive_bytes,
+            self.ram_buffers_bytes,
+            self.ram_cached_bytes,
+            self.ram_shared_bytes,
+            self.ram_slab_bytes,
+        ))]
+        # Swap is None when none of its fields are selected, and 0 without a swap device
+        if self.swap_total_bytes:
+            rows.append((SWAP_SCHEMA, (), (
+                self.swap_total_bytes,
+                self.swap_used_bytes,
+                self.swap_free_bytes,
+                self.swap_used_percent,
+                self.swap_in_total_bytes,
+                self.swap_out_total_bytes,
+            )))
+        return Projections.project(rows)
+
+
+CPU_CORE_SCHEMA = PointSchema(lambda: Settings.cpu_monitor.measurement, ('core',), (
+    ('utilization-percent', float),
+    ('user-percent', float),
+    ('system-percent', float),
+    ('iowait-percent', float),
+    ('irq-percent', float),
+    ('steal-percent', float),
+    ('freq-mhz', float),
+))
+CPU_SCHEMA = PointSchema(lambda: Settings.cpu_monitor.measurement, (), (
+    ('context_switches', int),
+    ('interrupts', int),
+    ('software_interrupts', int),
+    ('load_avg_1m_percent', float),
+    ('load_avg_5m_percent', float),
+    ('load_avg_15m_percent', float),
+), counters=(
+    Counter('context_switches', 'context_switches_per_s'),
+    Counter('interrupts', 'interrupts_per_s'),
+    Counter('software_interrupts', 'software_interrupts_per_s'),
+))
+
+
+@dataclass(frozen=True)
+class CPUTestData(TestResult):
+    # One CPU_CORE_SCHEMA point per core, tagged by its index
+    cores: Columns
+    load_avg_1m_percent: Optional[float]
+    load_avg_5m_percent: Optional[float]
+    load_avg_15m_percent: Optional[float]
+    num_context_switches: int
+    num_interrupts: int
+    num_software_interrupts: int
+
+    def rows(self) -> Iterable[Row]:
+        rows = self.cores.rows()
+        rows.extend(Projections.project([(CPU_SCHEMA, (), (
+            self.num_context_switches,
+            self.num_interrupts,
+            self.num_software_interrupts,
+            self.load_avg_1m_percent,
+            self.load_avg_5m_percent,
+            self.load_avg_15m_percent,
+        ))]))
+        return rows
+
+
+SPEEDTEST_SCHEMA = PointSchema(
+    lambda: Settings.network_speed_test.measurement,
+    ('server_city', 'server_country', 'server_vendor', 'server_lat', 'server_long', 'client_lat', 'client_long'),
+    (('download-mbps', float), ('upload-mbps', float), ('ping-ms', float), ('server-cache-hit', bool),
+     ('config-ms', float), ('select-ms', float), ('download-ms', float), ('upload-ms', float)),
+    # A new series for every server and client location
+    high_cardinality_tags=(('server_lat', float), ('server_long', float), ('client_lat', float),
+                           ('client_long', float)),
+)
+
+
+@dataclass(frozen=True)
+class SpeedTestData(TestResult):
+    download_mbps: float
+    upload_mbps: float
+    ping_ms: float
+    server_lat: float
+    server_long: float
+    server_city: str
+    server_country: str
+    server_vendor: str
+    client_lat: float
+    client_long: float
+    # Whether the server was the cached one, rather than selected by pinging the closest servers
+    server_cache_hit: bool
+    # Time spent getting the configuration, selecting the server, downloading and uploading
+    config_ms: float
+    select_ms: float
+    download_ms: float
+    upload_ms: float
+
+    def rows(self) -> Iterable[Row]:
+        tags = (self.server_city, self.server_country, self.server_vendor, self.server_lat, self.server_long,
+                self.client_lat, self.client_long)
+        return Projections.project([(SPEEDTEST_SCHEMA, tags, (
+            self.download_mbps, self.upload_mbps, self.ping_ms, self.server_cache_hit,
+            self.config_ms, self.select_ms, self.download_ms, self.upload_ms,
+        ))])
+
+
+NETWORK_IO_SCHEMA = PointSchema(lambda: Settings.network_io_monitor.measurement, ('interface',), (
+    ('bytes_sent', int),
+    ('bytes_recv', int),
+    ('packets_sent', int),
+    ('packets_recv', int),
+    ('errors_incoming', int),
+    ('errors_outgoing', int),
+    ('packets_dropped_incoming', int),
+    ('packets_dropped_outgoing', int),
+), counters=(
+    Counter('bytes_sent', 'bytes_sent_per_s'),
+    Counter('bytes_recv', 'bytes_recv_per_s'),
+    Counter('packets_sent', 'packets_sent_per_s'),
+    Counter('packets_recv', 'packets_recv_per_s'),
+    Counter('errors_incoming', 'errors_incoming_per_s'),
+    Counter('errors_outgoing', 'errors_outgoing_per_s'),
+    Counter('packets_dropped_incoming', 'packets_dropped_incoming_per_s'),
+    Counter('packets_dropped_outgoing', 'packets_dropped_outgoing_per_s'),
+))
+
+
+@dataclass(frozen=True)
+class NetworkIOData(TestResult):
+    # One NETWORK_IO_SCHEMA point per interface
+    interfaces: Columns
+
+    def rows(self) -> Iterable[Row]:
+        return self.interfaces.rows()
+
+
+DISK_SCHEMA = PointSchema(lambda: Settings.disk_monitor.measurement, ('directory', 'device'), (
+    ('total_bytes', int),
+    ('used_bytes', int),
+    ('free_bytes', int),
+    ('percent_used', float),
+    ('read_count', int),
+    ('write_count', int),
+    ('read_bytes', int),
+    ('write_bytes', int),
+    ('read_time_ms', int),
+    ('write_time_ms', int),
+    ('busy_time_ms', int),
+    ('read_merged_count', int),
+    ('write_merged_count', int),
+), counters=(
+    Counter('read_count', 'reads_per_s'),
+    Counter('write_count', 'writes_per_s'),
+    Counter('read_bytes', 'read_bytes_per_s'),
+    Counter('write_bytes', 'write_bytes_per_s'),
+    # The time counters are 32 bit milliseconds in /proc/diskstats and wrap after ~50 days of busy time
+    Counter('busy_time_ms', 'utilization_percent', scale=0.1, bits=32),
+    Counter('read_merged_count', 'read_merges_per_s'),
+    Counter('write_merged_count', 'write_merges_per_s'),
+))
+
+
+@dataclass(frozen=True)
+class DiskTestData(TestResult):
+    # One DISK_SCHEMA point per directory
+    disks: Columns
+
+    def rows(self) -> Iterable[Row]:
+        return self.disks.rows()
+
+
+PROCESS_SCHEMA = PointSchema(lambda: Settings.process_monitor.measurement, ('ranking', 'rank'), (
+    ('pid', int),
+    ('name', str),
+    ('cmdline', str),
+    ('exe', str),
+    ('cgroup', str),
+    ('cpu_percent', float),
+    ('rss_bytes', int),
+    ('read_bytes_per_s', float),
+    ('write_bytes_per_s', float),
+))
+PROCESS_SCAN_SCHEMA = PointSchema(lambda: Settings.process_monitor.measurement, (), (
+    ('pids_total', int),
+    ('pids_scanned', int),
+    ('scan_cpu_ms', float),
+    ('scan_truncated', bool),
+))
+CGROUP_SCHEMA = PointSchema(lambda: Settings.process_monitor.cgroup_measurement, ('cgroup',), (
+    ('num_processes', int),
+    ('cpu_percent', float),
+    ('rss_bytes', int),
+    ('read_bytes_per_s', float),
+    ('write_bytes_per_s', float),
+))
+
+
+@dataclass(frozen=True)
+class ProcessStats:
+    pid: int
+    name: str
+    cmdline: str
+    exe: str
+    cgroup: str
+    cpu_percent: Optional[float]
+    rss_bytes: int
+    read_bytes_per_s: Optional[float]
+    write_bytes_per_s: Optional[float]
+
+
+@dataclass(frozen=True)
+class CgroupStats:
+    cgroup: str
+    num_processes: int
+    cpu_percent: float
+    rss_bytes: int
+    read_bytes_per_s: float
+    write_bytes_per_s: float
+
+
+@dataclass(frozen=True)
+class ProcessTestData(TestResult):
+    # ranking (cpu, rss or io) -> processes, highest first
+    top_processes: Dict[str, List[ProcessStats]]
+    cgroup_stats: Iterable[CgroupStats]
+    pids_total: int
+    pids_scanned: int
+    scan_cpu_ms: float
+    scan_truncated: bool
+
+    def rows(self) -> Iterable[Row]:
+        rows = []
+        for ranking, processes in self.top_processes.items():
+            for rank, proc in enumerate(processes, 1):
+                rows.append((PROCESS_SCHEMA, (ranking, str(rank)), (
+                    proc.pid,
+                    proc.name,
+                    proc.cmdline,
+                    proc.exe,
+                    proc.cgroup,
+                    proc.cpu_percent,
+                    proc.rss_bytes,
+                    proc.read_bytes_per_s,
+                    proc.write_bytes_per_s,
+                )))
+        for cgroup in self.cgroup_stats:
+            rows.append((CGROUP_SCHEMA, (cgroup.cgroup,), (
+                cgroup.num_processes,
+                cgroup.cpu_percent,
+                cgroup.rss_bytes,
+                cgroup.read_bytes_per_s,
+                cgroup.write_bytes_per_s,
+            )))
+        rows.append((PROCESS_SCAN_SCHEMA, (), (
+            self.pids_total, self.pids_scanned, self.scan_cpu_ms, self.scan_truncated,
+        )))
+        return Projections.project(rows)
+
+
+PRESSURE_SCHEMA = PointSchema(lambda: Settings.pressure_monitor.measurement, ('resource', 'cgroup'), (
+    ('some_avg10', float),
+    ('some_avg60', float),
+    ('some_avg300', float),
+    ('some_total_us', int),
+    ('full_avg10', float),
+    ('full_avg60', float),
+    ('full_avg300', float),
+    ('full_total_us', int),
+    # Whether the sample was taken because a PSI trigger on this resource fired
+    ('triggered', bool),
+), counters=(
+    # Microseconds stalled per second, as a percentage
+    Counter('some_total_us', 'some_stall_percent', scale=1e-4),
+    Counter('full_total_us', 'full_stall_percent', scale=1e-4),
+))
+
+
+@dataclass(frozen=True)
+class PressureStats:
+    resource: str
+    # Empty for the whole system
+    cgroup: str
+    some_avg10: float
+    some_avg60: float
+    some_avg300: float
+    some_total_us: int
+    # Not reported for cpu by kernels before 5.13
+    full_avg10: Optional[float]
+    full_avg60: Optional[float]
+    full_avg300: Optional[float]
+    full_total_us: Optional[int]
+    triggered: bool
+
+
+@dataclass(frozen=True)
+class PressureTestData(TestResult):
+    pressure: Iterable[PressureStats]
+
+    def rows(self) -> Iterable[Row]:
+        return Projections.project(
+            (PRESSURE_SCHEMA, (p.resource, p.cgroup), (
+                p.some_avg10, p.some_avg60, p.some_avg300, p.some_total_us,
+                p.full_avg10, p.full_avg60, p.full_avg300, p.full_total_us,
+                p.triggered,
+            ))
+            for p in self.pressure
+        )
+
+
+SCHEDULER_SCHEMA = PointSchema(lambda: Settings.scheduler.measurement, ('monitor',), (
+    ('lateness_ms', float),
+    ('missed_deadlines', int),
+    # The monitor's current interval, which changes for monitors with adaptive rates
+    ('interval_s', float),
+))
+
+
+@dataclass(frozen=True)
+class SchedulerTickStats:
+    monitor: str
+    lateness_ms: float
+    missed_deadlines: int
+    interval_s: float
+
+
+@dataclass(frozen=True)
+class SchedulerTestData(TestResult):
+    tick_stats: Iterable[SchedulerTickStats]
+
+    def rows(self) -> Iterable[Row]:
+        return Projections.project(
+            (SCHEDULER_SCHEMA, (tick.monitor,), (tick.lateness_ms, tick.missed_deadlines, tick.interval_s))
+            for tick in self.tick_stats
+        )
+
+
+def _histogram_schema(bounds: Tuple[float, ...], unit: str) -> PointSchema:
+    return PointSchema(lambda: Settings.instrumentation.measurement, ('stage', 'monitor'), (
+        ('count', int),
+        (f'sum_{unit}', float),
+        (f'max_{unit}', float),
+        (f'p50_{unit}', float),
+        (f'p99_{unit}', float),
+        *((f'le_{bound}', int) for bound in bounds),
+        ('le_inf', int),
+    ))
+
+
+INTERNAL_HISTOGRAM_SCHEMAS = {
+    LATENCY_BUCKETS_MS: _histogram_schema(LATENCY_BUCKETS_MS, 'ms'),
+    SIZE_BUCKETS_BYTES: _histogram_schema(SIZE_BUCKETS_BYTES, 'bytes'),
+}
+INTERNAL_AGENT_SCHEMA = PointSchema(lambda: Settings.instrumentation.measurement, (), (
+    ('rss_bytes', int),
+    ('cpu_percent', float),
+    ('num_threads', int),
+    ('queue_depth', int),
+    ('spool_depth', int),
+    ('points_dropped', int),
+    ('write_errors', int),
+    # Left out while the deadband is disabled
+    ('deadband_fields_suppressed', int),
+    ('deadband_points_suppressed', int),
+    ('deadband_bytes_saved', int),
+), counters=(
+    Counter('points_dropped', 'points_dropped_per_s'),
+    Counter('write_errors', 'write_errors_per_s'),
+    Counter('deadband_bytes_saved', 'deadband_bytes_saved_per_s'),
+))
+
+
+@dataclass(frozen=True)
+class InternalTestData(TestResult):
+    histograms: Iterable[HistogramSnapshot]
+    resources: AgentResources
+    write_stats: WriteStats
+    deadband_stats: Optional[DeadbandStats] = None
+
+    def rows(self) -> Iterable[Row]:
+        rows = []
+        for h in self.histograms:
+            # Buckets are cumulative like Prometheus' le buckets, so any of them can be graphed on its own
+            cumulative = list(itertools.accumulate(h.counts))
+            rows.append((INTERNAL_HISTOGRAM_SCHEMAS[h.bounds], (h.stage, h.monitor), (
+                h.count,
+                round(float(h.total), 3),
+                round(float(h.max), 3),
+                h.percentile(50),
+                h.percentile(99),
+                *cumulative,
+            )))
+        rows.append((INTERNAL_AGENT_SCHEMA, (), (
+            self.resources.rss_bytes,
+            self.resources.cpu_percent,
+            self.resources.num_threads,
+            self.write_stats.queue_depth,
+            self.write_stats.spool_depth,
+            self.write_stats.points_dropped,
+            self.write_stats.write_errors,
+            *((self.deadband_stats.fields_suppressed, self.deadband_stats.points_suppressed,
+               self.deadband_stats.bytes_saved) if self.deadband_stats else (None, None, None)),
+        )))
+        return Projections.project(rows)
+
+
+@dataclass(frozen=True)
+class RollupTestData(TestResult):
+    rollup_rows: List[Row]
+
+    def rows(self) -> Iterable[Row]:
+        # Rolled up from rows that were already projected
+        return self.rollup_rows
@@ -0,0 +1,153 @@
+import math
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+from line_protocol import PointSchema, Row
+
+ROLLUP_STATS = ('min', 'max', 'mean', 'last', 'p95', 'p99')
+MAX_ROLLUP_SAMPLES = 4096
+
+
+class _SchemaBuffer:
+    """
+    Samples of every series of one schema, as a (series, capacity, fields) array. Gauges get every stat in the rollup,
+    while cumulative counters only get their last value since the rates derived from them carry the interesting
+    statistics. That value is kept as it was sampled rather than in the array, since byte counters can be past 2**53
+    where a float64 loses their low digits.
+    """
+
+    def __init__(self, base: PointSchema, stats: Tuple[str, ...], capacity: int):
+        counters = {c[0] for c in base.counters}
+        self.numeric_fields = []
+        self.counter_fields = []
+        fields = []
+        selected = []
+        # Where each counter's last value goes among the rollup's fields
+        self.counter_positions = []
+        for i, (key, t) in enumerate(base.fields):
+            if t not in (int, float):
+                continue
+            if key in counters:
+                self.counter_positions.append(len(fields))
+                self.counter_fields.append(i)
+                fields.append((f'{key}_last', t))
+                continue
+            column = len(self.numeric_fields)
+            self.numeric_fields.append(i)
+            for stat_index, stat in enumerate(stats):
+                fields.append((f'{key}_{stat}', float))
+                selected.append(column * len(stats) + stat_index)
+        self.schema = PointSchema(base._measurement, base.tag_keys, fields,
+                                  high_cardinality_tags=base.high_cardinality_tags)
+        # Indexes into the flattened (fields, stats) aggregate array of a series
+        self.selected = np.array(selected, dtype=np.intp)
+        self.series: Dict[Tuple, int] = {}
+        self.values = np.full((0, capacity, len(self.numeric_fields)), np.nan)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.last_counters: List[Tuple] = []
+
+    def add(self, tag_values: Tuple, field_values: Tuple):
+        series = self.series.get(tag_values)
+        if series is None:
+            series = self.series[tag_values] = len(self.series)
+            self.last_counters.append(())
+            if series == len(self.values):
+                grow = max(len(self.values), 1)
+                self.values = np.concatenate([self.values, np.full((grow, *self.values.shape[1:]), np.nan)])
+                self.counts = np.concatenate([self.counts, np.zeros(grow, dtype=np.int64)])
+        capacity = self.values.shape[1]
+        self.values[series, self.counts[series] % capacity] = [
+            np.nan if field_values[i] is None else field_values[i] for i in self.numeric_fields
+        ]
+        self.counts[series] += 1
+        self.last_counters[series] = tuple([field_values[i] for i in self.counter_fields])
+
+    def reset(self):
+        # Series not seen during the window are forgotten, e.g. an interface that went away
+        seen = [(tag_values, series) for tag_values, series in self.series.items() if self.counts[series]]
+        self.series = {tag_values: i for i, (tag_values, _) in enumerate(seen)}
+        self.last_counters = [self.last_counters[series] for _, series in seen]
+        self.values[:] = np.nan
+        self.counts[:] = 0
+
+
+def _percentiles(sorted_window: np.ndarray, num_valid: np.ndarray, q: float) -> np.ndarray:
+    """
+    Linearly interpolated percentile along axis 1 of an array sorted along that axis with nans last
+    """
+    position = np.maximum(num_valid - 1, 0) * (q / 100)
+    lower = np.floor(position).astype(np.intp)
+    upper = np.minimum(lower + 1, np.maximum(num_valid - 1, 0))
+    lower_values = np.take_along_axis(sorted_window, lower[:, None, :], axis=1)[:, 0]
+    upper_values = np.take_along_axis(sorted_window, upper[:, None, :], axis=1)[:, 0]
+    return lower_values + (upper_values - lower_values) * (position - lower)
+
+
+class RollupBuffer:
+    """
+    Collects samples taken at a fast inner rate into fixed-size arrays, and aggregates each series into one row of
+    per-field statistics when flushed. Stats are computed for all series of a schema at once. Once a window holds
+    more than `capacity` samples the oldest are overwritten, so memory and flush cost stay flat however fast the
+    inner rate is.
+    """
+
+    def __init__(self, capacity: int, stats: Sequence[str] = ROLLUP_STATS):
+        unknown = set(stats) - set(ROLLUP_STATS)
+        if unknown:
+            raise ValueError(f"Invalid rollup stats {unknown}, expected some of {ROLLUP_STATS}")
+        self.capacity = min(capacity, MAX_ROLLUP_SAMPLES)
+        self.stats = tuple(stats) if 'last' in stats else (*stats, 'last')
+        self._buffers: Dict[PointSchema, _SchemaBuffer] = {}
+
+    @classmethod
+    def for_rates(cls, rollup_interval_s: float, sample_interval_s: float, stats: Sequence[str] = ROLLUP_STATS):
+        return cls(math.ceil(rollup_interval_s / sample_interval_s) + 1, stats)
+
+    def add(self, rows: Iterable[Row]):
+        for schema, tag_values, field_values in rows:
+            buffer = self._buffers.get(schema)
+            if buffer is None:
+                buffer = self._buffers[schema] = _SchemaBuffer(schema, self.stats, self.capacity)
+            buffer.add(tag_values, field_values)
+
+    def _aggregate(self, buffer: _SchemaBuffer) -> np.ndarray:
+        """
+        Returns a (series, fields, stats) array
+        """
+        num_series = len(buffer.series)
+        counts = buffer.counts[:num_series]
+        window = buffer.values[:num_series, :min(int(counts.max()), self.capacity)]
+        num_valid = (~np.isnan(window)).sum(axis=1)
+        out = np.full((num_series, window.shape[2], len(self.stats)), np.nan)
+        sorted_window = None
+        for i, stat in enumerate(self.stats):
+            if stat == 'min':
+                out[:, :, i] = np.fmin.reduce(window, axis=1)
+            elif stat == 'max':
+                out[:, :, i] = np.fmax.reduce(window, axis=1)
+            elif stat == 'mean':
+                np.divide(np.where(np.isnan(window), 0, window).sum(axis=1), num_valid, out=out[:, :, i],
+                          where=num_valid > 0)
+            elif stat == 'last':
+                out[:, :, i] = buffer.values[np.arange(num_series), (counts - 1) % self.capacity]
+            else:
+                if sorted_window is None:
+                    sorted_window = np.sort(window, axis=1)
+                out[:, :, i] = _percentiles(sorted_window, num_valid, float(stat[1:]))
+        return out
+
+    def flush(self) -> List[Row]:
+        rows = []
+        for buffer in self._buffers.values():
+            if not buffer.series:
+                continue
+            aggregates = self._aggregate(buffer).reshape(len(buffer.series), -1)[:, buffer.selected].round(3)
+            for (tag_values, series), series_aggregates in zip(buffer.series.items(), aggregates.tolist()):
+                if buffer.counts[series]:
+                    field_values = [None if math.isnan(v) else v for v in series_aggregates]
+                    for position, value in zip(buffer.counter_positions, buffer.last_counters[series]):
+                        field_values.insert(position, value)
+                    rows.append((buffer.schema, tag_values, tuple(field_values)))
+            buffer.reset()
+        return rows
@@ -0,0 +1,106 @@
+import heapq
+import itertools
+import logging
+import math
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from monitored_stat import MonitoredStat
+
+CATCH_UP_POLICIES = ('skip', 'coalesce')
+
+
+@dataclass(frozen=True)
+class Tick:
+    monitor: MonitoredStat
+    deadline_s: float
+    fired_s: float
+    lateness_s: float
+    missed: int
+
+
+class Scheduler:
+    """
+    Fires monitors on a fixed grid of absolute monotonic deadlines. The next deadline is always derived from the
+    previous one, never from when the measurement ran, so intervals do not drift.
+
+    When a tick fires more than one interval late, the deadlines in between were missed:
+      * 'coalesce' fires once immediately and reports how many deadlines were folded into that tick
+      * 'skip' drops the late tick entirely and waits for the next deadline on the grid
+
+    A monitor whose refresh_rate_s changed (see AdaptiveRate) is moved onto a new grid by reschedule(), starting
+    from its last deadline. Its old deadline stays in the heap and is ignored when popped.
+    """
+
+    def __init__(self, monitors: Iterable[MonitoredStat], align_to_wall_clock: bool = False,
+                 catch_up: str = 'skip', clock: Callable[[], float] = time.monotonic,
+                 wall_clock: Callable[[], float] = time.time):
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"Invalid catch up policy {catch_up}, expected one of {CATCH_UP_POLICIES}")
+        self.align_to_wall_clock = align_to_wall_clock
+        self.catch_up = catch_up
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._heap: List[Tuple[float, int, MonitoredStat]] = []
+        self._seq = itertools.count()
+        # The deadline and sequence number of each monitor's live heap entry, and the last deadline it fired for
+        self._pending: Dict[str, Tuple[float, int]] = {}
+        self._last_deadline_s: Dict[str, float] = {}
+        self.last_lateness_s: Dict[str, float] = {}
+        self.missed_ticks: Dict[str, int] = {}
+        for monitor in monitors:
+            self.add(monitor)
+
+    def add(self, monitor: MonitoredStat):
+        now = self._clock()
+        first_deadline = now
+        if self.align_to_wall_clock:
+            first_deadline += -self._wall_clock() % monitor.refresh_rate_s
+        self._push(first_deadline, monitor)
+        self.last_lateness_s[monitor.name] = 0.0
+        self.missed_ticks[monitor.name] = 0
+
+    def _push(self, deadline_s: float, monitor: MonitoredStat):
+        seq = next(self._seq)
+        self._pending[monitor.name] = (deadline_s, seq)
+        heapq.heappush(self._heap, (deadline_s, seq, monitor))
+
+    def reschedule(self, monitor: MonitoredStat):
+        last_deadline_s = self._last_deadline_s.get(monitor.name)
+        if last_deadline_s is None:
+            return
+        deadline_s = last_deadline_s + monitor.refresh_rate_s
+        if self._pending[monitor.name][0] != deadline_s:
+            self._push(deadline_s, monitor)
+
+    def time_to_next_tick_s(self) -> float:
+        self._drop_stale()
+        if not self._heap:
+            return math.inf
+        return max(self._heap[0][0] - self._clock(), 0)
+
+    def _drop_stale(self):
+        while self._heap and self._pending[self._heap[0][2].name][1] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self) -> List[Tick]:
+        now = self._clock()
+        ticks = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            deadline_s, _, monitor = heapq.heappop(self._heap)
+            lateness_s = now - deadline_s
+            missed = int(lateness_s // monitor.refresh_rate_s)
+            self._last_deadline_s[monitor.name] = deadline_s + missed * monitor.refresh_rate_s
+            self._push(deadline_s + (missed + 1) * monitor.refresh_rate_s, monitor)
+            self.last_lateness_s[monitor.name] = lateness_s
+            self.missed_ticks[monitor.name] += missed
+            self._drop_stale()
+            if missed and self.catch_up == 'skip':
+                logging.warning(f'{monitor.name} fell {lateness_s:.3f}s behind schedule, skipping {missed + 1} '
+                                f'measurement(s)')
+                continue
+            ticks.append(Tick(monitor=monitor, deadline_s=deadline_s, fired_s=now, lateness_s=lateness_s,
+                              missed=missed))
+        return ticks
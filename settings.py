@@ -1,8 +1,22 @@
+import dataclasses
 import logging
+import socket
 from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import yaml
 
+UNIT_TO_S = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_refresh_rate(rate: str) -> float:
+    rate = rate.lower().strip()
+    unit = rate[-1]
+    if unit not in UNIT_TO_S.keys():
+        raise KeyError(f"Invalid refresh rate unit on stat. Found {unit}, expected one of {UNIT_TO_S.keys()}")
+    refresh_rate = float(rate[:-1]) * UNIT_TO_S[unit]
+    return refresh_rate
+
 
 @dataclass(frozen=True)
 class InfluxSettings:
@@ -10,18 +24,82 @@ class InfluxSettings:
     server: str
     bucket: str
     org: str
+    batch_size: int = 5000
+    flush_interval_ms: int = 1000
+    max_queue_size: int = 100000
+    overflow: str = 'drop-oldest'
+    spool_directory: Optional[str] = None
+    spool_segment_mb: int = 8
+    spool_max_mb: int = 512
+    replay_points_per_s: int = 5000
+    gzip_level: int = 6
+    gzip_min_bytes: int = 1024
+    connect_timeout_s: float = 3
+    read_timeout_s: float = 10
+    retry_initial_s: float = 1
+    retry_max_s: float = 60
+
+
+@dataclass(frozen=True)
+class TriggerSettings:
+    # A field of the monitor's points, or the rate field of one of its counters, e.g. utilization_percent of disks
+    field: str
+    above: Optional[float] = None
+    below: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class AdaptiveSettings:
+    # Fastest rate the monitor speeds up to while a trigger holds. Its monitor_rate is the slowest
+    min_rate: str
+    triggers: list[TriggerSettings]
+    # How much the interval grows each measurement once no trigger holds, until it is back at monitor_rate
+    decay_factor: float = 2.0
+
+
+def adaptive_settings(monitor: dict) -> Optional[AdaptiveSettings]:
+    adaptive = monitor.get('adaptive')
+    if adaptive is None:
+        return None
+    return AdaptiveSettings(
+        min_rate=adaptive['min_rate'],
+        triggers=[TriggerSettings(**trigger) for trigger in adaptive['triggers']],
+        decay_factor=adaptive.get('decay_factor', 2.0),
+    )
 
 
 @dataclass(frozen=True)
 class SpeedtestSettings:
     measurement: str
     monitor_rate: str
+    # The speedtest.net configuration, nearby servers and the selected server are kept here between runs
+    cache_path: Optional[str] = 'speedtest-cache.json'
+    cache_ttl: str = '1d'
+    closest_servers: int = 5
+    # The server is selected again once its latency is this many times what it was when it was selected
+    max_latency_increase: float = 2.0
+    # Defaults to what speedtest.net's configuration says
+    download_threads: Optional[int] = None
+    upload_threads: Optional[int] = None
+    # Caps on the data transferred by each test, defaults to the full speedtest.net test
+    download_bytes: Optional[int] = None
+    upload_bytes: Optional[int] = None
+    timeout: Optional[str] = None
+    max_overlapping_runs: int = 1
+    sample_rate: Optional[str] = None
+    rollup_stats: Optional[list[str]] = None
+    adaptive: Optional[AdaptiveSettings] = None
 
 
 @dataclass(frozen=True)
 class CPUTestSettings:
     measurement: str
     monitor_rate: str
+    timeout: Optional[str] = None
+    max_overlapping_runs: int = 1
+    sample_rate: Optional[str] = None
+    rollup_stats: Optional[list[str]] = None
+    adaptive: Optional[AdaptiveSettings] = None
 
 
 @dataclass(frozen=True)
@@ -29,6 +107,11 @@ class MemoryTestSettings:
     ram_measurement: str
     swap_measurement: str
     monitor_rate: str
+    timeout: Optional[str] = None
+    max_overlapping_runs: int = 1
+    sample_rate: Optional[str] = None
+    rollup_stats: Optional[list[str]] = None
+    adaptive: Optional[AdaptiveSettings] = None
 
 
 @dataclass(frozen=True)
@@ -36,6 +119,11 @@ class NetworkIOSettings:
     interfaces: list[str]
     measurement: str
     monitor_rate: str
+    timeout: Optional[str] = None
+    max_overlapping_runs: int = 1
+    sample_rate: Optional[str] = None
+    rollup_stats: Optional[list[str]] = None
+    adaptive: Optional[AdaptiveSettings] = None
 
 
 @dataclass(frozen=True)
@@ -43,51 +131,336 @@ class DiskTestSettings:
     directories: list[str]
     measurement: str
     monitor_rate: str
+    timeout: Optional[str] = None
+    max_overlapping_runs: int = 1
+    sample_rate: Optional[str] = None
+    rollup_stats: Optional[list[str]] = None
+    adaptive: Optional[AdaptiveSettings] = None
+
+
+@dataclass(frozen=True)
+class ProcessTestSettings:
+    measurement: str
+    cgroup_measurement: str
+    monitor_rate: str
+    top_n: int = 10
+    scan_budget_ms: int = 250
+    max_open_files: int = 4096
+    timeout: Optional[str] = None
+    max_overlapping_runs: int = 1
+    sample_rate: Optional[str] = None
+    rollup_stats: Optional[list[str]] = None
+    adaptive: Optional[AdaptiveSettings] = None
+
+
+@dataclass(frozen=True)
+class PressureTriggerSettings:
+    # cpu, memory or io
+    resource: str
+    # some: at least one task stalled, full: all non-idle tasks stalled at once
+    type: str = 'some'
+    # Fire when tasks were stalled for stall_ms within any window_ms
+    stall_ms: int = 100
+    window_ms: int = 1000
+    # A cgroup directory, e.g. /sys/fs/cgroup/system.slice, instead of the whole system
+    cgroup: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class PressureTestSettings:
+    measurement: str
+    monitor_rate: str
+    # cgroup directories whose pressure is reported alongside the whole system's
+    cgroups: list[str] = dataclasses.field(default_factory=list)
+    triggers: list[PressureTriggerSettings] = dataclasses.field(default_factory=list)
+    timeout: Optional[str] = None
+    max_overlapping_runs: int = 1
+    sample_rate: Optional[str] = None
+    rollup_stats: Optional[list[str]] = None
+    adaptive: Optional[AdaptiveSettings] = None
+
+
+@dataclass(frozen=True)
+class SchedulerSettings:
+    align_to_wall_clock: bool
+    catch_up: str
+    measurement: str
+
+
+@dataclass(frozen=True)
+class InstrumentationSettings:
+    enabled: bool
+    measurement: str
+    monitor_rate: str
+    profile_signal: Optional[str]
+    profile_directory: str
+
+
+@dataclass(frozen=True)
+class SinkSettings:
+    # influxdb, prometheus, file or history
+    type: str
+    # prometheus: address to serve /metrics on
+    listen: str = '0.0.0.0:9100'
+    # file: line protocol is appended here, '-' for stdout
+    path: str = '-'
+    # history: where the ring files are kept, and the size of each one
+    directory: str = 'history'
+    max_mb: float = 4
+
+
+@dataclass(frozen=True)
+class RelaySettings:
+    # Send to the relay at this address instead of InfluxDB
+    address: Optional[str]
+    # When run as a relay (relay.py), the addresses to accept agents on
+    listen: list[str]
+    dedup_window: int
+    max_datagram_bytes: int
+
+
+@dataclass(frozen=True)
+class RateSettings:
+    mode: str
+
+
+@dataclass(frozen=True)
+class DeadbandSettings:
+    enabled: bool
+    heartbeat_intervals: int
+    # measurement -> field -> {'absolute': ..., 'percent': ...}
+    measurements: dict
+
+
+@dataclass(frozen=True)
+class CardinalitySettings:
+    enabled: bool
+    # Distinct series the agent may write
+    series_budget: int
+    # warn or reject
+    on_exceeded: str
+    # Distinct values after which a tag is written as a field, 0 to never demote tags automatically
+    max_tag_values: int
+    # measurement -> tag keys to write as fields
+    demote: dict
+
+
+@dataclass(frozen=True)
+class FieldSettings:
+    # measurement -> {'include': [...]} or {'exclude': [...]}, fields that are collected and sent
+    measurements: dict
+
+
+class MonitorSection(NamedTuple):
+    # The SettingsObj attribute the monitor's settings are kept in, None while it is disabled
+    attribute: str
+    settings: type
+    # Where the monitor's section is when it isn't declared under monitors
+    legacy_path: Tuple[str, ...]
+
+
+# Every type of monitor, in the order they are started in. Each can be declared at most once
+MONITOR_SECTIONS = {
+    'disk': MonitorSection('disk_monitor', DiskTestSettings, ('disk_monitor',)),
+    'network_io': MonitorSection('network_io_monitor', NetworkIOSettings, ('network', 'io')),
+    'speedtest': MonitorSection('network_speed_test', SpeedtestSettings, ('network', 'speedtest')),
+    'cpu': MonitorSection('cpu_monitor', CPUTestSettings, ('cpu_monitor',)),
+    'memory': MonitorSection('memory_monitor', MemoryTestSettings, ('memory_monitor',)),
+    'process': MonitorSection('process_monitor', ProcessTestSettings, ('process_monitor',)),
+    'pressure': MonitorSection('pressure_monitor', PressureTestSettings, ('pressure_monitor',)),
+}
+RATE_OPTIONS = ('monitor_rate', 'sample_rate', 'timeout', 'cache_ttl')
+
+
+def _check_rate(errors: List[str], where: str, rate) -> bool:
+    try:
+        parse_refresh_rate(rate)
+    except (AttributeError, IndexError, KeyError, ValueError):
+        errors.append(f'{where}: invalid rate {rate!r}, expected a number followed by one of {", ".join(UNIT_TO_S)}')
+        return False
+    return True
+
+
+def monitor_declarations(settings: dict, errors: List[str]) -> Dict[str, dict]:
+    """
+    Returns the section of every declared monitor by type, from the monitors list and from the legacy sections
+    """
+    declared = {}
+    for monitor in settings.get('monitors') or []:
+        monitor_type = monitor.get('type')
+        if monitor_type not in MONITOR_SECTIONS:
+            errors.append(f'monitors: unknown type {monitor_type!r}, expected one of {", ".join(MONITOR_SECTIONS)}')
+        elif monitor_type in declared:
+            errors.append(f'monitors: {monitor_type} is declared more than once')
+        else:
+            declared[monitor_type] = monitor
+    for monitor_type, section in MONITOR_SECTIONS.items():
+        legacy = settings
+        for key in section.legacy_path:
+            legacy = legacy.get(key) if isinstance(legacy, dict) else None
+        if legacy is None:
+            continue
+        if monitor_type in declared:
+            errors.append(f'{".".join(section.legacy_path)}: {monitor_type} is also declared under monitors')
+        else:
+            declared[monitor_type] = legacy
+    return declared
+
+
+def monitor_settings(monitor_type: str, monitor: dict, errors: List[str]):
+    """
+    Builds the settings of an enabled monitor from its section, or returns None after adding what is wrong with it
+    to errors
+    """
+    settings_type = MONITOR_SECTIONS[monitor_type].settings
+    fields = {f.name: f for f in dataclasses.fields(settings_type)}
+    valid = True
+    for key in monitor.keys() - fields.keys() - {'type', 'enabled'}:
+        errors.append(f'{monitor_type}: unknown option {key}, expected one of {", ".join(fields)}')
+        valid = False
+    missing = [name for name, f in fields.items() if name not in monitor and
+               f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING]
+    if missing:
+        errors.append(f'{monitor_type}: missing {", ".join(missing)}')
+        valid = False
+    for key in RATE_OPTIONS:
+        if monitor.get(key) is not None:
+            valid &= _check_rate(errors, f'{monitor_type}.{key}', monitor[key])
+    options = {key: value for key, value in monitor.items() if key in fields}
+    try:
+        options['adaptive'] = adaptive_settings(monitor)
+        if 'triggers' in options:
+            options['triggers'] = [PressureTriggerSettings(**trigger) for trigger in options['triggers']]
+            for trigger in options['triggers']:
+                # A trigger marks its cgroup's points as triggered, so the cgroup has to be reported, spelled the same
+                if trigger.cgroup and trigger.cgroup not in (options.get('cgroups') or []):
+                    errors.append(f'{monitor_type}: trigger cgroup {trigger.cgroup} is not one of the cgroups')
+                    valid = False
+    except (KeyError, TypeError) as e:
+        errors.append(f'{monitor_type}: invalid adaptive settings or triggers: {e!r}')
+        return None
+    if options['adaptive'] is not None:
+        valid &= _check_rate(errors, f'{monitor_type}.adaptive.min_rate', options['adaptive'].min_rate)
+        if options.get('sample_rate'):
+            errors.append(f'{monitor_type}: can either have a sample_rate or adaptive rates, not both')
+            valid = False
+    return settings_type(**options) if valid else None
 
 
 # todo: rename this
 class SettingsObj:
     influxdb: InfluxSettings
-    network_speed_test: SpeedtestSettings
-    network_io_monitor: NetworkIOSettings
-    cpu_monitor: CPUTestSettings
-    memory_monitor: MemoryTestSettings
-    disk_monitor: DiskTestSettings
+    network_speed_test: Optional[SpeedtestSettings]
+    network_io_monitor: Optional[NetworkIOSettings]
+    cpu_monitor: Optional[CPUTestSettings]
+    memory_monitor: Optional[MemoryTestSettings]
+    disk_monitor: Optional[DiskTestSettings]
+    process_monitor: Optional[ProcessTestSettings]
+    pressure_monitor: Optional[PressureTestSettings]
+    scheduler: SchedulerSettings
+    instrumentation: InstrumentationSettings
+    relay: RelaySettings
+    sinks: list[SinkSettings]
+    rates: RateSettings
+    deadband: DeadbandSettings
+    cardinality: CardinalitySettings
+    fields: FieldSettings
+    # Tag of every line sent, None to leave it out
+    host: Optional[str]
 
-    def load_settings(self):
+    def load_settings(self, path: str = 'settings.yaml'):
         logging.debug("Loading settings from yaml file")
-        with open('settings.yaml', 'r') as f:
-            settings = yaml.safe_load(f)
-        self.influxdb = InfluxSettings(
-            token=settings['influxdb']['token'],
-            server=settings['influxdb']['server'],
-            bucket=settings['influxdb']['bucket'],
-            org=settings['influxdb']['org'],
+        with open(path, 'r') as f:
+            self.load_dict(yaml.safe_load(f))
 
+    def load_dict(self, settings: dict):
+        # Everything wrong with the settings is reported at once, before anything is started
+        errors: List[str] = []
+        declared = monitor_declarations(settings, errors)
+        relay = settings.get('relay') or {}
+        self.relay = RelaySettings(
+            address=relay.get('address'),
+            listen=relay.get('listen') or [],
+            dedup_window=relay.get('dedup_window', 100000),
+            max_datagram_bytes=relay.get('max_datagram_bytes', 8192),
+        )
+        # Agents writing to the same bucket, e.g. through a relay, would otherwise overwrite each other's series. Only
+        # tagged by default behind a relay, since a new tag starts a new series for every existing one.
+        self.host = settings.get('host', socket.gethostname() if self.relay.address else None)
+        self.sinks = [SinkSettings(**sink) for sink in settings.get('sinks', [{'type': 'influxdb'}])]
+        # Agents sending to a relay, or only to other sinks, don't talk to InfluxDB, so they need no credentials
+        needs_influxdb = not self.relay.address and any(sink.type == 'influxdb' for sink in self.sinks)
+        influxdb = settings.get('influxdb') or {}
+        missing = [key for key in ('token', 'server', 'bucket', 'org') if key not in influxdb]
+        if needs_influxdb and missing:
+            errors.append(f'influxdb: missing {", ".join(missing)}, needed by the influxdb sink')
+        self.influxdb = InfluxSettings(
+            token=influxdb.get('token', ''),
+            server=influxdb.get('server', ''),
+            bucket=influxdb.get('bucket', ''),
+            org=influxdb.get('org', ''),
+            batch_size=influxdb.get('batch_size', 5000),
+            flush_interval_ms=influxdb.get('flush_interval_ms', 1000),
+            max_queue_size=influxdb.get('max_queue_size', 100000),
+            overflow=influxdb.get('overflow', 'drop-oldest'),
+            spool_directory=influxdb.get('spool_directory'),
+            spool_segment_mb=influxdb.get('spool_segment_mb', 8),
+            spool_max_mb=influxdb.get('spool_max_mb', 512),
+            replay_points_per_s=influxdb.get('replay_points_per_s', 5000),
+            gzip_level=influxdb.get('gzip_level', 6),
+            gzip_min_bytes=influxdb.get('gzip_min_bytes', 1024),
+            connect_timeout_s=influxdb.get('connect_timeout_s', 3),
+            read_timeout_s=influxdb.get('read_timeout_s', 10),
+            retry_initial_s=influxdb.get('retry_initial_s', 1),
+            retry_max_s=influxdb.get('retry_max_s', 60),
+        )
+        for monitor_type, section in MONITOR_SECTIONS.items():
+            monitor = declared.get(monitor_type)
+            enabled = monitor is not None and monitor.get('enabled', True)
+            setattr(self, section.attribute, monitor_settings(monitor_type, monitor, errors) if enabled else None)
+        scheduler = settings.get('scheduler') or {}
+        self.scheduler = SchedulerSettings(
+            align_to_wall_clock=scheduler.get('align_to_wall_clock', False),
+            catch_up=scheduler.get('catch_up', 'skip'),
+            measurement=scheduler.get('measurement', 'sysmon-scheduler'),
         )
-        self.network_speed_test = SpeedtestSettings(
-            measurement=settings['network']['speedtest']['measurement'],
-            monitor_rate=settings['network']['speedtest']['monitor_rate'],
+        instrumentation = settings.get('instrumentation') or {}
+        self.instrumentation = InstrumentationSettings(
+            enabled=instrumentation.get('enabled', True),
+            measurement=instrumentation.get('measurement', 'sysmon-internal'),
+            monitor_rate=instrumentation.get('monitor_rate', '60s'),
+            profile_signal=instrumentation.get('profile_signal', 'SIGUSR1'),
+            profile_directory=instrumentation.get('profile_directory', 'profiles'),
         )
-        self.network_io_monitor = NetworkIOSettings(
-            interfaces=settings['network']['io']['interfaces'],
-            measurement=settings['network']['io']['measurement'],
-            monitor_rate=settings['network']['io']['monitor_rate'],
+        self.rates = RateSettings(
+            mode=(settings.get('rates') or {}).get('mode', 'alongside'),
         )
-        self.cpu_monitor = CPUTestSettings(
-            measurement=settings['cpu_monitor']['measurement'],
-            monitor_rate=settings['cpu_monitor']['monitor_rate'],
+        deadband = settings.get('deadband') or {}
+        self.deadband = DeadbandSettings(
+            enabled=deadband.get('enabled', False),
+            heartbeat_intervals=deadband.get('heartbeat_intervals', 10),
+            measurements=deadband.get('measurements') or {},
         )
-        self.memory_monitor = MemoryTestSettings(
-            ram_measurement=settings['memory_monitor']['ram_measurement'],
-            swap_measurement=settings['memory_monitor']['swap_measurement'],
-            monitor_rate=settings['memory_monitor']['monitor_rate'],
+        if not isinstance(self.deadband.heartbeat_intervals, int) or self.deadband.heartbeat_intervals < 1:
+            errors.append(f'deadband.heartbeat_intervals: expected a whole number of at least 1, got '
+                          f'{self.deadband.heartbeat_intervals!r}')
+        cardinality = settings.get('cardinality') or {}
+        self.cardinality = CardinalitySettings(
+            enabled=cardinality.get('enabled', True),
+            series_budget=cardinality.get('series_budget', 10000),
+            on_exceeded=cardinality.get('on_exceeded', 'warn'),
+            max_tag_values=cardinality.get('max_tag_values', 1000),
+            demote=cardinality.get('demote') or {},
         )
-        self.disk_monitor = DiskTestSettings(
-            directories=settings['disk_monitor']['directories'],
-            measurement=settings['disk_monitor']['measurement'],
-            monitor_rate=settings['disk_monitor']['monitor_rate'],
+        self.fields = FieldSettings(
+            measurements=settings.get('fields') or {},
         )
+        for measurement, selection in self.fields.measurements.items():
+            listed = [key for key in ('include', 'exclude') if isinstance(selection, dict) and key in selection]
+            if len(listed) != 1 or len(selection) != 1 or not isinstance(selection[listed[0]], list):
+                errors.append(f'fields.{measurement}: expected either an include or an exclude list of fields')
+        if errors:
+            raise ValueError('Invalid settings:\n' + '\n'.join(f'  {error}' for error in errors))
 
 
 Settings = SettingsObj()
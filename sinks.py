@@ -0,0 +1,170 @@
+import gzip
+import logging
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, BinaryIO, Dict, List, Tuple
+
+from line_protocol import LineProtocolEncoder, PointSchema, Row
+from rates import RateDeriver
+from settings import Settings
+
+if TYPE_CHECKING:
+    from results import TestResult
+
+SINK_TYPES = ('influxdb', 'prometheus', 'file', 'history')
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+INVALID_METRIC_CHARS = re.compile(r'[^a-zA-Z0-9_:]')
+INVALID_LABEL_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+
+class Sink:
+    """
+    Somewhere measurements are sent. start_monitoring hands every result to each configured sink.
+    """
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def record_measurement(self, data: 'TestResult', monitor: str = ''):
+        raise NotImplementedError("All sinks must implement record_measurement()")
+
+
+class LineProtocolFileSink(Sink):
+    """
+    Writes line protocol to a file, or stdout for '-', for debugging what would be sent to InfluxDB
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file: BinaryIO = sys.stdout.buffer if path == '-' else open(path, 'ab')
+        self.encoder = LineProtocolEncoder(Settings.host)
+        self.rate_deriver = RateDeriver(Settings.rates.mode)
+
+    def close(self):
+        if self.path != '-':
+            self.file.close()
+
+    def record_measurement(self, data: 'TestResult', monitor: str = ''):
+        rows = self.rate_deriver.derive(data.rows(), data.monotonic_ns or time.monotonic_ns())
+        lines = self.encoder.encode_rows(rows, data.timestamp_ns or time.time_ns())
+        if lines:
+            self.file.write(b'\n'.join(lines) + b'\n')
+            self.file.flush()
+
+
+def _metric_name(measurement: str, field: str) -> str:
+    name = INVALID_METRIC_CHARS.sub('_', f'{measurement}_{field}')
+    return f'_{name}' if name[0].isdigit() else name
+
+
+def _label_value(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _sample_value(value) -> str:
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value)
+
+
+class _Exposition:
+    """
+    Metric names and types of each numeric field of a schema. Counters keep the counter type so rate() works on them.
+    """
+    __slots__ = ('label_keys', 'metrics')
+
+    def __init__(self, schema: PointSchema):
+        counters = {c[0] for c in schema.counters}
+        self.label_keys = [INVALID_LABEL_CHARS.sub('_', key) for key in schema.tag_keys]
+        self.metrics: List[Tuple[int, str, str]] = [
+            (i, f'{_metric_name(schema.measurement, key)}_total', 'counter') if key in counters
+            else (i, _metric_name(schema.measurement, key), 'gauge')
+            for i, (key, t) in enumerate(schema.fields) if t in (int, float, bool)
+        ]
+
+
+class PrometheusSink(Sink):
+    """
+    Serves the latest result of every monitor on /metrics in the Prometheus text format. Each result is rendered
+    when it is recorded and the whole page is swapped in as one pre-rendered (and pre-gzipped) snapshot, so a scrape
+    only copies bytes out and never collects or formats anything.
+    """
+
+    def __init__(self, listen: str):
+        host, port = listen.rsplit(':', 1)
+        self.rate_deriver = RateDeriver(Settings.rates.mode)
+        self._expositions: Dict[PointSchema, _Exposition] = {}
+        self._blocks: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+        # (body, gzipped body), replaced as a whole so handlers never see a half updated page
+        self.snapshot: Tuple[bytes, bytes] = (b'', gzip.compress(b''))
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body, gzipped = sink.snapshot
+                use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                if use_gzip:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(gzipped if use_gzip else body)))
+                self.end_headers()
+                self.wfile.write(gzipped if use_gzip else body)
+
+        self.server = ThreadingHTTPServer((host, int(port)), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='prometheus-sink', daemon=True)
+
+    def connect(self):
+        self._thread.start()
+        logging.info(f'Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}'
+                     f'/metrics')
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _exposition(self, schema: PointSchema) -> _Exposition:
+        exposition = self._expositions.get(schema)
+        if exposition is None:
+            exposition = self._expositions[schema] = _Exposition(schema)
+        return exposition
+
+    def render(self, rows: List[Row]) -> bytes:
+        # Samples have to be grouped by metric, while rows hold one sample of many metrics
+        families: Dict[str, List[str]] = {}
+        for schema, tag_values, field_values in rows:
+            exposition = self._exposition(schema)
+            labels = ','.join(f'{key}="{_label_value(value)}"' for key, value in zip(exposition.label_keys, tag_values)
+                              if value is not None and value != '')
+            labels = f'{{{labels}}}' if labels else ''
+            for i, name, metric_type in exposition.metrics:
+                value = field_values[i]
+                if value is None:
+                    continue
+                samples = families.get(name)
+                if samples is None:
+                    samples = families[name] = [f'# TYPE {name} {metric_type}']
+                samples.append(f'{name}{labels} {_sample_value(value)}')
+        return ''.join('\n'.join(samples) + '\n' for samples in families.values()).encode()
+
+    def record_measurement(self, data: 'TestResult', monitor: str = ''):
+        rows = self.rate_deriver.derive(data.rows(), data.monotonic_ns or time.monotonic_ns())
+        block = self.render(rows)
+        with self._lock:
+            self._blocks[monitor or type(data).__name__] = block
+            body = b''.join(self._blocks.values())
+            self.snapshot = (body, gzip.compress(body, compresslevel=1))
@@ -0,0 +1,121 @@
+import logging
+import os
+from collections import deque
+from typing import BinaryIO, Deque, Dict, List, Optional
+
+SEGMENT_SUFFIX = '.lp'
+
+
+def _timestamp(line: bytes) -> int:
+    ts = line.rsplit(b' ', 1)[-1]
+    return int(ts) if ts.isdigit() else 0
+
+
+class Spool:
+    """
+    Append-only write-ahead log of line protocol points that could not be written. Points are appended to the
+    newest segment file, which is rotated once it reaches segment_bytes. When the spool grows past max_bytes the
+    oldest segments are evicted. Segments are replayed oldest first, in timestamp order within each segment, and
+    deleted once every point in them has been committed. Replaying a segment twice after a crash is harmless since
+    InfluxDB overwrites points with the same series and timestamp.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 8 * 1024 * 1024, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.points_evicted = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments: Deque[str] = deque(sorted(
+            os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(SEGMENT_SUFFIX)
+        ))
+        self._segment_points: Dict[str, int] = {}
+        self._segment_bytes: Dict[str, int] = {}
+        for segment in self._segments:
+            with open(segment, 'rb') as f:
+                self._segment_points[segment] = f.read().count(b'\n')
+            self._segment_bytes[segment] = os.path.getsize(segment)
+        self._next_id = int(os.path.basename(self._segments[-1])[:-len(SEGMENT_SUFFIX)]) + 1 if self._segments else 0
+        self._current: Optional[BinaryIO] = None
+        self._replay_lines: List[bytes] = []
+        self._replay_pos = 0
+        if self._segments:
+            logging.info(f'Found {self.pending_points} spooled points in {len(self._segments)} segment(s)')
+
+    @property
+    def pending_points(self) -> int:
+        return sum(self._segment_points.values()) - self._replay_pos
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(self._segment_bytes.values())
+
+    def _rotate(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+    def _open_segment(self) -> BinaryIO:
+        segment = os.path.join(self.directory, f'{self._next_id:016d}{SEGMENT_SUFFIX}')
+        self._next_id += 1
+        self._segments.append(segment)
+        self._segment_points[segment] = 0
+        self._segment_bytes[segment] = 0
+        return open(segment, 'ab')
+
+    def append(self, lines: List[bytes]):
+        if not lines:
+            return
+        if self._current is None:
+            self._current = self._open_segment()
+        segment = self._segments[-1]
+        data = b''.join(line + b'\n' for line in lines)
+        self._current.write(data)
+        self._current.flush()
+        os.fsync(self._current.fileno())
+        self._segment_points[segment] += len(lines)
+        self._segment_bytes[segment] += len(data)
+        if self._segment_bytes[segment] >= self.segment_bytes:
+            self._rotate()
+        self._evict()
+
+    def _evict(self):
+        while self.size_bytes > self.max_bytes and len(self._segments) > 1:
+            segment = self._segments[0]
+            evicted = self._segment_points[segment] - self._replay_pos
+            self._remove_oldest()
+            self.points_evicted += evicted
+            logging.warning(f'Spool exceeded {self.max_bytes} bytes, evicted {evicted} points from {segment}')
+
+    def _remove_oldest(self):
+        segment = self._segments.popleft()
+        del self._segment_points[segment]
+        del self._segment_bytes[segment]
+        os.remove(segment)
+        self._replay_lines = []
+        self._replay_pos = 0
+
+    def peek(self, max_points: int) -> List[bytes]:
+        while not self._replay_lines:
+            if not self._segments:
+                return []
+            if len(self._segments) == 1:
+                self._rotate()
+            with open(self._segments[0], 'rb') as f:
+                # A crash mid-append can leave a partial last line, which is dropped
+                self._replay_lines = f.read().split(b'\n')[:-1]
+            self._replay_lines.sort(key=_timestamp)
+            self._replay_pos = 0
+            self._segment_points[self._segments[0]] = len(self._replay_lines)
+            if not self._replay_lines:
+                self._remove_oldest()
+        return self._replay_lines[self._replay_pos:self._replay_pos + max_points]
+
+    def commit(self, num_points: int):
+        self._replay_pos += num_points
+        if self._replay_pos >= len(self._replay_lines):
+            self._remove_oldest()
+
+    def close(self):
+        self._rotate()